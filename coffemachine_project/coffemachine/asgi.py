@@ -0,0 +1,20 @@
+"""
+ASGI config for coffemachine project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Ajax orders are brewed by coroutines, other requests are served by WSGI application in thread pool,
+e.g. uvicorn coffemachine.asgi:application
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "coffemachine.settings.production")
+
+from django.core.wsgi import get_wsgi_application
+
+wsgi_application = get_wsgi_application()
+
+from coffemachine.machine.asgi import CoffeeMachineASGI
+from coffemachine.machine.views import fleet
+
+application = CoffeeMachineASGI(fleet, wsgi_application)
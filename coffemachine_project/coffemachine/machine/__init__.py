@@ -0,0 +1 @@
+default_app_config = 'coffemachine.machine.apps.MachineConfig'
@@ -1,6 +1,7 @@
 # Register your models here.
 
 from django.contrib import admin
-from .models import Coffee
+from .models import Coffee, MachineState
 
 admin.site.register(Coffee)
+admin.site.register(MachineState)
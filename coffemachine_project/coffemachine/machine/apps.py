@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
 
 
 class MachineConfig(AppConfig):
-    name = 'machine'
+    name = 'coffemachine.machine'
     verbose_name = "Machine"
+
+    def ready(self):
+        from coffemachine.machine.models import Coffee
+        from coffemachine.machine.recipes import invalidate_recipes
+
+        post_save.connect(invalidate_recipes, sender=Coffee, dispatch_uid="machine_recipes_post_save")
+        post_delete.connect(invalidate_recipes, sender=Coffee, dispatch_uid="machine_recipes_post_delete")
+
+        from coffemachine.machine.lifecycle import register_fork_hook, warm_up
+
+        register_fork_hook()
+        if getattr(settings, "COFFEE_MACHINE_WARM_UP", False):
+            warm_up()
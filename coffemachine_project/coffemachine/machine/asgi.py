@@ -0,0 +1,248 @@
+"""
+ASGI application serving orders of coffee with coroutines.
+
+Django 1.11 handles requests only in threads, so this small ASGI application routes ajax orders to async views,
+which brew on AsyncCoffeeMachineFleet, and passes every other request to WSGI application in thread pool.
+Async views get regular HttpRequest, CSRF protection is checked like in middleware of WSGI application.
+Forms, recipes and availability of machines are checked in executor, so event loop does not wait for database,
+cache or state store.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.http import JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
+
+from coffemachine.machine.asynchronous import AsyncCoffeeMachineFleet
+from coffemachine.machine.clock import get_clock
+from coffemachine.machine.errors import encode_errors
+from coffemachine.machine.forms import CoffeeChoiceForm, CoffeeBatchForm
+from coffemachine.machine.fragments import render_problems
+from coffemachine.machine.idempotency import idempotent
+from coffemachine.machine.orders import Order
+from coffemachine.machine.recipes import recipe_cache
+
+
+def get_environ(scope, body):
+    """
+    :param scope: (dict) - scope of ASGI http connection
+    :param body: (bytes) - body of request
+    :return: WSGI environ of request
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        if name == "CONTENT_TYPE":
+            environ[name] = value
+        else:
+            key = "HTTP_%s" % name
+            environ[key] = "%s,%s" % (environ[key], value) if key in environ else value
+    return environ
+
+
+def get_order_result(status):
+    """
+    :param status: String with path to coffee image, otherwise dict with errors
+    :return: dict with result of order in the same format as status of queued order
+    """
+    if isinstance(status, dict):
+        return {"status": Order.FAILED, "problems": render_problems(status), "error_code": encode_errors(status)}
+    return {"status": Order.DONE, "image": status}
+
+
+def check_order(request, fleet):
+    """
+    Validate ajax order and check availability of coffee. It reads recipes and state of machines,
+    so async view runs it in executor.
+    :param fleet: (CoffeeMachineFleet) - wrapped fleet
+    :return: tuple: coffee and None, or None and response sent instead of brewing
+    """
+    form = CoffeeChoiceForm(data=request.POST)
+    if not form.is_valid():
+        return None, JsonResponse({"errors": form.errors}, status=400)
+    coffee = recipe_cache.get(form.cleaned_data["coffee_type"])
+    errors = fleet.get_unavailable_errors(coffee)
+    if errors:
+        return None, JsonResponse(get_order_result(errors))
+    return coffee, None
+
+
+def check_batch(request):
+    """
+    Validate batch of coffees, run in executor like check_order
+    :return: tuple: list of coffees and None, or None and response with errors of form
+    """
+    form = CoffeeBatchForm(data=request.POST, max_size=getattr(settings, "COFFEE_MACHINE_BATCH_SIZE", None))
+    if not form.is_valid():
+        return None, JsonResponse({"errors": form.errors}, status=400)
+    return [recipe_cache.get(coffee_type) for coffee_type in form.cleaned_data["coffee_type"]], None
+
+
+@idempotent
+async def make_coffee_view(request, fleet):
+    """
+    Async version of ajax order of CoffeeMachineView. Coffee is brewed before response is sent,
+    so response contains result instead of ticket.
+    """
+    coffee, response = await fleet.run_blocking(check_order, request, fleet.fleet)
+    if response is not None:
+        return response
+    return JsonResponse(get_order_result(await fleet.make_coffee(coffee)))
+
+
+@idempotent
+async def make_batch_view(request, fleet):
+    """
+    Async version of CoffeeBatchAjaxView
+    """
+    coffees, response = await fleet.run_blocking(check_batch, request)
+    if response is not None:
+        return response
+    results = await fleet.make_batch(coffees)
+    return JsonResponse({
+        "results": [dict(get_order_result(status), coffee_type=coffee.coffee_type)
+                    for coffee, status in zip(coffees, results)]
+    })
+
+
+class CoffeeMachineASGI(object):
+    """
+    ASGI 3 application. Ajax POST requests to paths of ASYNC_VIEWS are handled by coroutines,
+    other requests are handled by WSGI application.
+
+    Attributes:
+        ASYNC_VIEWS (dict) - async views keyed by path
+        fleet (AsyncCoffeeMachineFleet) - fleet brewing orders of async views
+        wsgi_application - Django WSGI application
+    """
+    ASYNC_VIEWS = {
+        "/": make_coffee_view,
+        "/batch/": make_batch_view,
+    }
+
+    def __init__(self, fleet, wsgi_application, workers=None):
+        """
+        :param fleet: (CoffeeMachineFleet) - fleet shared with WSGI views, e.g. fleet of views module
+        :param wsgi_application: Django WSGI application
+        :param workers: (int) - threads running WSGI application
+        """
+        self.fleet = AsyncCoffeeMachineFleet(fleet)
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            body = await self.read_body(receive)
+            view = self.ASYNC_VIEWS.get(scope["path"])
+            if view is not None and scope["method"] == "POST":
+                request = WSGIRequest(get_environ(scope, body))
+                if request.is_ajax():
+                    await self.send_response(send, await self.run_view(view, request))
+                    return
+            await self.run_wsgi(scope, body, send)
+        else:
+            raise ValueError("Unsupported connection %s" % scope["type"])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                get_clock().stop()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def run_view(self, view, request):
+        """
+        Run view between steps of CSRF middleware, like in WSGI application
+        :return: response of view, 403 response if CSRF token is wrong
+        """
+        middleware = CsrfViewMiddleware()
+        # CSRF cookie is read by process_request in later releases of Django 1.11, by process_view before
+        if hasattr(middleware, "process_request"):
+            middleware.process_request(request)
+        response = middleware.process_view(request, view, (), {})
+        if response is None:
+            response = await view(request, self.fleet)
+        return middleware.process_response(request, response)
+
+    async def run_wsgi(self, scope, body, send):
+        """
+        Run WSGI application in thread pool. Body of response is sent chunk by chunk,
+        so streaming responses, e.g. Server-Sent Events, reach client immediately.
+        """
+        loop = asyncio.get_event_loop()
+        status_headers = []
+
+        def start_response(status, headers, exc_info=None):
+            status_headers[:] = [status, headers]
+
+        response = await loop.run_in_executor(
+            self.executor, self.wsgi_application, get_environ(scope, body), start_response)
+        chunks = iter(response)
+        try:
+            status, headers = status_headers
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+            })
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(response, "close"):
+                await loop.run_in_executor(self.executor, response.close)
+
+    @staticmethod
+    async def send_response(send, response):
+        """
+        :param response: (HttpResponse) - response of async view
+        """
+        headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in response.items()]
+        headers.extend((b"set-cookie", cookie.output(header="").strip().encode("latin-1"))
+                       for cookie in response.cookies.values())
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": response.content})
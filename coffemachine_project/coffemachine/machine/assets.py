@@ -0,0 +1,214 @@
+"""
+Static bundles built ahead of time and served with far-future caching.
+
+build_assets concatenates sources of each bundle found by staticfiles finders, names result by hash of its content
+and writes gzip and brotli (if brotli package is installed) variants next to it. Bundle is served from other URL
+than its sources, so URLs of static files in stylesheets are made absolute and versioned by hash of the file,
+and comments linking source maps, which are not built, are removed. Manifest maps name of bundle
+to hashed file name. Hashed files never change, so AssetView sends them as immutable and repeat visitors
+download nothing. Without built manifest, e.g. in development, templates link sources of bundles one by one.
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.signals import setting_changed
+from django.templatetags.static import static
+
+BUNDLES = OrderedDict([
+    ("css/machine.css", ["css/bootstrap.min.css", "css/style.css"]),
+    ("js/machine.js", ["js/jquery-3.3.1.min.js", "js/machine.js"]),
+])
+
+MANIFEST_NAME = "manifest.json"
+
+# variants in order of preference, pairs of encoding and suffix of file
+ENCODINGS = (
+    ("br", ".br"),
+    ("gzip", ".gz"),
+)
+
+CSS_URL = re.compile(br"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+SOURCE_MAP = re.compile(br"^\s*(?://|/\*)# sourceMappingURL=.*$\n?", re.MULTILINE)
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def get_assets_root():
+    """
+    :return: (string) - directory with built bundles, COFFEE_MACHINE_ASSETS_ROOT or assets in STATIC_ROOT
+    """
+    return getattr(settings, "COFFEE_MACHINE_ASSETS_ROOT", None) or os.path.join(settings.STATIC_ROOT, "assets")
+
+
+def get_hashed_name(name, content):
+    """
+    :param name: (string) - name of bundle, e.g. "js/machine.js"
+    :param content: (bytes) - content of bundle
+    :return: name with first 12 characters of sha256 of content, e.g. "js/machine.0123456789ab.js"
+    """
+    root, extension = os.path.splitext(name)
+    return "%s.%s%s" % (root, hashlib.sha256(content).hexdigest()[:12], extension)
+
+
+def _hash_file(path):
+    with open(path, "rb") as static_file:
+        return hashlib.sha256(static_file.read()).hexdigest()[:12]
+
+
+def rewrite_urls(source, content):
+    """
+    :param source: (string) - path of stylesheet relative to static directories, e.g. "css/style.css"
+    :param content: (bytes) - content of stylesheet
+    :return: (bytes) - content with URLs of static files resolved against STATIC_URL and versioned by hash of file,
+        other URLs, e.g. data or external, are kept
+    :raise ValueError if referenced static file is not found
+    """
+    def replace(match):
+        url = match.group(2).decode("utf-8").strip()
+        path = url.split("#", 1)[0].split("?", 1)[0]
+        if path.startswith(settings.STATIC_URL):
+            path = path[len(settings.STATIC_URL):]
+        elif path and not path.startswith("/") and ":" not in path:
+            path = posixpath.normpath(posixpath.join(posixpath.dirname(source), path))
+        else:
+            return match.group(0)
+        found = finders.find(path)
+        if found is None:
+            raise ValueError("Static file %s referenced by %s not found" % (path, source))
+        return ('url("%s?v=%s")' % (static(path), _hash_file(found))).encode("utf-8")
+
+    return CSS_URL.sub(replace, content)
+
+
+def read_sources(sources):
+    """
+    :param sources: (list) - paths of static files relative to static directories
+    :return: (bytes) - content of files joined by new lines, URLs in stylesheets rewritten by rewrite_urls
+        and source map comments removed
+    :raise ValueError if any source is not found
+    """
+    chunks = []
+    for source in sources:
+        path = finders.find(source)
+        if path is None:
+            raise ValueError("Static file %s of bundle not found" % source)
+        with open(path, "rb") as source_file:
+            content = SOURCE_MAP.sub(b"", source_file.read())
+        if source.endswith(".css"):
+            content = rewrite_urls(source, content)
+        chunks.append(content.rstrip(b"\n"))
+    return b"\n".join(chunks) + b"\n"
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as output:
+        output.write(content)
+
+
+def compress_gzip(content):
+    """
+    :return: (bytes) - content compressed with the highest level, mtime is fixed,
+        so the same sources always give the same file
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as compressed:
+        compressed.write(content)
+    return buffer.getvalue()
+
+
+def build_assets(root=None, bundles=BUNDLES):
+    """
+    Write hashed bundles with compressed variants and manifest.
+    :param root: (string) - output directory, by default COFFEE_MACHINE_ASSETS_ROOT
+    :param bundles: (dict) - list of source files keyed by name of bundle
+    :return: (dict) - manifest, hashed file name keyed by name of bundle
+    """
+    root = root or get_assets_root()
+    manifest = OrderedDict()
+    for name, sources in bundles.items():
+        content = read_sources(sources)
+        hashed_name = get_hashed_name(name, content)
+        path = os.path.join(root, hashed_name)
+        _write(path, content)
+        _write(path + ".gz", compress_gzip(content))
+        if brotli is not None:
+            _write(path + ".br", brotli.compress(content, quality=11))
+        manifest[name] = hashed_name
+    _write(os.path.join(root, MANIFEST_NAME), json.dumps(manifest, indent=2).encode("utf-8"))
+    reset_manifest()
+    return manifest
+
+
+def get_manifest():
+    """
+    :return: (dict) - hashed file name keyed by name of bundle, empty if assets were not built
+    """
+    global _manifest
+    if _manifest is None:
+        with _manifest_lock:
+            if _manifest is None:
+                try:
+                    with open(os.path.join(get_assets_root(), MANIFEST_NAME)) as manifest_file:
+                        _manifest = json.load(manifest_file)
+                except (IOError, ValueError):
+                    _manifest = {}
+    return _manifest
+
+
+def reset_manifest(setting=None, **kwargs):
+    global _manifest
+    if setting in (None, "COFFEE_MACHINE_ASSETS_ROOT", "STATIC_ROOT"):
+        with _manifest_lock:
+            _manifest = None
+
+
+def reinit_after_fork():
+    global _manifest_lock
+    _manifest_lock = threading.Lock()
+
+
+setting_changed.connect(reset_manifest, dispatch_uid="machine_assets")
+
+
+def find_variant(hashed_name, accept_encoding):
+    """
+    :param hashed_name: (string) - file name from manifest
+    :param accept_encoding: (string) - Accept-Encoding header of request
+    :return: path of the smallest variant accepted by client and its encoding, None if file is not built
+    """
+    path = os.path.join(get_assets_root(), hashed_name)
+    accepted = set()
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip())
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.exists(path + suffix):
+            return path + suffix, encoding
+    if os.path.exists(path):
+        return path, None
+    return None, None
+
+
+def get_content_type(name):
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type.endswith("javascript"):
+        content_type += "; charset=utf-8"
+    return content_type
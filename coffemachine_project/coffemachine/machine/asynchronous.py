@@ -0,0 +1,261 @@
+"""
+Coroutine API of mechanism and fleet used by ASGI application.
+
+Logic of devices is not duplicated. Each device operation is run by wrapped CoffeeBrewMechanism at once
+in thread of executor, with DeferredClock collecting duration of device processes, and then coroutine sleeps
+collected duration on clock configured in settings. Event loop never waits for locks of devices, which are shared
+with blocking code, nor for persistent store. Brew waiting on simulated hardware keeps only a coroutine,
+so one event loop holds thousands of orders in flight.
+"""
+import asyncio
+import time
+
+from coffemachine.machine.clock import DeferredClock, get_clock, override_clock
+from coffemachine.machine.errors import ErrorFlags
+from coffemachine.machine.eventlog import EventLog
+from coffemachine.machine.fleet import brew_operation, batch_operation
+from coffemachine.machine.handler import CoffeeBrewMechanism, BrewContext, OperationException
+from coffemachine.machine.metrics import timed, step_seconds, brew_seconds, count_brew
+
+DEVICES = ("coffee_grinder", "milk_heater", "pressure_pump", "trash_bin", "water_heater")
+
+
+class AsyncCoffeeBrewMechanism(object):
+    """
+    Async version of CoffeeBrewMechanism. Steps of different brews overlap like in threaded mechanism,
+    each device is used by one brew at a time. Wrapped mechanism can be used by blocking code at the same time,
+    clocks of its devices are not changed.
+
+    Attributes:
+        mechanism (CoffeeBrewMechanism) - wrapped mechanism keeping state of devices
+        clock - clock used to sleep, None uses clock configured in settings
+        executor - executor running operations of wrapped mechanism, None uses default executor of event loop
+    """
+
+    def __init__(self, mechanism=None, clock=None, executor=None):
+        self.mechanism = mechanism or CoffeeBrewMechanism.create_standalone()
+        self.clock = clock
+        self.executor = executor
+        self._locks = {}
+
+    def _get_lock(self, device):
+        """
+        Locks are created lazily, so they belong to event loop running brews
+        """
+        if device not in self._locks:
+            self._locks[device] = asyncio.Lock()
+        return self._locks[device]
+
+    async def run(self, devices, operation, *args):
+        """
+        Run operation of wrapped mechanism holding locks of given devices until devices finish their processes
+        :param devices: (iterable) - names of used devices
+        :param operation: function of mechanism
+        :return: result of operation
+        """
+        locks = [self._get_lock(device) for device in sorted(devices)]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            deferred = DeferredClock()
+            result = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._run_deferred, deferred, operation, args)
+            await (self.clock or get_clock()).sleep(deferred.take())
+            return result
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @staticmethod
+    def _run_deferred(clock, operation, args):
+        """
+        Run operation in thread of executor, devices used by operation only add durations of processes to clock
+        """
+        with override_clock(clock):
+            return operation(*args)
+
+    async def prepare_ground_coffee(self, coffee):
+        """
+        :return: ErrorFlags of device, zero if successfully completed process
+        """
+        return await self.run(("coffee_grinder",), self.mechanism.prepare_ground_coffee, coffee)
+
+    async def boiling_water(self, quantity):
+        """
+        :return: ErrorFlags of device, zero if successfully completed process
+        """
+        return await self.run(("water_heater",), self.mechanism.boiling_water, quantity)
+
+    async def prepare_pressure_pump(self):
+        """
+        :return: ErrorFlags of device, zero if successfully completed process
+        """
+        return await self.run(("pressure_pump",), self.mechanism.prepare_pressure_pump)
+
+    async def lather_milk(self):
+        """
+        :return: ErrorFlags of device, zero if successfully completed process
+        """
+        return await self.run(("milk_heater", "water_heater"), self.mechanism.lather_milk)
+
+    async def reserve_trash_bin(self, context):
+        """
+        :return: ErrorFlags of device, zero if place for waste was taken
+        """
+        return await self.run(("trash_bin",), self.mechanism.reserve_trash_bin, context)
+
+    def _check_step(self, context, status, stage, step):
+        self.mechanism._update_status(context, status)
+        context.notify(stage, context.errors)
+        if context.errors:
+            raise OperationException(step)
+
+    @timed(step_seconds, "step_preparing_trash")
+    async def step_preparing_trash(self, context):
+        self._check_step(context, await self.reserve_trash_bin(context), context.TRASH, "step_preparing_trash")
+
+    @timed(step_seconds, "step_preparing_ground_coffee")
+    async def step_preparing_ground_coffee(self, context):
+        status = await self.prepare_ground_coffee(context.coffee)
+        self._check_step(context, status, context.GRINDING, "step_preparing_ground_coffee")
+
+    @timed(step_seconds, "step_preparing_boiling_water")
+    async def step_preparing_boiling_water(self, context):
+        status = await self.boiling_water(context.coffee.size)
+        self._check_step(context, status, context.BOILING, "step_preparing_boiling_water")
+
+    @timed(step_seconds, "step_preparing_pressure_pump")
+    async def step_preparing_pressure_pump(self, context):
+        status = await self.prepare_pressure_pump()
+        self._check_step(context, status, context.PRESSURE, "step_preparing_pressure_pump")
+
+    async def step_adding_extra_water(self, context):
+        status = await self.boiling_water(context.coffee.extra_quantity)
+        context.notify(context.EXTRA_WATER, status)
+        return status
+
+    async def step_lathering_milk(self, context):
+        status = await self.lather_milk()
+        context.notify(context.MILK, status)
+        return status
+
+    async def brew(self, context):
+        """
+        Run steps of compiled recipe, like brew of CoffeeBrewMechanism
+        :param context: BrewContext object with state of brew
+        :return: String with path to coffee image, otherwise ErrorFlags with errors
+        """
+        recipe = context.recipe
+        try:
+            for method in recipe.basic_methods:
+                await getattr(self, method)(context)
+        except OperationException:
+            await self.run(("trash_bin",), self.mechanism.release_trash_bin, [context])
+            self.mechanism._store_errors(context.errors)
+            return context.errors
+        await self.run(("pressure_pump", "water_heater"), self.mechanism.run_brew_process)
+        for method in recipe.extra_methods:
+            status = await getattr(self, method)(context)
+            if status:
+                return status
+        return recipe.IMAGE
+
+    async def make_coffee(self, coffee, listener=None):
+        """
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :param listener: function informed about each finished stage of brew, see BrewContext
+        :return: String with path to proper coffee image, otherwise dict with errors
+        """
+        start = time.perf_counter()
+        context = BrewContext(coffee, self.mechanism.get_method_for_coffee(coffee), self.mechanism.get_errors(),
+                              listener)
+        try:
+            status = await self.brew(context)
+        finally:
+            brew_seconds.observe(coffee.coffee_type, time.perf_counter() - start)
+        if isinstance(status, ErrorFlags):
+            context.notify(context.FAILED, status)
+            status = status.to_dict()
+        else:
+            context.notify(context.DONE)
+        count_brew(coffee, status)
+        return status
+
+    async def make_batch(self, coffees):
+        """
+        Batch shares cycles of devices, so it holds every device until whole batch is finished
+        :param coffees: (list) - model objects containing coffees, which clients want to drink
+        :return: list with path to proper coffee image or dict with errors for each coffee
+        """
+        return await self.run(DEVICES, self.mechanism.make_batch, coffees)
+
+
+class AsyncCoffeeMachineFleet(object):
+    """
+    Coroutine API over CoffeeMachineFleet. Dispatching, counters and refills are shared with wrapped fleet.
+    Machine with persistent store or journal runs operation through FleetMachine in executor, so state is
+    saved and logged like in blocking fleet, and then sleeps for durations of devices collected by operation.
+
+    Attributes:
+        fleet (CoffeeMachineFleet) - wrapped fleet
+        brewers (list) - AsyncCoffeeBrewMechanism of each machine
+    """
+
+    def __init__(self, fleet, clock=None, executor=None):
+        self.fleet = fleet
+        self.executor = executor
+        self.brewers = [AsyncCoffeeBrewMechanism(machine.mechanism, clock, executor) for machine in fleet.machines]
+
+    async def run_blocking(self, function, *args):
+        """
+        Run blocking function, e.g. reading persistent store or database, in executor
+        :return: result of function
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def _reserve(self, machine, operation, kind, coffees, listener=None):
+        """
+        Apply operation to machine with persistent store or journal in executor, then replay its side effects
+        :return: result of operation
+        """
+        result, effects = await self.run_blocking(machine.reserve, operation, kind, coffees, listener)
+        if effects is not None:
+            await effects.replay_async(listener, self.brewers[machine.machine_id].clock)
+        return result
+
+    async def make_coffee(self, coffee, listener=None):
+        """
+        Dispatch order to least loaded machine able to brew it
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :param listener: function informed about each finished stage of brew, see BrewContext
+        :return: String with path to proper coffee image, otherwise dict with errors
+        """
+        machine = await self.run_blocking(self.fleet.dispatch, [coffee])
+        try:
+            start = time.time()
+            if machine.store is not None or machine.journal is not None:
+                status = await self._reserve(machine, brew_operation(coffee), EventLog.BREW, [coffee], listener)
+            else:
+                status = await self.brewers[machine.machine_id].make_coffee(coffee, listener)
+            machine._count([status], time.time() - start)
+            return status
+        finally:
+            self.fleet.release(machine, 1)
+
+    async def make_batch(self, coffees):
+        """
+        Dispatch whole batch to one machine
+        :param coffees: (list) - model objects containing coffees, which clients want to drink
+        :return: list with path to proper coffee image or dict with errors for each coffee
+        """
+        machine = await self.run_blocking(self.fleet.dispatch, coffees, True)
+        try:
+            start = time.time()
+            if machine.store is not None or machine.journal is not None:
+                results = await self._reserve(machine, batch_operation(coffees), EventLog.BATCH_CUP, coffees)
+            else:
+                results = await self.brewers[machine.machine_id].make_batch(coffees)
+            machine._count(results, time.time() - start)
+            return results
+        finally:
+            self.fleet.release(machine, len(coffees))
@@ -0,0 +1,133 @@
+import math
+from collections import namedtuple
+
+from coffemachine.machine.container import MilkTank
+from coffemachine.machine.devices import WaterHeater, MilkHeater, CoffeeGrinder, TrashBin
+
+CupConsumption = namedtuple("CupConsumption", ["water", "water_required", "beans", "milk", "trash", "valid"])
+CupConsumption.__doc__ = """
+Resources used by mechanism to brew one cup of coffee. Milk heater does not check water taken for pressure pump,
+so latte is served even if this last portion of water is missing, water_required does not contain it.
+Flag valid is False if recipe can not be brewed at all, e.g. size of coffee does not fit in water heater.
+"""
+
+
+def get_cup_consumption(coffee, recipe):
+    """
+    Count resources used by one brew. It follows steps of mechanism: water for coffee and for each
+    preparing of pressure pump is taken from water tank, grinder takes beans only if amount fits in grinder.
+    :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+    :param recipe: (RecipePipeline) - compiled recipe used to brew coffee
+    :return: CupConsumption object
+    """
+    boils = [coffee.size]
+    milk = 0
+    if recipe.EXTRA_WATER:
+        boils.append(coffee.extra_quantity or 0)
+    if recipe.LATHER_MILK:
+        boils.append(MilkTank.WATER_FOR_LATHER)
+        milk = MilkHeater.CAPACITY
+    valid = all(WaterHeater.MIN_CAPACITY <= amount <= WaterHeater.CAPACITY for amount in boils)
+    beans = coffee.coffee_quantity if 0 < coffee.coffee_quantity <= CoffeeGrinder.CAPACITY else 0
+    water = sum(boils) + WaterHeater.CAPACITY * len(boils)
+    water_required = water - WaterHeater.CAPACITY if recipe.LATHER_MILK else water
+    return CupConsumption(water=water, water_required=water_required, beans=beans, milk=milk, trash=1, valid=valid)
+
+
+def count_cups(level, amount, required=None):
+    """
+    Count how many times amount can be taken from container. Container never gives away the last portion,
+    so level must stay above zero.
+    :param level: (int) - current level of container
+    :param amount: (int) - amount taken by one cup
+    :param required: (int) - part of amount, which must be available for the last cup, by default whole amount
+    :return: number of cups, None if cup does not need anything from container
+    """
+    if not amount:
+        return None
+    if required is None:
+        required = amount
+    return max(int(math.ceil(float(level - required + amount) / amount)) - 1, 0)
+
+
+class MachineAvailability(object):
+    """
+    Read-only view on resources of mechanism. Counts how many cups of coffee can be brewed without running
+    any device, so doomed orders are rejected before they consume beans or water.
+
+    Attributes:
+        mechanism (CoffeeBrewMechanism) - checked mechanism
+    """
+
+    def __init__(self, mechanism):
+        self.mechanism = mechanism
+
+    def get_levels(self):
+        """
+        :return: dict with current level of each resource
+        """
+        mechanism = self.mechanism
+        return {
+            "water": mechanism.water_heater.water_tank.content_level,
+            "beans": mechanism.coffee_grinder.coffee_tank.content_level,
+            "milk": mechanism.milk_heater.milk_tank.content_level,
+            "trash": TrashBin.CAPACITY - mechanism.trash_bin.current_level,
+        }
+
+    def _get_limits(self, coffee):
+        consumption = get_cup_consumption(coffee, self.mechanism.get_method_for_coffee(coffee))
+        levels = self.get_levels()
+        return consumption, {
+            "water": count_cups(levels["water"], consumption.water, consumption.water_required),
+            "beans": count_cups(levels["beans"], consumption.beans),
+            "milk": count_cups(levels["milk"], consumption.milk),
+            "trash": max(levels["trash"], 0),
+        }
+
+    def count(self, coffee):
+        """
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :return: number of cups, which can be brewed right now
+        """
+        if not self.mechanism.can_make_coffee(coffee):
+            return 0
+        consumption, limits = self._get_limits(coffee)
+        if not consumption.valid:
+            return 0
+        return min(limit for limit in limits.values() if limit is not None)
+
+    def get_errors(self, coffee):
+        """
+        Find errors, which brew of given coffee would report.
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :return: dict with errors, empty if coffee can be brewed
+        """
+        errors = self.mechanism.get_errors()
+        if errors:
+            return errors.to_dict()
+        errors = {}
+        consumption, limits = self._get_limits(coffee)
+        if not consumption.valid:
+            errors[WaterHeater.ERROR_NOT_ENOUGH_WATER_TO_BOIL] = True
+        messages = {
+            "water": WaterHeater.ERROR_EMPTY_WATER_TANK,
+            "beans": CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND,
+            "milk": MilkHeater.ERROR_EMPTY_MILK_TANK,
+            "trash": TrashBin.ERROR_FULL_TRASH,
+        }
+        for resource, limit in limits.items():
+            if limit == 0:
+                errors[messages[resource]] = True
+        devices = [self.mechanism.water_heater, self.mechanism.coffee_grinder, self.mechanism.trash_bin]
+        if coffee.contains_milk:
+            devices.append(self.mechanism.milk_heater)
+        for device in devices:
+            errors.update(device.get_device_errors().to_dict())
+        return errors
+
+    def get_availability(self, recipes):
+        """
+        :param recipes: (iterable) - coffee recipes
+        :return: dict with number of available cups keyed by coffee type
+        """
+        return {coffee.coffee_type: self.count(coffee) for coffee in recipes}
@@ -0,0 +1,239 @@
+"""
+Benchmarks of mechanism and views. Each benchmark returns dict with measured value, unit and direction,
+so results of different runs can be stored as json and compared.
+"""
+import gc
+import platform
+import time
+import tracemalloc
+from unittest import mock
+
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from coffemachine.machine.compact import CompactFleetState
+from coffemachine.machine.handler import CoffeeBrewMechanism, BrewContext, OperationException
+
+STEPS = (
+    "step_preparing_trash",
+    "step_preparing_ground_coffee",
+    "step_preparing_boiling_water",
+    "step_preparing_pressure_pump",
+)
+
+# seconds after which order measured by benchmark of views is counted as failed
+ORDER_TIMEOUT = 10
+
+
+def _latency(timings):
+    """
+    :param timings: (list) - measured durations in seconds
+    :return: dict with median latency in seconds and its spread
+    """
+    timings = sorted(timings)
+    return {
+        "value": timings[len(timings) // 2],
+        "min": timings[0],
+        "max": timings[-1],
+        "rounds": len(timings),
+        "unit": "s",
+        "higher_is_better": False,
+    }
+
+
+def bench_make_coffee(coffee, rounds=200):
+    """
+    Latency of CoffeeBrewMechanism.make_coffee. Each round brews on new mechanism with full tanks,
+    creating mechanism is not measured.
+    :param coffee: (Coffee) - model object or recipe snapshot
+    """
+    timings = []
+    for _ in range(rounds):
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        start = time.perf_counter()
+        mechanism.make_coffee(coffee)
+        timings.append(time.perf_counter() - start)
+    return _latency(timings)
+
+
+def bench_steps(coffee, rounds=200):
+    """
+    Latency of each step of basic coffee. Steps are run in order on new mechanism, like in brew of mechanism.
+    :param coffee: (Coffee) - model object or recipe snapshot
+    :return: dict with result of each step keyed by name of step
+    """
+    timings = {step: [] for step in STEPS}
+    for _ in range(rounds):
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        context = BrewContext(coffee, mechanism.get_method_for_coffee(coffee))
+        for step in STEPS:
+            method = getattr(mechanism, step)
+            start = time.perf_counter()
+            try:
+                method(context)
+            except OperationException:
+                break
+            finally:
+                timings[step].append(time.perf_counter() - start)
+    return {step: _latency(values) for step, values in timings.items() if values}
+
+
+def _requests_per_second(send, prepare=None, rounds=200):
+    """
+    :param send: function sending one request and returning True if it succeeded
+    :param prepare: function called before each request, its time is not measured
+    :return: dict with number of requests per second and number of failed requests
+    """
+    send()
+    elapsed = 0.0
+    errors = 0
+    for _ in range(rounds):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        succeeded = send()
+        elapsed += time.perf_counter() - start
+        errors += not succeeded
+    return {
+        "value": rounds / elapsed if elapsed else 0.0,
+        "rounds": rounds,
+        "errors": errors,
+        "unit": "req/s",
+        "higher_is_better": True,
+    }
+
+
+def bench_views(coffee_type, rounds=200):
+    """
+    Requests per second of CoffeeMachineView and CoffeeExtraOptionsAjaxView through django test client.
+    Order is measured until it is brewed, not only until it is queued. Views use own fleet of benchmark,
+    which is refilled before each order, so every request goes through whole view and machines of server
+    are not touched.
+    :param coffee_type: (string) - coffee ordered in main view
+    """
+    from coffemachine.machine import views
+    from coffemachine.machine.fleet import CoffeeMachineFleet
+    from coffemachine.machine.orders import Order
+
+    fleet = CoffeeMachineFleet()
+
+    def refill():
+        fleet.refill_water_tank()
+        fleet.refill_beans_tank()
+        fleet.fill_milk()
+        fleet.remove_trash_bin()
+
+    def order_coffee():
+        response = client.post(main_url, {"coffee_type": coffee_type}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        if response.status_code >= 400:
+            return False
+        order = views.orders.get(response.json()["ticket"])
+        return order.wait(ORDER_TIMEOUT) and order.status == Order.DONE
+
+    client = Client()
+    main_url = reverse("machine:%s" % views.CoffeeMachineView.view_name)
+    options_url = reverse("machine:%s" % views.CoffeeExtraOptionsAjaxView.view_name)
+    with override_settings(ALLOWED_HOSTS=["testserver"]), mock.patch.object(views, "fleet", fleet), \
+            mock.patch.object(views.orders, "machine", fleet):
+        return {
+            "view_order_coffee": _requests_per_second(order_coffee, prepare=refill, rounds=rounds),
+            "view_extra_options": _requests_per_second(
+                lambda: client.post(options_url, {"method": "water_options"},
+                                    HTTP_X_REQUESTED_WITH="XMLHttpRequest").status_code < 400,
+                rounds=rounds),
+        }
+
+
+def bench_mechanism_memory(instances=1000):
+    """
+    Memory allocated by one standalone mechanism with all devices and containers
+    :param instances: (int) - number of mechanisms created at once, result is averaged
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        mechanisms = [CoffeeBrewMechanism.create_standalone() for _ in range(instances)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del mechanisms
+    return {
+        "value": float(after - before) / instances,
+        "rounds": instances,
+        "unit": "B",
+        "higher_is_better": False,
+    }
+
+
+def bench_compact_memory(machines=100000):
+    """
+    Memory allocated for one machine kept in CompactFleetState, comparable with bench_mechanism_memory
+    :param machines: (int) - number of machines in fleet, result is averaged
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        state = CompactFleetState(machines)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del state
+    return {
+        "value": float(after - before) / machines,
+        "rounds": machines,
+        "unit": "B",
+        "higher_is_better": False,
+    }
+
+
+def run_benchmarks(recipes, rounds=200, views=True):
+    """
+    Run all benchmarks
+    :param recipes: (iterable) - Coffee model objects or recipe snapshots
+    :param rounds: (int) - number of measured rounds of each benchmark
+    :param views: (bool) - measure views, it needs database with recipes
+    :return: dict with environment and results keyed by name of benchmark
+    """
+    recipes = list(recipes)
+    results = {}
+    for coffee in recipes:
+        results["make_coffee.%s" % coffee.coffee_type] = bench_make_coffee(coffee, rounds)
+        for step, result in bench_steps(coffee, rounds).items():
+            results["%s.%s" % (step, coffee.coffee_type)] = result
+    if views and recipes:
+        results.update(bench_views(recipes[0].coffee_type, rounds))
+    results["mechanism_memory"] = bench_mechanism_memory()
+    results["compact_machine_memory"] = bench_compact_memory()
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "rounds": rounds,
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Compare results with saved baseline. Result is regression, if it is worse than baseline by more than threshold.
+    :param baseline: (dict) - results returned by run_benchmarks
+    :param current: (dict) - results returned by run_benchmarks
+    :param threshold: (float) - allowed relative change, e.g. 0.2 for 20%
+    :return: list of dicts with name, baseline value, current value, change and flag of regression
+    """
+    rows = []
+    for name, result in sorted(current["results"].items()):
+        saved = baseline["results"].get(name)
+        if saved is None or not saved["value"]:
+            continue
+        change = (result["value"] - saved["value"]) / saved["value"]
+        worse = -change if result["higher_is_better"] else change
+        rows.append({
+            "name": name,
+            "baseline": saved["value"],
+            "current": result["value"],
+            "change": change,
+            "regression": worse > threshold,
+        })
+    return rows
@@ -0,0 +1,187 @@
+"""
+Clocks used by devices to model duration of their processes.
+
+Devices do not count time themselves, they ask clock to wait PROCESS_TIME seconds. Instant clock returns at once,
+so tests and benchmarks measure only logic of mechanism. Scaled clock waits N times shorter than real device,
+real-time clock waits whole PROCESS_TIME. Waiting thread sleeps on event, so it does not use CPU.
+Coroutines of async mechanism use sleep of clock instead of wait, so they do not block event loop.
+"""
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+
+class InstantClock(object):
+    """
+    Clock without waiting, processes of devices finish immediately
+    """
+    speed = None
+
+    def wait(self, seconds):
+        """
+        :param seconds: (float) - duration of process of real device
+        :return: True if whole duration passed
+        """
+        return True
+
+    async def sleep(self, seconds):
+        """
+        Coroutine version of wait, it only lets other coroutines run
+        """
+        await asyncio.sleep(0)
+        return True
+
+    def stop(self):
+        pass
+
+
+class ScaledClock(object):
+    """
+    Clock running speed times faster than real time.
+
+    Attributes:
+        speed (float) - how many seconds of device process pass in one real second
+    """
+
+    def __init__(self, speed=1.0):
+        if speed <= 0:
+            raise ValueError("Speed of clock must be positive")
+        self.speed = float(speed)
+        self._stopped = threading.Event()
+
+    def wait(self, seconds):
+        """
+        :param seconds: (float) - duration of process of real device
+        :return: True if whole duration passed, False if clock was stopped in the meantime
+        """
+        return not self._stopped.wait(seconds / self.speed)
+
+    async def sleep(self, seconds):
+        """
+        Coroutine version of wait, other coroutines run in the meantime
+        :param seconds: (float) - duration of process of real device
+        :return: True if clock was not stopped
+        """
+        if not self._stopped.is_set():
+            await asyncio.sleep(seconds / self.speed)
+        return not self._stopped.is_set()
+
+    def stop(self):
+        """
+        Wake up all waiting devices, e.g. on shutdown of process. Next waits return immediately.
+        """
+        self._stopped.set()
+
+
+class RealTimeClock(ScaledClock):
+    """
+    Clock waiting as long as real device
+    """
+
+    def __init__(self):
+        super(RealTimeClock, self).__init__(1.0)
+
+
+class DeferredClock(object):
+    """
+    Clock which only sums duration of processes. Async mechanism runs logic of devices with this clock
+    and then sleeps whole collected duration on real clock.
+
+    Attributes:
+        pending (float) - seconds collected since last take
+    """
+
+    def __init__(self):
+        self.pending = 0.0
+
+    def wait(self, seconds):
+        self.pending += seconds
+        return True
+
+    def take(self):
+        """
+        :return: collected seconds, counting starts again from zero
+        """
+        pending, self.pending = self.pending, 0.0
+        return pending
+
+
+CLOCKS = {
+    "instant": InstantClock,
+    "scaled": ScaledClock,
+    "realtime": RealTimeClock,
+}
+
+_clock = None
+_clock_lock = threading.Lock()
+
+
+def create_clock(mode, speed=None):
+    """
+    :param mode: (string) - "instant", "scaled" or "realtime"
+    :param speed: (float) - speed of scaled clock
+    :return: new clock
+    """
+    if mode not in CLOCKS:
+        raise ValueError("Unknown clock %s, choose one of: %s" % (mode, ", ".join(sorted(CLOCKS))))
+    if mode == "scaled":
+        return ScaledClock(speed or 1.0)
+    return CLOCKS[mode]()
+
+
+_override = threading.local()
+
+
+@contextmanager
+def override_clock(clock):
+    """
+    Devices without own clock used by current thread inside block wait on given clock,
+    e.g. DeferredClock collecting duration of operation, which is waited later. Other threads are not affected.
+    """
+    previous = getattr(_override, "clock", None)
+    _override.clock = clock
+    try:
+        yield clock
+    finally:
+        _override.clock = previous
+
+
+def get_clock():
+    """
+    :return: clock overridden in current thread, otherwise clock configured by COFFEE_MACHINE_CLOCK
+        and COFFEE_MACHINE_CLOCK_SPEED settings, shared by all devices
+    """
+    global _clock
+    clock = getattr(_override, "clock", None)
+    if clock is not None:
+        return clock
+    if _clock is None:
+        with _clock_lock:
+            if _clock is None:
+                _clock = create_clock(getattr(settings, "COFFEE_MACHINE_CLOCK", "instant"),
+                                      getattr(settings, "COFFEE_MACHINE_CLOCK_SPEED", None))
+    return _clock
+
+
+def reset_clock(setting, **kwargs):
+    global _clock
+    if setting in ("COFFEE_MACHINE_CLOCK", "COFFEE_MACHINE_CLOCK_SPEED"):
+        with _clock_lock:
+            if _clock is not None:
+                _clock.stop()
+            _clock = None
+
+
+def reinit_after_fork():
+    """
+    Child process creates own clock, event of parent clock could be used by threads, which do not exist in child
+    """
+    global _clock, _clock_lock
+    _clock_lock = threading.Lock()
+    _clock = None
+
+
+setting_changed.connect(reset_clock, dispatch_uid="machine_clock")
@@ -0,0 +1,200 @@
+"""
+Compact state of large fleet of virtual machines.
+
+State of all machines is kept in typed arrays indexed by machine id, e.g. water level of machine 7 is water[7].
+Devices, containers and mechanism are short living views with __slots__ over one position of arrays.
+Original classes define __slots__ too, so views have no __dict__.
+Views inherit all logic from original classes, only attributes with state are read from and written to arrays,
+so machine kept in arrays behaves exactly like CoffeeBrewMechanism.
+"""
+import threading
+from array import array
+
+from coffemachine.machine.container import WaterTank, MilkTank, CoffeeBeansTank
+from coffemachine.machine.devices import WaterHeater, MilkHeater, CoffeeGrinder, PressurePump, TrashBin
+from coffemachine.machine.errors import ERROR_MESSAGES, ALL_ERRORS, ErrorFlags
+from coffemachine.machine.handler import CoffeeBrewMechanism
+
+ERROR_OWNERS = ("water_heater", "milk_heater", "coffee_grinder", "pressure_pump", "trash_bin", "mechanism")
+
+if len(ERROR_OWNERS) * len(ERROR_MESSAGES) > 64:
+    raise ValueError("Errors of %s owners do not fit in 64 bits of errors array" % len(ERROR_OWNERS))
+
+
+class CompactFleetState(object):
+    """
+    Arrays with state of machines. Each machine starts with full tanks and empty trash bin, like new mechanism.
+
+    Attributes:
+        COLUMNS (tuple) - name, type code and initial value of each array
+        size (int) - number of machines
+        errors (array) - ErrorFlags of each device and mechanism, shifted by position of owner in ERROR_OWNERS
+        lock (RLock) - guards all arrays, views use it instead of locks of devices
+    """
+    COLUMNS = (
+        ("water", "i", WaterTank.CAPACITY),
+        ("beans", "i", CoffeeBeansTank.CAPACITY),
+        ("milk", "i", MilkTank.CAPACITY),
+        ("trash", "i", 0),
+        ("water_temp", "h", 20),
+        ("heater_capacity", "i", WaterHeater.MIN_CAPACITY),
+        ("pressure", "b", 1),
+        ("grinder_capacity", "i", 0),
+        ("errors", "Q", 0),
+    )
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("Fleet needs at least one machine")
+        self.size = size
+        for name, typecode, initial in self.COLUMNS:
+            setattr(self, name, array(typecode, [initial]) * size)
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.size
+
+    def machine(self, machine_id):
+        """
+        :param machine_id: (int) - index of machine
+        :return: CompactMechanism view of machine
+        """
+        if not 0 <= machine_id < self.size:
+            raise IndexError("Fleet has %s machines" % self.size)
+        return CompactMechanism(self, machine_id)
+
+    def make_coffee(self, machine_id, coffee):
+        """
+        :return: String with path to proper coffee image, otherwise dict with errors
+        """
+        return self.machine(machine_id).make_coffee(coffee)
+
+    def get_memory(self):
+        """
+        :return: number of bytes used by arrays
+        """
+        return sum(len(column) * column.itemsize for column in (getattr(self, name) for name, _, _ in self.COLUMNS))
+
+
+def _column(name, doc):
+    """
+    :return: property reading and writing position of view in array with given name
+    """
+    def getter(self):
+        return getattr(self.state, name)[self.index]
+
+    def setter(self, value):
+        getattr(self.state, name)[self.index] = value
+
+    return property(getter, setter, doc=doc)
+
+
+def _view(view_class, doc):
+    """
+    :return: property creating view of other part of the same machine
+    """
+    return property(lambda self: view_class(self.state, self.index), doc=doc)
+
+
+def _error_bits(owner, doc):
+    """
+    :return: property reading and writing ErrorFlags of given owner, which are kept in part of bits of errors array
+    """
+    shift = ERROR_OWNERS.index(owner) * len(ERROR_MESSAGES)
+
+    def getter(self):
+        return ErrorFlags(self.state.errors[self.index] >> shift & ALL_ERRORS)
+
+    def setter(self, errors):
+        bits = self.state.errors[self.index] & ~(ALL_ERRORS << shift)
+        self.state.errors[self.index] = bits | (ErrorFlags(errors) & ALL_ERRORS) << shift
+
+    return property(getter, setter, doc=doc)
+
+
+class _MachineView(object):
+    """
+    Base of views. Lock of every part is lock of whole fleet state, devices use clock configured in settings.
+    Original classes have own slots, so each view defines slots state and index, base can not add them
+    without conflict of layouts.
+    """
+    __slots__ = ()
+    clock = None
+
+    def __init__(self, state, index):
+        self.state = state
+        self.index = index
+
+    @property
+    def lock(self):
+        return self.state.lock
+
+
+class CompactWaterTank(_MachineView, WaterTank):
+    __slots__ = ("state", "index")
+    content_level = _column("water", "level of water tank")
+
+
+class CompactMilkTank(_MachineView, MilkTank):
+    __slots__ = ("state", "index")
+    content_level = _column("milk", "level of milk tank")
+
+
+class CompactCoffeeBeansTank(_MachineView, CoffeeBeansTank):
+    __slots__ = ("state", "index")
+    content_level = _column("beans", "level of coffee beans tank")
+
+
+class CompactWaterHeater(_MachineView, WaterHeater):
+    __slots__ = ("state", "index")
+    _errors = _error_bits("water_heater", "errors of device")
+    water_tank = _view(CompactWaterTank, "water tank of machine")
+    water_temp = _column("water_temp", "temperature of water")
+    current_capacity = _column("heater_capacity", "amount of water in heater")
+
+
+class CompactMilkHeater(_MachineView, MilkHeater):
+    __slots__ = ("state", "index")
+    _errors = _error_bits("milk_heater", "errors of device")
+    water_heater = _view(CompactWaterHeater, "water heater of machine")
+    milk_tank = _view(CompactMilkTank, "milk tank of machine")
+
+
+class CompactCoffeeGrinder(_MachineView, CoffeeGrinder):
+    __slots__ = ("state", "index")
+    _errors = _error_bits("coffee_grinder", "errors of device")
+    coffee_tank = _view(CompactCoffeeBeansTank, "coffee beans tank of machine")
+    current_capacity = _column("grinder_capacity", "amount of ground beans")
+
+
+class CompactPressurePump(_MachineView, PressurePump):
+    __slots__ = ("state", "index")
+    _errors = _error_bits("pressure_pump", "errors of device")
+    current_pressure = _column("pressure", "current pressure")
+
+
+class CompactTrashBin(_MachineView, TrashBin):
+    __slots__ = ("state", "index")
+    _errors = _error_bits("trash_bin", "errors of device")
+    current_level = _column("trash", "level of trash bin")
+
+
+class CompactMechanism(_MachineView, CoffeeBrewMechanism):
+    """
+    Mechanism of one machine kept in CompactFleetState. It does not take part in singleton pattern.
+    """
+    __slots__ = ("state", "index")
+    water_heater = _view(CompactWaterHeater, "water heater of machine")
+    milk_heater = _view(CompactMilkHeater, "milk heater of machine")
+    coffee_grinder = _view(CompactCoffeeGrinder, "coffee grinder of machine")
+    pressure_pump = _view(CompactPressurePump, "pressure pump of machine")
+    trash_bin = _view(CompactTrashBin, "trash bin of machine")
+
+    def __new__(cls, state, index):
+        return object.__new__(cls)
+
+    errors = _error_bits("mechanism", "errors blocking mechanism")
+
+    @property
+    def _errors_lock(self):
+        return self.state.lock
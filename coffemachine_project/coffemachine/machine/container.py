@@ -1,15 +1,28 @@
+import threading
 from abc import ABCMeta
 
 
 class Container(object):
+    """
+    Abstract container for water, milk or coffee beans.
+
+    Attributes:
+        content_level (int) - current amount of content
+        lock (Lock) - guards content level, so concurrent brews do not lose updates
+    """
     __metaclass__ = ABCMeta
+    __slots__ = ("lock", "content_level")
     CAPACITY = 0
 
     def __init__(self, fill_fluid=True):
+        self.lock = threading.Lock()
         self.content_level = 0
         if fill_fluid:
             self.fill_tank(self.CAPACITY)
 
+    def reinit_after_fork(self):
+        self.lock = threading.Lock()
+
     def fill_tank(self, capacity):
         """
         Filling the container with given amount of something
@@ -20,29 +33,34 @@ class Container(object):
             return False
         elif capacity < 0:
             raise ValueError("It is possible to have minus something in bottle?")
-        elif capacity + self.content_level <= self.CAPACITY:
-            self.content_level += capacity
-            return True
-        else:
-            self.content_level = self.CAPACITY
-            return False
+        with self.lock:
+            if capacity + self.content_level <= self.CAPACITY:
+                self.content_level += capacity
+                return True
+            else:
+                self.content_level = self.CAPACITY
+                return False
 
     def get_amount_from_container(self, amount):
-        if self.content_level - amount > 0:
-            self.content_level -= amount
-            return True
-        else:
-            return False
+        with self.lock:
+            if self.content_level - amount > 0:
+                self.content_level -= amount
+                return True
+            else:
+                return False
 
 
 class WaterTank(Container):
+    __slots__ = ()
     CAPACITY = 1000  # ml
 
 
 class MilkTank(Container):
+    __slots__ = ()
     CAPACITY = 300  # ml
     WATER_FOR_LATHER = 150  # ml
 
 
 class CoffeeBeansTank(Container):
+    __slots__ = ()
     CAPACITY = 500  # dg
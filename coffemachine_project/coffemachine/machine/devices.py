@@ -1,6 +1,10 @@
+import threading
 from abc import ABCMeta, abstractmethod
 
+from coffemachine.machine.clock import get_clock
 from coffemachine.machine.container import MilkTank, CoffeeBeansTank, WaterTank
+from coffemachine.machine.errors import ErrorFlags, ERROR_CODES
+from coffemachine.machine.metrics import timed, device_seconds
 
 
 class DevicePart(object):
@@ -8,12 +12,20 @@ class DevicePart(object):
     This abstract class provides basic operations for all device parts in coffee machine
 
     Attributes:
-            _errors (dict): collect errors in mechanism
+            _errors (ErrorFlags): collect errors in mechanism
+            lock (RLock): guards state of device, mechanism holds it during each operation on device
+            clock: clock measuring duration of processes, None uses clock configured in settings
     """
     __metaclass__ = ABCMeta
+    __slots__ = ("_errors", "lock", "clock")
 
     def __init__(self):
-        self._errors = {}
+        self._errors = ErrorFlags()
+        self.lock = threading.RLock()
+        self.clock = None
+
+    def reinit_after_fork(self):
+        self.lock = threading.RLock()
 
     @abstractmethod
     def cleanup(self):
@@ -31,19 +43,24 @@ class DevicePart(object):
 
     def get_device_errors(self):
         """
-        Return a dict with errors if any key was found, otherwise return False
-        :return:
+        Return errors of device, flags are immutable, so no copy is needed
+        :return: ErrorFlags, zero if device has no errors
         """
-        if self._errors.keys():
-            return self._errors
-        return False
+        return self._errors
 
     def add_error(self, error):
         """
         Add error to device
         :string error:
         """
-        self._errors[error] = True
+        self._errors |= ERROR_CODES[error]
+
+    def wait_process(self):
+        """
+        Wait until process of device is finished
+        :return: True if whole PROCESS_TIME passed
+        """
+        return (self.clock or get_clock()).wait(self.PROCESS_TIME)
 
 
 class PressurePump(DevicePart):
@@ -53,8 +70,11 @@ class PressurePump(DevicePart):
     Attributes:
          MAX_PRESSURE (int): Maximum compression during production
          current_pressure (int): Current level of compression
+         PROCESS_TIME (int): Duration of compressing water
     """
+    __slots__ = ("current_pressure",)
     MAX_PRESSURE = 10  # bar
+    PROCESS_TIME = 10  # s
 
     def __init__(self):
         super(PressurePump, self).__init__()
@@ -72,13 +92,14 @@ class PressurePump(DevicePart):
         """
         self.current_pressure = 1
 
+    @timed(device_seconds, "pressure_pump")
     def run_process(self):
         """
         Simulation of compressing water
         :return: result of check_current_pressure method
         """
-        for bar in range(PressurePump.MAX_PRESSURE + 1):
-            self.current_pressure = bar
+        self.wait_process()
+        self.current_pressure = self.MAX_PRESSURE
         return self.check_current_pressure()
 
 
@@ -90,13 +111,16 @@ class WaterHeater(DevicePart):
         CAPACITY (int) - static variable, maximum amount of water to boil at once
         MIN_CAPACITY (int) - minimum of water to start process of boiling
         BOILING_POINT (int) - temperature of boiling water
+        PROCESS_TIME (int) - duration of boiling water
         ERROR_EMPTY_WATER_TANK (string) - error message
         ERROR_NOT_ENOUGH_WATER_TO_BOIL (string) - error message
         ERROR_BAD_TEMP (string) - error message
     """
+    __slots__ = ("water_tank", "water_temp", "current_capacity")
     CAPACITY = 350  # ml
     MIN_CAPACITY = 50  # ml
     BOILING_POINT = 100  # C
+    PROCESS_TIME = 8  # s
 
     ERROR_EMPTY_WATER_TANK = "Empty water tank"
     ERROR_NOT_ENOUGH_WATER_TO_BOIL = "Not enough water in heater to boil"
@@ -143,8 +167,9 @@ class WaterHeater(DevicePart):
         Provides refilling water of main coffee machine water tank, and reset errors message
         """
         self.water_tank.fill_tank(WaterTank.CAPACITY)
-        self._errors = {}
+        self._errors = ErrorFlags()
 
+    @timed(device_seconds, "water_heater")
     def run_process(self, water_to_boil=CAPACITY):
         """
         Run process of simulation boiling water in device tank, and send it to coffee brew device
@@ -164,14 +189,24 @@ class WaterHeater(DevicePart):
         if self.check_is_enough_water_capacity():
             water_for_tank = self.water_tank.get_amount_from_container(amount)
             if water_for_tank:  # check if empty tank is empty
-                for temp in range(self.water_temp, 101):
-                    self.water_temp = temp
+                self.wait_process()
+                self.water_temp = self.BOILING_POINT
                 return True
             else:
                 self.add_error(self.ERROR_EMPTY_WATER_TANK)
                 return False
         return False
 
+    def boil_batch(self, amount):
+        """
+        Boil water for many cups at once. Heater stays hot between batches of one order,
+        so water for pressure pump is not prepared here.
+        :param amount: (int) - amount of water, at most CAPACITY
+        :return: True or False
+        """
+        self.current_capacity = amount
+        return self.prepare_to_boiling(amount)
+
     def prepare_water_for_pressure_pump(self):
         """
         Process to prepare water for pressure pump
@@ -199,12 +234,17 @@ class MilkHeater(DevicePart):
 
     Attributes:
         CAPACITY (int) - static variable, maximum amount of milk to foam at once
+        PROCESS_TIME (int) - duration of lather milk
         ERROR_EMPTY_MILK_TANK (string) - error message
+        ERROR_PUMP (string) - error message
         water_heater  (WaterHeater) - device to help milk heater to foam milk.
         milk_tank (MilkTank) - milk tank contains milk
     """
+    __slots__ = ("water_heater", "milk_tank")
     CAPACITY = 150  # ml
+    PROCESS_TIME = 10  # s
     ERROR_EMPTY_MILK_TANK = "Empty milk tank"
+    ERROR_PUMP = "Pump"
 
     def __init__(self, water_heater):
         """
@@ -220,8 +260,7 @@ class MilkHeater(DevicePart):
         Fill water tank and remove proper error.
         """
         self.water_heater.water_tank.fill_tank(WaterTank.CAPACITY)
-        if self.water_heater.ERROR_EMPTY_WATER_TANK in self._errors.keys():
-            del self._errors[self.water_heater.ERROR_EMPTY_WATER_TANK]
+        self._errors = self._errors.without(self.water_heater.ERROR_EMPTY_WATER_TANK)
 
     def fill_milk(self):
         """
@@ -229,32 +268,38 @@ class MilkHeater(DevicePart):
         :return:
         """
         self.milk_tank.fill_tank(self.milk_tank.CAPACITY)
-        if self.ERROR_EMPTY_MILK_TANK in self._errors.keys():
-            del self._errors[self.ERROR_EMPTY_MILK_TANK]
+        self._errors = self._errors.without(self.ERROR_EMPTY_MILK_TANK)
 
+    @timed(device_seconds, "milk_heater")
     def run_process(self):
         """
         Run process of loaming milk. Get boiled water, prepare pressure pump,
-        get amount of milk. If successfully, then lather milk for 10 second.
+        get amount of milk. If successfully, then lather milk for PROCESS_TIME.
         :return: True if successfully, otherwise False
         """
         prepare_boiling = self.water_heater.prepare_to_boiling(MilkTank.WATER_FOR_LATHER)
         prepare_pressure_pump = self.water_heater.prepare_water_for_pressure_pump()
         if prepare_boiling and prepare_pressure_pump:
-            milk_for_lather = self.milk_tank.get_amount_from_container(self.CAPACITY)
-            if milk_for_lather:
-                for second in range(10):
-                    pass
-                return True
-            else:
-                self.add_error(self.ERROR_EMPTY_MILK_TANK)
-                return False
+            return self.froth_milk()
         if not prepare_boiling:
             self.add_error(self.water_heater.ERROR_NOT_ENOUGH_WATER_TO_BOIL)
         if not prepare_pressure_pump:
-            self.add_error("Pump")
+            self.add_error(self.ERROR_PUMP)
         return False
 
+    def froth_milk(self):
+        """
+        Get amount of milk and lather it for PROCESS_TIME. Water must be already boiled.
+        :return: True if successfully, otherwise False
+        """
+        milk_for_lather = self.milk_tank.get_amount_from_container(self.CAPACITY)
+        if milk_for_lather:
+            self.wait_process()
+            return True
+        else:
+            self.add_error(self.ERROR_EMPTY_MILK_TANK)
+            return False
+
     def cleanup(self):
         pass
 
@@ -265,10 +310,13 @@ class TrashBin(DevicePart):
 
     Attributes:
         CAPACITY (int) - static variable, maximum amount trash
+        PROCESS_TIME (int) - duration of checking trash bin
         ERROR_FULL_TRASH (string) - error message
         current_level (int) - current level of filling the bin
     """
+    __slots__ = ("current_level",)
     CAPACITY = 4  # TRAILS
+    PROCESS_TIME = 1  # s
     ERROR_FULL_TRASH = "Full trash bin"
 
     def __init__(self):
@@ -289,15 +337,33 @@ class TrashBin(DevicePart):
         """
         Throw away trash, and reset errors
         """
-        self._errors = {}
+        self._errors = ErrorFlags()
         self.current_level = 0
 
+    @timed(device_seconds, "trash_bin")
     def run_process(self):
         """
         Add new waste to bin
         """
         self.current_level += 1
 
+    def reserve(self):
+        """
+        Check capacity and take place for waste of brew at once, so concurrent brews can not overfill bin
+        :return: True if place was taken, otherwise False
+        """
+        if not self.is_trash_full():
+            return False
+        self.run_process()
+        return True
+
+    def release(self):
+        """
+        Give back place taken by brew, which failed before any waste was made
+        """
+        if self.current_level > 0:
+            self.current_level -= 1
+
 
 class CoffeeGrinder(DevicePart):
     """
@@ -305,11 +371,14 @@ class CoffeeGrinder(DevicePart):
 
     Attributes:
         CAPACITY (int) - static variable, maximum amount trash
+        PROCESS_TIME (int) - duration of grinding beans
         ERROR_NOT_ENOUGH_BEANS_TO_GRIND (string) - error message
         coffee_tank (CoffeeBeansTank) - container with available coffee beans
         current_capacity - current level of grinded coffee beans
     """
+    __slots__ = ("coffee_tank", "current_capacity")
     CAPACITY = 200  # ml
+    PROCESS_TIME = 5  # s
     ERROR_NOT_ENOUGH_BEANS_TO_GRIND = "Not enough beans to grind"
 
     def __init__(self, fill_coffee_beans=True):
@@ -329,7 +398,7 @@ class CoffeeGrinder(DevicePart):
         """
         self.current_capacity = 0
         self.coffee_tank.fill_tank(CoffeeBeansTank.CAPACITY)
-        self._errors = {}
+        self._errors = ErrorFlags()
 
     def check_is_enough_coffee_beans(self):
         return 0 < self.current_capacity <= self.CAPACITY
@@ -343,13 +412,14 @@ class CoffeeGrinder(DevicePart):
         if 0 < amount <= self.CAPACITY:
             coffee = self.coffee_tank.get_amount_from_container(amount)
             if coffee:
-                for sec in range(5):
-                    pass
+                self.wait_process()
                 return True
             else:
                 self.add_error(self.ERROR_NOT_ENOUGH_BEANS_TO_GRIND)
                 return False
         return False
 
+    @timed(device_seconds, "coffee_grinder")
     def run_process(self):
         pass
+
@@ -0,0 +1,97 @@
+"""
+Errors of devices and mechanism kept as bits of integer.
+
+Each message has static code, code of message is bit with position of message in ERROR_MESSAGES.
+New messages must be added at the end, so codes saved in state files and sent to clients stay valid.
+Merging errors of steps is bitwise or, checking is bitwise and. Errors are converted to dict of messages
+only for result of failed brew.
+"""
+
+ERROR_MESSAGES = (
+    "Empty milk tank",
+    "Empty water tank",
+    "Full trash bin",
+    "Not enough beans to grind",
+    "Not enough water in heater to boil",
+    "Pump",
+    "Too low water temperature",
+)
+
+ERROR_CODES = {message: 1 << position for position, message in enumerate(ERROR_MESSAGES)}
+
+ALL_ERRORS = (1 << len(ERROR_MESSAGES)) - 1
+
+
+class ErrorFlags(int):
+    """
+    Immutable set of errors stored in one integer. It can be read like dict of messages mapped to True,
+    so errors can be checked with flags[message] or message in flags and iterated by messages.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_messages(cls, messages):
+        """
+        :param messages: (iterable) - error messages, e.g. dict with errors
+        :return: ErrorFlags with given errors
+        :raise KeyError if message is not in ERROR_MESSAGES
+        """
+        bits = 0
+        for message in messages:
+            bits |= ERROR_CODES[message]
+        return cls(bits)
+
+    def __getitem__(self, message):
+        if not self & ERROR_CODES.get(message, 0):
+            raise KeyError(message)
+        return True
+
+    def __contains__(self, message):
+        return bool(self & ERROR_CODES.get(message, 0))
+
+    def __iter__(self):
+        return iter([message for message in ERROR_MESSAGES if self & ERROR_CODES[message]])
+
+    def __len__(self):
+        return bin(self).count("1")
+
+    def __or__(self, other):
+        return ErrorFlags(int(self) | int(other))
+
+    __ror__ = __or__
+
+    def __repr__(self):
+        return "ErrorFlags(%r)" % list(self)
+
+    def keys(self):
+        return list(self)
+
+    def get(self, message, default=None):
+        return True if message in self else default
+
+    def without(self, message):
+        """
+        :return: ErrorFlags without given error
+        """
+        return ErrorFlags(self & ~ERROR_CODES[message])
+
+    def to_dict(self):
+        """
+        :return: dict with messages mapped to True, format of errors returned by failed brew
+        """
+        return dict.fromkeys(self, True)
+
+
+def encode_errors(errors):
+    """
+    :param errors: (dict) - errors of failed brew or order
+    :return: (int) - code of errors, messages without code (e.g. failure of order) are skipped
+    """
+    return int(ErrorFlags.from_messages(message for message in errors if message in ERROR_CODES))
+
+
+def get_error_table():
+    """
+    :return: dict with message of each code, sent once to clients, which receive errors as single integer
+    """
+    return {str(code): message for message, code in ERROR_CODES.items()}
@@ -0,0 +1,268 @@
+"""
+Append-only binary log of operations of machines with checkpoints of their state.
+
+Every brew, batch, refill and trash removal is appended as record of fixed size. Each machine periodically saves
+checkpoint with snapshot of its state and position in log. After restart latest checkpoint of each machine
+is applied and only records written after it are replayed, so machines come back with real levels of tanks.
+Log contains whole recipe of each cup, so it can be read offline as history of orders.
+"""
+import json
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+from coffemachine.machine.clock import InstantClock, override_clock
+from coffemachine.machine.metrics import MetricsBuffer
+from coffemachine.machine.models import Coffee
+from coffemachine.machine.pipeline import BASIC_STEPS, EXTRA_WATER, LATHER, compile_recipe, get_steps
+from coffemachine.machine.state import get_snapshot, apply_snapshot
+
+COFFEE_TYPES = tuple(coffee_type for coffee_type, _ in Coffee.coffee_types)
+# coffee type of drinks added later than coffee_types, e.g. cappuccino
+OTHER_COFFEE_TYPE = "other"
+
+# bits of flags byte of record
+MILK_FLAG = 1
+STEPS_FLAG = 2
+EXTRA_WATER_FLAG = 4
+LATHER_FLAG = 8
+
+LoggedCoffee = namedtuple("LoggedCoffee", ["coffee_type", "coffee_quantity", "size", "extra_quantity",
+                                           "contains_milk", "steps"])
+LoggedCoffee.__doc__ = """
+Recipe of cup read from log. Provides attributes of Coffee used by mechanism, so brew can be replayed.
+Steps are empty for records written before steps were logged, default steps of coffee type are used then.
+"""
+
+Event = namedtuple("Event", ["offset", "time", "machine_id", "kind", "batch_size", "coffee", "served"])
+Event.__doc__ = """
+Record of log. Coffee is None for refills and trash removal, batch_size is number of cups in batch or zero.
+"""
+
+
+class EventLog(object):
+    """
+    Log of operations of fleet kept in file, checkpoints are kept in second file with .checkpoint suffix.
+
+    Attributes:
+        MAGIC (bytes) - header of log file
+        RECORD (Struct) - layout of record: time, machine id, kind, coffee type, flags of milk and steps,
+            size of batch, coffee quantity, size, extra quantity (-1 if None), result of brew
+        path (string) - path to log file
+        checkpoint_every (int) - number of records of machine between its checkpoints
+        fsync (bool) - flush each record to disk, slower but record survives crash of system
+    """
+    MAGIC = b"COFFLOG1"
+    RECORD = struct.Struct("<dIBBBHiiiB")
+
+    BREW = 1
+    BATCH_CUP = 2
+    REFILL_WATER = 3
+    REFILL_BEANS = 4
+    FILL_MILK = 5
+    REMOVE_TRASH = 6
+    KINDS = {
+        BREW: "brew",
+        BATCH_CUP: "batch_cup",
+        REFILL_WATER: "refill_water_tank",
+        REFILL_BEANS: "refill_beans_tank",
+        FILL_MILK: "fill_milk",
+        REMOVE_TRASH: "remove_trash_bin",
+    }
+
+    def __init__(self, path, checkpoint_every=1000, fsync=False):
+        self.path = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.checkpoint_every = checkpoint_every
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self._checkpoints = {}
+        self._written = {}
+
+    def _truncate(self, end):
+        """
+        Remove record written only partially and unfinished batch at the end of log, so next records are aligned
+        """
+        if os.path.exists(self.path) and os.path.getsize(self.path) > end:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            with open(self.path, "r+b") as log:
+                log.truncate(end)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            if not self._file.tell():
+                self._file.write(self.MAGIC)
+                self._file.flush()
+        return self._file
+
+    def reinit_after_fork(self):
+        """
+        Child process opens log again. File of parent is not closed, so its buffer is not written twice.
+        """
+        self._lock = threading.Lock()
+        self._file = None
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _pack(self, machine_id, kind, coffee=None, batch_size=0, served=False):
+        if coffee is None:
+            return self.RECORD.pack(time.time(), machine_id, kind, 0, 0, batch_size, 0, 0, -1, 0)
+        extra = coffee.extra_quantity if coffee.extra_quantity is not None else -1
+        coffee_type = COFFEE_TYPES.index(coffee.coffee_type) if coffee.coffee_type in COFFEE_TYPES else 255
+        recipe = compile_recipe(get_steps(coffee))
+        flags = MILK_FLAG * bool(coffee.contains_milk) | STEPS_FLAG | EXTRA_WATER_FLAG * recipe.EXTRA_WATER | \
+            LATHER_FLAG * recipe.LATHER_MILK
+        return self.RECORD.pack(time.time(), machine_id, kind, coffee_type, flags, batch_size, coffee.coffee_quantity,
+                                coffee.size, extra, served)
+
+    @staticmethod
+    def _unpack_steps(flags):
+        """
+        :return: (string) - steps of logged cup in order of mechanism, empty if record does not contain steps
+        """
+        if not flags & STEPS_FLAG:
+            return ""
+        steps = list(BASIC_STEPS)
+        if flags & EXTRA_WATER_FLAG:
+            steps.append(EXTRA_WATER)
+        if flags & LATHER_FLAG:
+            steps.append(LATHER)
+        return ",".join(steps)
+
+    def record(self, machine_id, mechanism, kind, coffees=(), results=()):
+        """
+        Append operation to log. Caller must hold lock of machine, so order of records of each machine
+        is the same as order of operations on its mechanism.
+        :param machine_id: (int) - id of machine in fleet
+        :param mechanism: (CoffeeBrewMechanism) - mechanism after operation, used for checkpoint
+        :param kind: (int) - kind of operation, e.g. EventLog.BREW
+        :param coffees: (list) - brewed coffees
+        :param results: (list) - status of each coffee returned by mechanism
+        """
+        if kind == self.BREW:
+            data = self._pack(machine_id, kind, coffees[0], served=not isinstance(results[0], dict))
+        elif kind == self.BATCH_CUP:
+            data = b"".join(self._pack(machine_id, kind, coffee, len(coffees), not isinstance(status, dict))
+                            for coffee, status in zip(coffees, results))
+        else:
+            data = self._pack(machine_id, kind)
+        with self._lock:
+            log = self._open()
+            log.write(data)
+            log.flush()
+            if self.fsync:
+                os.fsync(log.fileno())
+            self._written[machine_id] = self._written.get(machine_id, 0) + 1
+            if self._written[machine_id] >= self.checkpoint_every:
+                self._written[machine_id] = 0
+                self._checkpoints[machine_id] = {"offset": log.tell(), "snapshot": get_snapshot(mechanism)}
+                self._save_checkpoints()
+
+    def _save_checkpoints(self):
+        temporary = self.checkpoint_path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({str(machine_id): checkpoint for machine_id, checkpoint in self._checkpoints.items()}, f)
+        os.replace(temporary, self.checkpoint_path)
+
+    def _load_checkpoints(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return {int(machine_id): checkpoint for machine_id, checkpoint in json.load(f).items()}
+        except (IOError, ValueError):
+            return {}
+
+    def read(self, start=None):
+        """
+        Read records of log, last record written only partially is skipped
+        :param start: (int) - position of first record, by default beginning of log
+        :return: generator of Event objects
+        """
+        try:
+            log = open(self.path, "rb")
+        except IOError:
+            return
+        with log:
+            if log.read(len(self.MAGIC)) != self.MAGIC:
+                return
+            if start is not None:
+                log.seek(max(start, len(self.MAGIC)))
+            while True:
+                offset = log.tell()
+                data = log.read(self.RECORD.size)
+                if len(data) < self.RECORD.size:
+                    return
+                timestamp, machine_id, kind, coffee_type, flags, batch_size, quantity, size, extra, served = \
+                    self.RECORD.unpack(data)
+                coffee = None
+                if kind in (self.BREW, self.BATCH_CUP):
+                    coffee = LoggedCoffee(COFFEE_TYPES[coffee_type] if coffee_type < len(COFFEE_TYPES)
+                                          else OTHER_COFFEE_TYPE, quantity, size, extra if extra >= 0 else None,
+                                          bool(flags & MILK_FLAG), self._unpack_steps(flags))
+                yield Event(offset, timestamp, machine_id, self.KINDS[kind], batch_size, coffee, bool(served))
+
+    def recover(self, machines):
+        """
+        Rebuild state of machines from latest checkpoints and records written after them. Records are replayed
+        without waiting for devices and without metrics, which counted them when they were written.
+        :param machines: (dict) - mechanisms keyed by machine id
+        :return: number of replayed records
+        """
+        metrics = MetricsBuffer()
+        with self._lock, override_clock(InstantClock()), metrics:
+            try:
+                return self._recover(machines)
+            finally:
+                metrics.discard()
+
+    def _recover(self, machines):
+        checkpoints = self._load_checkpoints()
+        for machine_id, checkpoint in checkpoints.items():
+            if machine_id in machines:
+                apply_snapshot(machines[machine_id], checkpoint["snapshot"])
+        self._checkpoints = {machine_id: checkpoint for machine_id, checkpoint in checkpoints.items()
+                             if machine_id in machines}
+        start = None
+        if machines and all(machine_id in checkpoints for machine_id in machines):
+            start = min(checkpoints[machine_id]["offset"] for machine_id in machines)
+        replayed = 0
+        batch = []
+        end = len(self.MAGIC) if start is None else start
+        for event in self.read(start):
+            mechanism = machines.get(event.machine_id)
+            if mechanism is not None and event.offset >= checkpoints.get(event.machine_id, {}).get("offset", 0):
+                replayed += 1
+                if event.kind == "batch_cup":
+                    batch.append(event.coffee)
+                    if len(batch) < event.batch_size:
+                        continue
+                    mechanism.make_batch(batch)
+                    batch = []
+                elif event.kind == "brew":
+                    mechanism.make_coffee(event.coffee)
+                else:
+                    getattr(mechanism, event.kind)()
+            end = event.offset + self.RECORD.size
+        self._truncate(end)
+        return replayed
+
+
+def get_event_log():
+    """
+    :return: EventLog configured by COFFEE_MACHINE_EVENT_LOG setting, None if operations are not logged
+    """
+    path = getattr(settings, "COFFEE_MACHINE_EVENT_LOG", None)
+    if not path:
+        return None
+    return EventLog(path, checkpoint_every=getattr(settings, "COFFEE_MACHINE_CHECKPOINT_EVERY", 1000))
@@ -0,0 +1,429 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import DatabaseError
+
+from coffemachine.machine.availability import MachineAvailability
+from coffemachine.machine.eventlog import EventLog
+from coffemachine.machine.handler import CoffeeBrewMechanism
+from coffemachine.machine.maintenance import RefillPredictor
+from coffemachine.machine.state import StateConflict, SideEffects
+
+MAINTENANCE_OPERATIONS = OrderedDict([
+    ("refill_water_tank", EventLog.REFILL_WATER),
+    ("refill_beans_tank", EventLog.REFILL_BEANS),
+    ("fill_milk", EventLog.FILL_MILK),
+    ("remove_trash_bin", EventLog.REMOVE_TRASH),
+])
+SERVICE = "service"
+
+logger = logging.getLogger(__name__)
+
+
+def brew_operation(coffee):
+    """
+    :return: operation of FleetMachine brewing given coffee
+    """
+    return lambda mechanism, listener: mechanism.make_coffee(coffee, listener)
+
+
+def batch_operation(coffees):
+    """
+    :return: operation of FleetMachine brewing batch of given coffees
+    """
+    return lambda mechanism, listener: mechanism.make_batch(coffees)
+
+
+class FleetMachine(object):
+    """
+    One machine in fleet. Keeps independent mechanism and counters used by dispatcher.
+
+    Attributes:
+        machine_id (int) - position of machine in fleet
+        mechanism (CoffeeBrewMechanism) - independent mechanism of machine
+        availability (MachineAvailability) - read-only view on resources of mechanism
+        pending (int) - number of orders waiting or brewing on this machine
+        served (int) - number of successfully brewed coffees
+        failed (int) - number of brews finished with errors
+        busy_time (float) - seconds spent on brewing
+        store (StateStore) - persistent state shared with other processes, None if state is kept only in mechanism
+        journal (EventLog) - log of operations used to recover state after restart, None if operations are not logged
+    """
+
+    def __init__(self, machine_id, mechanism, store=None, journal=None):
+        self.machine_id = machine_id
+        self.mechanism = mechanism
+        self.store = store
+        self.journal = journal
+        self._journal_lock = threading.Lock()
+        self.availability = MachineAvailability(mechanism)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.served = 0
+        self.failed = 0
+        self.busy_time = 0.0
+
+    def reinit_after_fork(self):
+        self._journal_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.mechanism.reinit_after_fork()
+
+    def make_coffee(self, coffee, listener=None):
+        """
+        Brew coffee on machine mechanism and update counters.
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :param listener: function informed about each finished stage of brew, see BrewContext
+        :return: String with path to proper coffee image, otherwise dict with errors
+        """
+        start = time.time()
+        status = self.run(brew_operation(coffee), EventLog.BREW, [coffee], listener)
+        self._count([status], time.time() - start)
+        return status
+
+    def make_batch(self, coffees):
+        """
+        Brew batch of coffees on machine mechanism and update counters.
+        :param coffees: (list) - model objects containing coffees, which clients want to drink
+        :return: list with path to proper coffee image or dict with errors for each coffee
+        """
+        start = time.time()
+        results = self.run(batch_operation(coffees), EventLog.BATCH_CUP, coffees)
+        self._count(results, time.time() - start)
+        return results
+
+    def run(self, operation, kind=None, coffees=(), listener=None):
+        """
+        Run operation on mechanism, see reserve. With persistent store devices wait after state is saved.
+        :param operation: function called with mechanism and listener of brew stages
+        :param kind: (int) - kind of operation recorded in journal, e.g. EventLog.BREW
+        :param coffees: (list) - coffees brewed by operation
+        :param listener: function informed about each finished stage of brew, see BrewContext
+        :return: result of operation
+        """
+        result, effects = self.reserve(operation, kind, coffees, listener)
+        if effects is not None:
+            effects.replay(listener)
+        return result
+
+    def reserve(self, operation, kind=None, coffees=(), listener=None):
+        """
+        Apply operation to state of machine. With persistent store operation checks and reserves resources
+        on current state shared by all processes and its changes are saved at once, without waiting for devices.
+        With journal operation is appended to log, operations of machine are then serialized,
+        so log keeps their real order.
+        :return: tuple of result of operation and SideEffects, which caller must replay,
+            None if operation already waited for devices and informed listener
+        """
+        if self.journal is None or kind is None:
+            return self._run(operation, listener)
+        with self._journal_lock:
+            result, effects = self._run(operation, listener)
+            results = result if kind == EventLog.BATCH_CUP else [result]
+            self.journal.record(self.machine_id, self.mechanism, kind, coffees, results)
+        return result, effects
+
+    def maintain(self, operations):
+        """
+        Run maintenance operations at once. With persistent store state is saved once for all operations,
+        with journal each operation is recorded.
+        :param operations: (list) - names of mechanism methods from MAINTENANCE_OPERATIONS
+        """
+        def operation(mechanism, listener):
+            for name in operations:
+                getattr(mechanism, name)()
+
+        if self.journal is None:
+            return self.run(operation)
+        with self._journal_lock:
+            result, effects = self._run(operation)
+            for name in operations:
+                self.journal.record(self.machine_id, self.mechanism, MAINTENANCE_OPERATIONS[name])
+        if effects is not None:
+            effects.replay()
+
+    def _run(self, operation, listener=None):
+        """
+        :return: tuple of result of operation and SideEffects collected on working copy of state,
+            None if operation ran on mechanism
+        """
+        if self.store is None:
+            return operation(self.mechanism, listener), None
+        attempts = []
+
+        def reserve(mechanism):
+            attempts.append(SideEffects())
+            return attempts[-1].run(operation, mechanism)
+
+        result = self.store.run(self.machine_id, self.mechanism, reserve)
+        return result, attempts[-1]
+
+    def refresh(self):
+        """
+        Load current state from persistent store, so read-only checks see changes of other processes
+        """
+        if self.store is not None:
+            self.store.load(self.machine_id, self.mechanism)
+
+    def _count(self, results, busy_time):
+        with self.lock:
+            self.busy_time += busy_time
+            for status in results:
+                if isinstance(status, dict):
+                    self.failed += 1
+                else:
+                    self.served += 1
+
+    def get_stats(self, elapsed):
+        """
+        :param elapsed: (float) - seconds since fleet start
+        :return: dict with counters and throughput in coffees per second
+        """
+        return {
+            "machine": self.machine_id,
+            "pending": self.pending,
+            "served": self.served,
+            "failed": self.failed,
+            "busy_time": self.busy_time,
+            "throughput": self.served / elapsed if elapsed else 0.0,
+        }
+
+
+class CoffeeMachineFleet(object):
+    """
+    Pool of independent coffee machines. Each order is sent to machine with the shortest queue,
+    which is able to brew given coffee. Machines with blocking errors (empty tank, full trash bin)
+    are skipped until the problem is solved.
+
+    Attributes:
+        machines (list) - list of FleetMachine objects
+        started (float) - timestamp of fleet creation, used to count throughput
+        predictor (RefillPredictor) - rates of orders of each machine used to plan refills
+    """
+
+    def __init__(self, size=1, store=None, journal=None, predictor=None):
+        """
+        :param size: (int) - number of machines in fleet
+        :param store: (StateStore) - persistent state of machines, by default state is kept only in memory
+        :param journal: (EventLog) - log of operations, state of machines is recovered from it on start
+        :param predictor: (RefillPredictor) - predictor of refills, by default with half-life of one hour
+        """
+        if size < 1:
+            raise ValueError("Fleet needs at least one machine")
+        self.machines = [FleetMachine(machine_id, CoffeeBrewMechanism.create_standalone(), store, journal)
+                         for machine_id in range(size)]
+        if journal is not None:
+            journal.recover({machine.machine_id: machine.mechanism for machine in self.machines})
+        self.started = time.time()
+        self.predictor = predictor or RefillPredictor()
+        self._dispatch_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.machines)
+
+    def reinit_after_fork(self):
+        """
+        Replace locks inherited from parent process, including locks of shared store.
+        Journal is disabled, workers would append to the same log and overwrite checkpoints of each other,
+        so log can recover only process, which is not forked.
+        """
+        self._dispatch_lock = threading.Lock()
+        for machine in self.machines:
+            machine.reinit_after_fork()
+        machine = self.machines[0]
+        if machine.store is not None:
+            machine.store.reinit_after_fork()
+        if machine.journal is not None:
+            logger.warning("Event log %s is disabled in forked process, use shared state store instead",
+                           machine.journal.path)
+            for machine in self.machines:
+                machine.journal = None
+        self.predictor.reinit_after_fork()
+
+    def refresh(self):
+        for machine in self.machines:
+            machine.refresh()
+
+    def select_machine(self, coffee, refresh=True):
+        """
+        Find least loaded machine, which can brew given coffee. If every machine is blocked,
+        return least loaded one, so client receives errors of that machine.
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :param refresh: (bool) - load current state from persistent store first
+        :return: FleetMachine
+        """
+        if refresh:
+            self.refresh()
+        available = [machine for machine in self.machines if machine.availability.count(coffee)]
+        return min(available or self.machines, key=lambda machine: machine.pending)
+
+    def select_machine_for_batch(self, coffees, refresh=True):
+        """
+        Find least loaded machine, which can brew every given coffee.
+        :param coffees: (list) - model objects containing coffees, which clients want to drink
+        :param refresh: (bool) - load current state from persistent store first
+        :return: FleetMachine
+        """
+        if refresh:
+            self.refresh()
+        available = [machine for machine in self.machines
+                     if all(machine.availability.count(coffee) for coffee in coffees)]
+        return min(available or self.machines, key=lambda machine: machine.pending)
+
+    def dispatch(self, coffees, batch=False):
+        """
+        Select machine for order and count order as pending on it. State is loaded from persistent store
+        before dispatch lock is taken, so reading store does not block other orders.
+        :param coffees: (list) - model objects containing coffees of order
+        :param batch: (bool) - coffees are brewed together, see make_batch
+        :return: FleetMachine
+        """
+        self.refresh()
+        with self._dispatch_lock:
+            if batch:
+                machine = self.select_machine_for_batch(coffees, refresh=False)
+            else:
+                machine = self.select_machine(coffees[0], refresh=False)
+            machine.pending += len(coffees)
+        self.predictor.observe(machine.machine_id, coffees)
+        return machine
+
+    def release(self, machine, count):
+        with self._dispatch_lock:
+            machine.pending -= count
+
+    def count_available(self, coffee):
+        """
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :return: number of cups, which can be brewed right now by whole fleet
+        """
+        self.refresh()
+        return sum(machine.availability.count(coffee) for machine in self.machines)
+
+    def get_availability(self, recipes):
+        """
+        :param recipes: (iterable) - coffee recipes
+        :return: dict with number of available cups keyed by coffee type
+        """
+        self.refresh()
+        return {coffee.coffee_type: sum(machine.availability.count(coffee) for machine in self.machines)
+                for coffee in recipes}
+
+    def get_unavailable_errors(self, coffee):
+        """
+        Check without running any device if coffee can be brewed by any machine.
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :return: empty dict if coffee can be brewed, otherwise errors of machine selected for order
+        """
+        return self.select_machine(coffee).availability.get_errors(coffee)
+
+    def make_coffee(self, coffee, listener=None):
+        """
+        Dispatch order to selected machine and brew coffee.
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :param listener: function informed about each finished stage of brew, see BrewContext
+        :return: String with path to proper coffee image, otherwise dict with errors
+        """
+        machine = self.dispatch([coffee])
+        try:
+            return machine.make_coffee(coffee, listener)
+        finally:
+            self.release(machine, 1)
+
+    def make_batch(self, coffees):
+        """
+        Dispatch whole batch to one selected machine, so batch shares heater and grinder cycles.
+        :param coffees: (list) - model objects containing coffees, which clients want to drink
+        :return: list with path to proper coffee image or dict with errors for each coffee
+        """
+        machine = self.dispatch(coffees, batch=True)
+        try:
+            return machine.make_batch(coffees)
+        finally:
+            self.release(machine, len(coffees))
+
+    def maintain(self, operations, machine_ids=None):
+        """
+        Run maintenance operations on many machines in one call. Operations of each machine are applied
+        together under its locks, failure of one machine does not stop the others.
+        :param operations: (list) - names from MAINTENANCE_OPERATIONS, SERVICE means all of them
+        :param machine_ids: (list) - ids of machines, by default whole fleet
+        :return: list of dicts with result of each operation on each machine
+        :raise ValueError if operation or machine is unknown
+        """
+        names = []
+        for name in operations:
+            for expanded in (MAINTENANCE_OPERATIONS if name == SERVICE else [name]):
+                if expanded not in MAINTENANCE_OPERATIONS:
+                    raise ValueError("Unknown maintenance operation %s" % expanded)
+                if expanded not in names:
+                    names.append(expanded)
+        if machine_ids is None:
+            machines = self.machines
+        else:
+            if any(not 0 <= machine_id < len(self.machines) for machine_id in machine_ids):
+                raise ValueError("Fleet has %s machines" % len(self.machines))
+            machines = [self.machines[machine_id] for machine_id in sorted(set(machine_ids))]
+        results = []
+        for machine in machines:
+            try:
+                machine.maintain(names)
+                error = None
+            except (StateConflict, DatabaseError, IOError) as e:
+                error = str(e) or e.__class__.__name__
+            results.extend({
+                "machine": machine.machine_id,
+                "operation": name,
+                "status": "failed" if error else "done",
+                "error": error,
+            } for name in names)
+        return results
+
+    def refill_water_tank(self):
+        """
+        :return: list of results of each machine, see maintain
+        """
+        return self.maintain(["refill_water_tank"])
+
+    def refill_beans_tank(self):
+        """
+        :return: list of results of each machine, see maintain
+        """
+        return self.maintain(["refill_beans_tank"])
+
+    def fill_milk(self):
+        """
+        :return: list of results of each machine, see maintain
+        """
+        return self.maintain(["fill_milk"])
+
+    def remove_trash_bin(self):
+        """
+        :return: list of results of each machine, see maintain
+        """
+        return self.maintain(["remove_trash_bin"])
+
+    def get_maintenance_schedule(self, horizon=None):
+        """
+        Predict from recent orders when tanks of each machine run empty and trash bins get full.
+        :param horizon: (float) - return only actions needed within given number of seconds
+        :return: list of predictions, the most urgent first
+        """
+        self.refresh()
+        return self.predictor.schedule(self.machines, horizon)
+
+    def get_stats(self):
+        """
+        Collect counters of each machine and fleet-wide throughput.
+        :return: dict with list of machines stats and summary of fleet
+        """
+        elapsed = time.time() - self.started
+        machines = [machine.get_stats(elapsed) for machine in self.machines]
+        served = sum(stats["served"] for stats in machines)
+        return {
+            "machines": machines,
+            "served": served,
+            "failed": sum(stats["failed"] for stats in machines),
+            "throughput": served / elapsed if elapsed else 0.0,
+        }
@@ -1,7 +1,45 @@
 from django import forms
 
+from coffemachine.machine.fleet import MAINTENANCE_OPERATIONS, SERVICE
 from coffemachine.machine.models import Coffee
+from coffemachine.machine.recipes import recipe_cache
+
+
+def get_coffee_choices():
+    """
+    :return: list of pairs: coffee type of each recipe and its label, drinks of coffee_types go first
+    """
+    labels = dict(Coffee.coffee_types)
+    recipes = recipe_cache.get_all()
+    coffee_types = [coffee_type for coffee_type, _ in Coffee.coffee_types if coffee_type in recipes]
+    coffee_types.extend(sorted(coffee_type for coffee_type in recipes if coffee_type not in labels))
+    return [(coffee_type, labels.get(coffee_type, coffee_type.replace("_", " ").title()))
+            for coffee_type in coffee_types]
 
 
 class CoffeeChoiceForm(forms.Form):
-    coffee_type = forms.ChoiceField(choices=Coffee.coffee_types)
+    coffee_type = forms.ChoiceField(choices=get_coffee_choices)
+
+
+class CoffeeBatchForm(forms.Form):
+    coffee_type = forms.MultipleChoiceField(choices=get_coffee_choices)
+
+    def __init__(self, *args, **kwargs):
+        self.max_size = kwargs.pop("max_size", None)
+        super(CoffeeBatchForm, self).__init__(*args, **kwargs)
+
+    def clean_coffee_type(self):
+        coffee_types = self.cleaned_data["coffee_type"]
+        if self.max_size and len(coffee_types) > self.max_size:
+            raise forms.ValidationError("Batch can contain at most %(size)d coffees", params={"size": self.max_size})
+        return coffee_types
+
+
+class MaintenanceForm(forms.Form):
+    operation = forms.MultipleChoiceField(choices=[(name, name) for name in list(MAINTENANCE_OPERATIONS) + [SERVICE]])
+    machine = forms.TypedMultipleChoiceField(coerce=int, required=False)
+
+    def __init__(self, *args, **kwargs):
+        machines = kwargs.pop("machines", 1)
+        super(MaintenanceForm, self).__init__(*args, **kwargs)
+        self.fields["machine"].choices = [(str(machine_id), machine_id) for machine_id in range(machines)]
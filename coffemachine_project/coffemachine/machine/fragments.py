@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.template.loader import get_template
+
+
+class ProblemFragmentCache(object):
+    """
+    Bounded LRU cache of rendered problem fragments keyed by set of errors. During outage every client
+    gets one of few error combinations, so html is rendered once for each of them.
+    Cache is cleared when template loader returns new compiled template, e.g. after cached loader reset.
+
+    Attributes:
+        template_name (string) - path to html template
+        maxsize (int) - maximum number of cached fragments
+        hits (int) - number of fragments returned from cache
+        misses (int) - number of rendered fragments
+    """
+
+    def __init__(self, template_name="core/problem.html", maxsize=32):
+        self.template_name = template_name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._template = None
+        self._lock = threading.Lock()
+
+    def render(self, errors):
+        """
+        :param errors: (dict) - errors returned by mechanism
+        :return: html with each error
+        """
+        template = get_template(self.template_name)
+        key = frozenset(errors)
+        with self._lock:
+            if getattr(template, "template", template) is not self._template:
+                self._fragments.clear()
+                self._template = getattr(template, "template", template)
+            html = self._fragments.get(key)
+            if html is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = template.render({"problems": sorted(key)})
+        with self._lock:
+            self._fragments[key] = html
+            while len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+        return html
+
+    def reinit_after_fork(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self._template = None
+
+    def get_stats(self):
+        return {
+            "size": len(self._fragments),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+problem_fragments = ProblemFragmentCache(maxsize=getattr(settings, "COFFEE_MACHINE_PROBLEM_CACHE_SIZE", 32))
+
+
+def render_problems(errors):
+    """
+    Render html with errors using shared cache of fragments
+    :param errors: (dict) - errors returned by mechanism
+    :return: html with each error
+    """
+    return problem_fragments.render(errors)
+
+
+def clear_problem_fragments(setting, **kwargs):
+    if setting == "TEMPLATES":
+        problem_fragments.clear()
+
+
+setting_changed.connect(clear_problem_fragments, dispatch_uid="machine_problem_fragments")
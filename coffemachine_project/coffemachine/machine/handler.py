@@ -1,73 +1,58 @@
+import threading
+import time
+
+from coffemachine.machine.container import MilkTank
 from coffemachine.machine.devices import WaterHeater, MilkHeater, CoffeeGrinder, PressurePump, TrashBin
+from coffemachine.machine.errors import ErrorFlags
+from coffemachine.machine.metrics import timed, step_seconds, brew_seconds, refills_total, count_brew
+from coffemachine.machine.pipeline import compile_recipe, get_steps
 
 try:
     import thread
 except ModuleNotFoundError:
     import _thread as thread
-from abc import ABCMeta
 
 
-class CoffeeBrewRecipe(object):
-    """
-    Abstract recipe for brew coffee
+class BrewContext(object):
     """
-    __metaclass__ = ABCMeta
-
-    IMAGE = ""
-
-    def brew(self, mechanism):
-        raise NotImplementedError
-
-
-class EspressoRecipe(CoffeeBrewRecipe):
-    IMAGE = "/static/images/espresso.png"
-
-    def brew(self, mechanism):
-        """
-        Brew espresso coffee if something fails return dict with error messages
-        :param mechanism: CoffeeBrewMachine object provides all required mechanism to complete task
-        :return: String with path to espresso image, otherwise dict with error messages
-        """
-        status_coffee = mechanism.make_basic_coffee()
-        if isinstance(status_coffee, dict):
-            return status_coffee
-        return self.IMAGE
-
-
-class AmericanoRecipe(CoffeeBrewRecipe):
-    IMAGE = "/static/images/espresso.png"
-
-    def brew(self, mechanism):
-        """
-        Brew americano coffee. On start makes normal espresso then add extra amount of boiled water
-        :param mechanism: CoffeeBrewMachine object provides all required mechanism to complete task
-        :return: : String with path to americano image, otherwise dict with error messages
-        """
-        status_coffee = mechanism.make_basic_coffee()
-        if isinstance(status_coffee, dict):
-            return status_coffee
-        status_extra_water = mechanism.boiling_water(mechanism.coffee.extra_quantity)
-        if isinstance(status_extra_water, dict):
-            return status_extra_water
-        return self.IMAGE
-
+    State of single brew. Each order gets own context, so concurrent brews on shared mechanism
+    do not overwrite each other.
 
-class LatteRecipe(CoffeeBrewRecipe):
-    IMAGE = "/static/images/latte.png"
+    Attributes:
+        coffee (Coffee) - model object containing coffee, which client wants to drink
+        recipe (RecipePipeline) - compiled recipe used to brew coffee
+        errors (ErrorFlags) - errors collected during brew, initialized with errors of mechanism
+        trash_reserved (bool) - place in trash bin was taken for waste of this brew
+        listener - function called with name of stage and dict with its result after each finished stage,
+            e.g. to stream progress of brew to client
+    """
+    TRASH = "trash"
+    GRINDING = "grinding"
+    BOILING = "boiling"
+    PRESSURE = "pressure"
+    EXTRA_WATER = "extra_water"
+    MILK = "milk"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, coffee, recipe, errors=None, listener=None):
+        self.coffee = coffee
+        self.recipe = recipe
+        self.errors = ErrorFlags(errors or 0)
+        self.trash_reserved = False
+        self.listener = listener
 
-    def brew(self, mechanism):
+    def notify(self, stage, errors=0):
         """
-        Brew latte coffee. On start makes normal espresso then add foamed milk.
-        :param mechanism: CoffeeBrewMachine object provides all required mechanism to complete task
-        :return: : String with path to latte image, otherwise dict with error messages
+        Inform listener that stage of brew is finished
+        :param stage: (string) - name of stage, e.g. BrewContext.GRINDING
+        :param errors: (ErrorFlags) - errors of stage, zero if stage succeeded
         """
-        status_coffee = mechanism.make_basic_coffee()
-        if isinstance(status_coffee, dict):
-            return status_coffee
-        status_milk = mechanism.lather_milk()
-        if isinstance(status_milk, dict):
-            return status_milk
-        return self.IMAGE
+        if self.listener is not None:
+            if errors:
+                self.listener(stage, {"errors": list(ErrorFlags(errors)), "error_code": int(errors)})
+            else:
+                self.listener(stage, {})
 
 
 class CoffeeBrewMechanism(object):
@@ -75,11 +60,15 @@ class CoffeeBrewMechanism(object):
     Class which combines all mechanism to simulate working coffee mechanism. Provides all required methods.
     This class implements singleton pattern, because only one device stay in virtual kitchen.
     Additionally django view life cycle forces to create object which keeps own state regardless of django view.
+    Mechanism is thread safe: state of each brew lives in BrewContext and every operation on device
+    holds lock of that device, so steps of different brews working on different devices can overlap.
     Attributes:
         __lockObj - secure new creation of a new instance, caused thread racing
         __instance - instance of CoffeeBrewMechanism
     """
 
+    __slots__ = ("water_heater", "milk_heater", "coffee_grinder", "pressure_pump", "trash_bin", "errors",
+                 "_errors_lock")
     __lockObj = thread.allocate_lock()
     __instance = None
 
@@ -98,11 +87,30 @@ class CoffeeBrewMechanism(object):
         # critical section stop
         return cls.__instance
 
+    @classmethod
+    def create_standalone(cls):
+        """
+        Create independent instance of mechanism, which bypass singleton pattern.
+        It is used by fleet of machines, where each machine keeps own devices.
+        :return: new instance of CoffeeBrewMechanism
+        """
+        instance = super(CoffeeBrewMechanism, cls).__new__(cls)
+        instance.__init__()
+        return instance
+
+    @classmethod
+    def reinit_singleton_after_fork(cls):
+        """
+        Replace lock of singleton and locks of its devices in child process after fork.
+        """
+        cls.__lockObj = thread.allocate_lock()
+        if cls.__instance is not None:
+            cls.__instance.reinit_after_fork()
+
     def __init__(self):
         """
         Initialize all required devices, which will be used to simulate coffee machine.
-        :param methods_brew (dict) - is used for call proper method of brewing coffee.
-        :param coffee_method (CoffeeRecipe) - stores class containing recipe of brewing coffee
+        :param errors (ErrorFlags) - errors, which block mechanism until proper device is refilled
         """
         self.water_heater = WaterHeater()
         self.milk_heater = MilkHeater(self.water_heater)
@@ -110,181 +118,410 @@ class CoffeeBrewMechanism(object):
         self.pressure_pump = PressurePump()
         self.trash_bin = TrashBin()
 
-        self.errors = {}
+        self.errors = ErrorFlags()
+        self._errors_lock = threading.Lock()
 
-        self.coffee_method = None
-        self.methods_brew = {
-            "espresso": EspressoRecipe,
-            "americano": AmericanoRecipe,
-            "latte": LatteRecipe,
-        }
+    def reinit_after_fork(self):
+        """
+        Replace locks inherited from parent process. Child has only the thread which called fork,
+        so lock held by any other thread of parent would never be released.
+        """
+        for device in (self.water_heater, self.milk_heater, self.coffee_grinder, self.pressure_pump, self.trash_bin):
+            device.reinit_after_fork()
+        for tank in (self.water_heater.water_tank, self.milk_heater.milk_tank, self.coffee_grinder.coffee_tank):
+            tank.reinit_after_fork()
+        self._errors_lock = threading.Lock()
 
-    def set_method_for_coffee(self, coffee):
+    def get_method_for_coffee(self, coffee):
         """
-        Set new method of brew coffee
+        Find compiled recipe of coffee. Pipelines are cached, so nothing is created for each order.
         :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :return: RecipePipeline object
         """
-        self.coffee_method = self.methods_brew.get(coffee.coffee_type)()
+        return compile_recipe(get_steps(coffee))
 
     def prepare_ground_coffee(self, coffee):
         """
         Run process of grinding beans for coffee. One of the API methods.
         :param coffee: (Coffee) - model object containing coffee, which client wants to drink
-        :return: True if successfully completed process, otherwise dict with errors
+        :return: ErrorFlags of device, zero if successfully completed process
         """
-        self.coffee_grinder.grind_beans(coffee.coffee_quantity)
-        return self.coffee_grinder.get_device_errors()
+        with self.coffee_grinder.lock:
+            self.coffee_grinder.grind_beans(coffee.coffee_quantity)
+            return self.coffee_grinder.get_device_errors()
 
     def boiling_water(self, quantity):
         """
         Run process of boiling water for coffee. One of the API methods.
         :param quantity: (int) - how many water require to brew coffee
-        :return: True if successfully completed process, otherwise dict with errors
+        :return: ErrorFlags of device, zero if successfully completed process
         """
-        self.water_heater.run_process(water_to_boil=quantity)
-        return self.water_heater.get_device_errors()
+        with self.water_heater.lock:
+            self.water_heater.run_process(water_to_boil=quantity)
+            return self.water_heater.get_device_errors()
 
     def prepare_pressure_pump(self):
         """
         Run process of preparing pressure pump.
-        :return: True if successfully completed process, otherwise dict with errors
+        :return: ErrorFlags of device, zero if successfully completed process
         """
-        self.pressure_pump.run_process()
-        return self.pressure_pump.get_device_errors()
+        with self.pressure_pump.lock:
+            self.pressure_pump.run_process()
+            return self.pressure_pump.get_device_errors()
 
     def lather_milk(self):
         """
         Run process of lather milk.
-        :return: True if successfully completed process, otherwise dict with errors
+        :return: ErrorFlags of device, zero if successfully completed process
         """
-        self.milk_heater.run_process()
-        return self.milk_heater.get_device_errors()
+        with self.milk_heater.lock, self.water_heater.lock:
+            self.milk_heater.run_process()
+            return self.milk_heater.get_device_errors()
 
     def is_full_trash_bin(self):
         """
         Run process which checking current capacity of trash bin.
-        :return: True if successfully completed process, otherwise dict with errors
+        :return: ErrorFlags of device, zero if successfully completed process
+        """
+        with self.trash_bin.lock:
+            self.trash_bin.is_trash_full()
+            return self.trash_bin.get_device_errors()
+
+    def reserve_trash_bin(self, context):
+        """
+        Check capacity of trash bin and take place for waste of brew under one lock.
+        :param context: BrewContext object with state of brew, it remembers taken place
+        :return: ErrorFlags of device, zero if place was taken
         """
-        self.trash_bin.is_trash_full()
-        return self.trash_bin.get_device_errors()
+        with self.trash_bin.lock:
+            context.trash_reserved = self.trash_bin.reserve()
+            return self.trash_bin.get_device_errors()
 
-    def _update_status(self, status):
+    def release_trash_bin(self, contexts):
         """
-        Update errors if given arguments is dict.
-        :param status: String or dict
+        Give back places in trash bin taken by failed brews
+        :param contexts: (list) - BrewContext objects of failed brews
         """
-        if isinstance(status, dict):
-            self.errors.update(status)
+        with self.trash_bin.lock:
+            for context in contexts:
+                if context.trash_reserved:
+                    self.trash_bin.release()
+                    context.trash_reserved = False
+
+    def _update_status(self, context, status):
+        """
+        Add errors of device to errors of brew.
+        :param context: BrewContext object with state of brew
+        :param status: (ErrorFlags) - errors of device
+        """
+        if status:
+            context.errors |= status
+
+    def _store_errors(self, errors):
+        """
+        Save errors of failed brew in mechanism, so they block next brews until refill.
+        :param errors: (ErrorFlags) - errors of brew
+        """
+        with self._errors_lock:
+            self.errors |= errors
+
+    def _remove_error(self, error):
+        with self._errors_lock:
+            self.errors = self.errors.without(error)
+
+    def get_errors(self):
+        """
+        :return: (ErrorFlags) - errors blocking mechanism, zero if there are none
+        """
+        return self.errors
 
     def is_errors(self):
-        return self.errors.keys()
+        return self.errors
+
+    def can_make_coffee(self, coffee):
+        """
+        Check if mechanism has no blocking errors for given coffee. Errors stay in devices until refill,
+        so every brew started on blocked mechanism will fail.
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :return: True if mechanism is able to brew coffee, otherwise False
+        """
+        if self.get_errors() or self.trash_bin.current_level >= TrashBin.CAPACITY:
+            return False
+        devices = [self.water_heater, self.coffee_grinder, self.trash_bin]
+        if coffee.contains_milk:
+            devices.append(self.milk_heater)
+        return not any(device.get_device_errors() for device in devices)
 
-    def step_preparing_trash(self):
+    @timed(step_seconds, "step_preparing_trash")
+    def step_preparing_trash(self, context):
         """
-        First step of making basic coffee, checking current status of trash bin
+        First step of making basic coffee, taking place for waste in trash bin
+        :param context: BrewContext object with state of brew
         :raise OperationException if any errors
         """
-        status = self.is_full_trash_bin()
-        self._update_status(status)
-        if self.is_errors():
+        status = self.reserve_trash_bin(context)
+        self._update_status(context, status)
+        context.notify(context.TRASH, context.errors)
+        if context.errors:
             raise OperationException("step_preparing_trash")
 
-    def step_preparing_ground_coffee(self):
+    @timed(step_seconds, "step_preparing_ground_coffee")
+    def step_preparing_ground_coffee(self, context):
         """
         Second step of making basic coffee, prepare ground coffee
+        :param context: BrewContext object with state of brew
         :raise OperationException if any errors
         """
-        status = self.prepare_ground_coffee(self.coffee)
-        self._update_status(status)
-        if self.is_errors():
+        status = self.prepare_ground_coffee(context.coffee)
+        self._update_status(context, status)
+        context.notify(context.GRINDING, context.errors)
+        if context.errors:
             raise OperationException("step_preparing_ground_coffee")
 
-    def step_preparing_boiling_water(self):
+    @timed(step_seconds, "step_preparing_boiling_water")
+    def step_preparing_boiling_water(self, context):
         """
         Third step of making basic coffee, prepare to boil water
+        :param context: BrewContext object with state of brew
         :raise OperationException if any errors
         """
-        status = self.boiling_water(self.coffee.size)
-        self._update_status(status)
-        if self.is_errors():
+        status = self.boiling_water(context.coffee.size)
+        self._update_status(context, status)
+        context.notify(context.BOILING, context.errors)
+        if context.errors:
             raise OperationException("step_prepairing_boiling_water")
 
-    def step_preparing_pressure_pump(self):
+    @timed(step_seconds, "step_preparing_pressure_pump")
+    def step_preparing_pressure_pump(self, context):
         """
         Fourth step of making basic coffee, prepare to use pressure pump
+        :param context: BrewContext object with state of brew
         :raise OperationException if any errors
         """
         status = self.prepare_pressure_pump()
-        self._update_status(status)
-        if self.errors.keys():
+        self._update_status(context, status)
+        context.notify(context.PRESSURE, context.errors)
+        if context.errors:
             raise OperationException("step_preparing_pressure_pump")
 
-    def make_basic_coffee(self):
+    def step_adding_extra_water(self, context):
         """
-        Method to make basic coffee, it means one cup of espresso.
-        Execute all steps define above. If there is no errors,
-        Run last process of brewing coffee
-        :return: True if successfully completed brew process, otherwise dict with errors
+        Extra step of recipe, boiled water is added to brewed espresso
+        :param context: BrewContext object with state of brew
+        :return: ErrorFlags of water heater, zero if water was added
         """
+        status = self.boiling_water(context.coffee.extra_quantity)
+        context.notify(context.EXTRA_WATER, status)
+        return status
+
+    def step_lathering_milk(self, context):
+        """
+        Extra step of recipe, foamed milk is added to brewed espresso
+        :param context: BrewContext object with state of brew
+        :return: ErrorFlags of milk heater, zero if milk was added
+        """
+        status = self.lather_milk()
+        context.notify(context.MILK, status)
+        return status
+
+    def brew(self, context):
+        """
+        Run steps of compiled recipe. Errors of steps making espresso are saved in mechanism,
+        errors of extra steps are only returned.
+        :param context: BrewContext object with state of brew
+        :return: String with path to coffee image, otherwise ErrorFlags with errors
+        """
+        recipe = context.recipe
+        start = time.perf_counter()
         try:
-            self.step_preparing_trash()
-            self.step_preparing_ground_coffee()
-            self.step_preparing_boiling_water()
-            self.step_preparing_pressure_pump()
-        except OperationException as e:
-            return self.errors
-        return self.run_brew_process()
+            for method in recipe.basic_methods:
+                getattr(self, method)(context)
+            self.run_brew_process()
+            for method in recipe.extra_methods:
+                status = getattr(self, method)(context)
+                if status:
+                    return status
+            return recipe.IMAGE
+        except OperationException:
+            self.release_trash_bin([context])
+            self._store_errors(context.errors)
+            return context.errors
+        finally:
+            brew_seconds.observe(context.coffee.coffee_type, time.perf_counter() - start)
 
+    @timed(step_seconds, "run_brew_process")
     def run_brew_process(self):
         """
         Simulation of brew coffee. For prepared ground coffee, hot water is passed though.
-        Then coffee flows to cup, wastes going to trash. Process complete
+        Then coffee flows to cup, wastes go to place in trash bin taken by first step. Process complete
         :return: True
         """
-        self.pressure_pump.cleanup()
-        self.water_heater.cleanup()
-        self.trash_bin.run_process()
+        with self.pressure_pump.lock:
+            self.pressure_pump.cleanup()
+        with self.water_heater.lock:
+            self.water_heater.cleanup()
         return True
 
-    def make_coffee(self, coffee):
+    def make_coffee(self, coffee, listener=None):
         """
         Method set coffee recipe for given coffee object.
         Run proper brew process and return his status.
         :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :param listener: function informed about each finished stage of brew, see BrewContext
         :return: String with path to proper coffee image, otherwise dict with errors
         """
-        self.coffee = coffee
-        self.set_method_for_coffee(self.coffee)
-        status = self.coffee_method.brew(self)
-        if isinstance(status, dict):
-            return status
+        context = BrewContext(coffee, self.get_method_for_coffee(coffee), self.get_errors(), listener)
+        status = self.brew(context)
+        if isinstance(status, ErrorFlags):
+            context.notify(context.FAILED, status)
+            status = status.to_dict()
+        else:
+            context.notify(context.DONE)
+        count_brew(coffee, status)
         return status
 
+    def make_batch(self, coffees):
+        """
+        Brew many coffees together. Instead of full cycle for each cup, beans are ground in portions
+        up to grinder capacity, water is boiled in portions up to heater capacity and pressure pump
+        is prepared once for whole batch. Coffees are served in given order, so if some device fails,
+        only rest of batch fails.
+        :param coffees: (list) - model objects containing coffees, which clients want to drink
+        :return: list with path to proper coffee image or dict with errors for each coffee
+        """
+        errors = self.get_errors()
+        cups = [BrewContext(coffee, self.get_method_for_coffee(coffee), errors) for coffee in coffees]
+        for stage in (self._batch_trash, self._batch_ground_coffee, self._batch_boiling_water):
+            brewing = [cup for cup in cups if not cup.errors]
+            if brewing:
+                stage(brewing)
+        self.release_trash_bin([cup for cup in cups if cup.errors])
+        brewing = [cup for cup in cups if not cup.errors]
+        self._batch_lather_milk([cup for cup in brewing if cup.recipe.LATHER_MILK])
+        statuses = [cup.errors.to_dict() if cup.errors else cup.recipe.IMAGE for cup in cups]
+        for coffee, status in zip(coffees, statuses):
+            count_brew(coffee, status)
+        return statuses
+
+    @staticmethod
+    def _split_portions(items, capacity):
+        """
+        Pack amounts into portions, which do not exceed capacity. Order of items is kept.
+        :param items: (list) - pairs of BrewContext and amount required by this cup
+        :param capacity: (int) - maximum amount of one portion
+        :return: list of pairs: list of BrewContext objects in portion and amount of portion
+        """
+        portions = []
+        for cup, amount in items:
+            if portions and portions[-1][1] + amount <= capacity:
+                portions[-1][0].append(cup)
+                portions[-1][1] += amount
+            else:
+                portions.append([[cup], amount])
+        return portions
+
+    def _fail_batch(self, cups, first_cup, errors, store=True):
+        """
+        Add errors to given cup and every next cup in batch
+        :param cups: (list) - BrewContext objects in batch
+        :param first_cup: (BrewContext) - first cup which failed
+        :param errors: (ErrorFlags) - errors of device
+        :param store: (bool) - save errors in mechanism, so they block next brews
+        """
+        for cup in cups[cups.index(first_cup):]:
+            cup.errors |= errors
+        if store:
+            self._store_errors(errors)
+
+    def _batch_trash(self, cups):
+        with self.trash_bin.lock:
+            free = TrashBin.CAPACITY - self.trash_bin.current_level
+            for cup in cups[:max(free, 0)]:
+                self.trash_bin.current_level += 1
+                cup.trash_reserved = True
+            if len(cups) > free:
+                self._fail_batch(cups, cups[max(free, 0)], ErrorFlags.from_messages([TrashBin.ERROR_FULL_TRASH]),
+                                 store=free <= 0)
+
+    def _batch_ground_coffee(self, cups):
+        items = [(cup, cup.coffee.coffee_quantity) for cup in cups]
+        with self.coffee_grinder.lock:
+            for portion, amount in self._split_portions(items, CoffeeGrinder.CAPACITY):
+                self.coffee_grinder.grind_beans(amount)
+                errors = self.coffee_grinder.get_device_errors()
+                if errors:
+                    self._fail_batch(cups, portion[0], errors)
+                    return
+
+    def _batch_boiling_water(self, cups):
+        items = []
+        for cup in cups:
+            items.append((cup, cup.coffee.size))
+            if cup.recipe.EXTRA_WATER:
+                items.append((cup, cup.coffee.extra_quantity))
+            if cup.recipe.LATHER_MILK:
+                items.append((cup, MilkTank.WATER_FOR_LATHER))
+        with self.water_heater.lock, self.pressure_pump.lock:
+            for portion, amount in self._split_portions(items, WaterHeater.CAPACITY):
+                self.water_heater.boil_batch(amount)
+                errors = self.water_heater.get_device_errors()
+                if errors:
+                    self._fail_batch(cups, portion[0], errors)
+                    break
+            else:
+                self.water_heater.prepare_water_for_pressure_pump()
+                errors = self.water_heater.get_device_errors()
+                if errors:
+                    self._fail_batch(cups, cups[0], errors)
+                self.pressure_pump.run_process()
+            self.pressure_pump.cleanup()
+            self.water_heater.cleanup()
+
+    def _batch_lather_milk(self, cups):
+        with self.milk_heater.lock:
+            for cup in cups:
+                self.milk_heater.froth_milk()
+                errors = self.milk_heater.get_device_errors()
+                if errors:
+                    self._fail_batch(cups, cup, errors, store=False)
+                    return
+
     def refill_water_tank(self):
         """
         Run process of refilling water tank and erase error
         """
-        self.water_heater.refill_water_tank()
-        if self.errors.get(WaterHeater.ERROR_EMPTY_WATER_TANK):
-            del self.errors[WaterHeater.ERROR_EMPTY_WATER_TANK]
+        refills_total.inc("water")
+        with self.water_heater.lock:
+            self.water_heater.refill_water_tank()
+        self._remove_error(WaterHeater.ERROR_EMPTY_WATER_TANK)
 
     def refill_beans_tank(self):
         """
         Run process of refilling coffee beans tank and erase error
         :return:
         """
-        self.coffee_grinder.cleanup()
-        if self.errors.get(CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND):
-            del self.errors[CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND]
+        refills_total.inc("beans")
+        with self.coffee_grinder.lock:
+            self.coffee_grinder.cleanup()
+        self._remove_error(CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND)
+
+    def fill_milk(self):
+        """
+        Run process of filling milk tank, milk heater erases own error
+        """
+        refills_total.inc("milk")
+        with self.milk_heater.lock:
+            self.milk_heater.fill_milk()
 
     def remove_trash_bin(self):
         """
         Run process of removing trash and erase error
         :return:
         """
-        self.trash_bin.cleanup()
-        if self.errors.get(TrashBin.ERROR_FULL_TRASH):
-            del self.errors[TrashBin.ERROR_FULL_TRASH]
+        refills_total.inc("trash")
+        with self.trash_bin.lock:
+            self.trash_bin.cleanup()
+        self._remove_error(TrashBin.ERROR_FULL_TRASH)
 
 
 class OperationException(Exception):
@@ -0,0 +1,290 @@
+"""
+Idempotency keys of orders.
+
+Client sends header Idempotency-Key with each order and repeats the same key when it retries, e.g. after timeout.
+Response of the first request is remembered by key, so retry gets the same ticket or results of batch and devices
+are not touched again. Keys are kept in bounded LRU cache and expire after ttl seconds. Retry of request,
+which is still being handled, gets 409 and should be repeated later. The same key sent with different order gets 422.
+Keys are remembered by process, like tickets of orders, so retries must reach the same worker process.
+Key is scoped by client: user, session or CSRF cookie is hashed together with key, so two clients sending
+the same key never get response of each other. Keys must be random and at least as long as hex of UUID.
+"""
+import asyncio
+import functools
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+
+from coffemachine.machine.metrics import registry, Counter
+
+HEADER = "HTTP_IDEMPOTENCY_KEY"
+REPLAYED_HEADER = "Idempotent-Replayed"
+KEY_PATTERN = re.compile(r"^[A-Za-z0-9_-]{32,64}$")
+
+# form fields, which are different in retries of the same order
+IGNORED_FIELDS = ("csrfmiddlewaretoken",)
+
+idempotent_requests_total = registry.register(Counter(
+    "coffee_machine_idempotent_requests_total", "Number of requests with idempotency key by result", "result"))
+
+
+class IdempotencyConflict(Exception):
+    """
+    Raised when request with the same key is still being handled
+
+    Attributes:
+        status (int) - HTTP status of response
+    """
+    status = 409
+
+
+class IdempotencyKeyReused(IdempotencyConflict):
+    """
+    Raised when key was already used by different request
+    """
+    status = 422
+
+
+class StoredResponse(object):
+    """
+    Response remembered by key, None until the first request is handled.
+
+    Attributes:
+        fingerprint (string) - hash of path and form of request
+        expires (float) - time of timer after which key is forgotten
+        content (bytes) - body of response
+        content_type (string) - Content-Type header of response
+        status (int) - HTTP status of response
+    """
+    __slots__ = ("fingerprint", "expires", "content", "content_type", "status")
+
+    def __init__(self, fingerprint, expires):
+        self.fingerprint = fingerprint
+        self.expires = expires
+        self.content = None
+        self.content_type = None
+        self.status = None
+
+    def is_ready(self):
+        return self.content is not None
+
+
+class IdempotencyCache(object):
+    """
+    Bounded LRU cache of responses keyed by idempotency key, entries expire ttl seconds after the first request.
+
+    Attributes:
+        maxsize (int) - maximum number of remembered keys
+        ttl (float) - seconds after which key is forgotten
+        timer - function returning current time in seconds
+        hits (int) - number of replayed responses
+        misses (int) - number of handled requests
+    """
+
+    def __init__(self, maxsize=1000, ttl=600, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def begin(self, key, fingerprint):
+        """
+        :param key: (string) - idempotency key of request
+        :param fingerprint: (string) - hash of path and form of request
+        :return: StoredResponse of the first request with this key, None if caller must handle request
+            and pass its response to complete
+        :raise IdempotencyConflict if request with this key is still being handled,
+            IdempotencyKeyReused if key was used by different request
+        """
+        now = self.timer()
+        with self._lock:
+            self._expire(now)
+            stored = self._responses.get(key)
+            if stored is not None and stored.expires <= now:
+                del self._responses[key]
+                stored = None
+            if stored is None:
+                self.misses += 1
+                self._responses[key] = StoredResponse(fingerprint, now + self.ttl)
+                while len(self._responses) > self.maxsize:
+                    self._responses.popitem(last=False)
+                return None
+            if stored.fingerprint != fingerprint:
+                raise IdempotencyKeyReused("Idempotency key was used by different order")
+            if not stored.is_ready():
+                raise IdempotencyConflict("Order with this idempotency key is being handled, try again later")
+            self._responses.move_to_end(key)
+            self.hits += 1
+            return stored
+
+    def complete(self, key, response):
+        """
+        Remember response of request started with begin
+        :param response: (HttpResponse) - response of view
+        """
+        with self._lock:
+            stored = self._responses.get(key)
+            if stored is not None:
+                stored.content = response.content
+                stored.content_type = response["Content-Type"]
+                stored.status = response.status_code
+
+    def abandon(self, key):
+        """
+        Forget key of request, which was not handled, so retry handles it again
+        """
+        with self._lock:
+            stored = self._responses.get(key)
+            if stored is not None and not stored.is_ready():
+                del self._responses[key]
+
+    def _expire(self, now):
+        while self._responses:
+            key, stored = next(iter(self._responses.items()))
+            if stored.expires > now:
+                return
+            del self._responses[key]
+
+    def reinit_after_fork(self):
+        """
+        Requests handled by parent are not finished in child, so child starts with empty cache
+        """
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+
+    def get_stats(self):
+        return {
+            "size": len(self._responses),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+idempotency_keys = IdempotencyCache(
+    maxsize=getattr(settings, "COFFEE_MACHINE_IDEMPOTENCY_KEYS", 1000),
+    ttl=getattr(settings, "COFFEE_MACHINE_IDEMPOTENCY_TTL", 600),
+)
+
+
+def get_idempotency_key(request):
+    """
+    :param request: Django request
+    :return: (string) - idempotency key of request, None if client did not send it
+    :raise ValueError if key is not valid
+    """
+    key = request.META.get(HEADER)
+    if key is None:
+        return None
+    if not KEY_PATTERN.match(key):
+        raise ValueError("Idempotency key must have 32 to 64 letters, digits, dashes or underscores")
+    return key
+
+
+def get_client(request):
+    """
+    :param request: Django request
+    :return: (string) - identity of client, which owns its idempotency keys: user, session or CSRF cookie
+    """
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return "user:%s" % user.pk
+    session = getattr(request, "session", None)
+    if session is not None and session.session_key:
+        return "session:%s" % session.session_key
+    return "csrf:%s" % request.COOKIES.get(settings.CSRF_COOKIE_NAME, "")
+
+
+def get_scoped_key(request, key):
+    """
+    :param key: (string) - idempotency key sent by client
+    :return: (string) - hash of client and key, key of response in IdempotencyCache
+    """
+    return hashlib.sha256(("%s\n%s" % (get_client(request), key)).encode("utf-8")).hexdigest()
+
+
+def get_fingerprint(request):
+    """
+    :param request: Django request
+    :return: (string) - hash of path and form of request, the same for each retry of order
+    """
+    form = sorted((name, request.POST.getlist(name)) for name in request.POST if name not in IGNORED_FIELDS)
+    return hashlib.sha1(repr((request.path, form)).encode("utf-8")).hexdigest()
+
+
+def _begin(request):
+    """
+    :return: tuple: key of request and response to return without calling view, None if view must be called
+    """
+    try:
+        key = get_idempotency_key(request)
+    except ValueError as e:
+        return None, JsonResponse({"error": str(e)}, status=400)
+    if key is None or request.method != "POST":
+        return None, None
+    key = get_scoped_key(request, key)
+    try:
+        stored = idempotency_keys.begin(key, get_fingerprint(request))
+    except IdempotencyConflict as e:
+        idempotent_requests_total.inc("conflict")
+        return None, JsonResponse({"error": str(e)}, status=e.status)
+    if stored is None:
+        idempotent_requests_total.inc("new")
+        return key, None
+    idempotent_requests_total.inc("replayed")
+    response = HttpResponse(stored.content, content_type=stored.content_type, status=stored.status)
+    response[REPLAYED_HEADER] = "true"
+    return None, response
+
+
+def _finish(key, response):
+    """
+    Remember json response of view, other responses, e.g. full queue or html page, are not remembered
+    """
+    if isinstance(response, JsonResponse) and response.status_code < 500:
+        idempotency_keys.complete(key, response)
+    else:
+        idempotency_keys.abandon(key)
+
+
+def idempotent(view):
+    """
+    Decorator of view function or coroutine function, which remembers its response by idempotency key of request.
+    Requests without key are passed to view. Use method_decorator for methods of class based views.
+    """
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def coroutine_wrapper(request, *args, **kwargs):
+            key, response = _begin(request)
+            if key is None:
+                return response if response is not None else await view(request, *args, **kwargs)
+            try:
+                response = await view(request, *args, **kwargs)
+            finally:
+                _finish(key, response)
+            return response
+        return coroutine_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key, response = _begin(request)
+        if key is None:
+            return response if response is not None else view(request, *args, **kwargs)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _finish(key, response)
+        return response
+    return wrapper
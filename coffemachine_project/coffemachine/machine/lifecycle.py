@@ -0,0 +1,102 @@
+"""
+Life cycle of machine in preforking servers, e.g. gunicorn with --preload or uwsgi without lazy-apps.
+
+Master process warms machine up once: recipes are loaded, templates compiled and problem fragments rendered,
+so first request of each worker costs as much as any other. Workers are forked from master and they inherit
+its locks, if lock was held by other thread of master during fork it is never released in worker.
+reinit_after_fork replaces all locks, forgets queued orders and database connections of master.
+It is registered with os.register_at_fork, servers on Python older than 3.7 call it from post fork hook.
+"""
+import logging
+import os
+import sys
+import time
+
+from django.db import connections, DatabaseError
+from django.template.loader import get_template
+
+from coffemachine.machine import assets, clock, pipeline
+from coffemachine.machine.errors import ERROR_MESSAGES
+from coffemachine.machine.fragments import problem_fragments
+from coffemachine.machine.handler import CoffeeBrewMechanism
+from coffemachine.machine.idempotency import idempotency_keys
+from coffemachine.machine.metrics import registry, Gauge
+from coffemachine.machine.recipes import recipe_cache
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES = (
+    "base.html",
+    "core/make_coffee_template.html",
+    "core/problem.html",
+)
+
+warm_up_seconds = None
+_fork_hook_registered = False
+
+
+def warm_up():
+    """
+    Load everything, which would be loaded by first request. Database connections are closed at the end,
+    so forked workers do not share them.
+    :return: (float) - seconds of warm up
+    """
+    global warm_up_seconds
+    start = time.perf_counter()
+    try:
+        recipes = recipe_cache.get_all()
+        for template_name in TEMPLATES:
+            get_template(template_name)
+        for message in ERROR_MESSAGES:
+            problem_fragments.render({message: True})
+        from coffemachine.machine.views import fleet
+        fleet.get_availability(recipes.values())
+    except DatabaseError as e:
+        logger.warning("Machine was not warmed up, database is not ready: %s", e)
+        return None
+    finally:
+        connections.close_all()
+    warm_up_seconds = time.perf_counter() - start
+    logger.info("Machine warmed up in %.3f s", warm_up_seconds)
+    return warm_up_seconds
+
+
+def reinit_after_fork():
+    """
+    Replace state inherited from parent process. It must be called in child process right after fork.
+    """
+    for connection in connections.all():
+        # closing would end session of parent, which uses the same socket
+        connection.connection = None
+    CoffeeBrewMechanism.reinit_singleton_after_fork()
+    clock.reinit_after_fork()
+    assets.reinit_after_fork()
+    pipeline.reinit_after_fork()
+    recipe_cache.reinit_after_fork()
+    problem_fragments.reinit_after_fork()
+    idempotency_keys.reinit_after_fork()
+    registry.reinit_after_fork()
+    views = sys.modules.get("coffemachine.machine.views")
+    if views is not None:
+        views.fleet.reinit_after_fork()
+        views.orders.reinit_after_fork()
+
+
+def register_fork_hook():
+    """
+    :return: True if reinit_after_fork is called automatically in every forked child
+    """
+    global _fork_hook_registered
+    if not hasattr(os, "register_at_fork"):
+        return False
+    if not _fork_hook_registered:
+        os.register_at_fork(after_in_child=reinit_after_fork)
+        _fork_hook_registered = True
+    return True
+
+
+def get_warm_up_seconds():
+    return [({}, warm_up_seconds)] if warm_up_seconds is not None else []
+
+
+registry.register(Gauge("coffee_machine_warm_up_seconds", "Duration of warm up of machine", get_warm_up_seconds))
@@ -0,0 +1,157 @@
+"""
+Prediction of refills from observed orders.
+
+Rate of orders of each coffee type is exponentially weighted, so recent traffic matters most. Rate of consumption
+of each tank is sum of order rates multiplied by resources used by one cup of each recipe, so change of recipe mix
+during the day changes predicted time-to-empty immediately.
+
+Rates are counted from orders handled by this process only, levels are read from state of machine, which may be
+shared. With many worker processes sharing state each of them sees only part of orders, so schedule of one worker
+predicts later refills than needed.
+"""
+import math
+import threading
+import time
+
+from coffemachine.machine.availability import get_cup_consumption, count_cups
+
+RESOURCES = (
+    ("water", "refill_water_tank"),
+    ("beans", "refill_beans_tank"),
+    ("milk", "fill_milk"),
+    ("trash", "remove_trash_bin"),
+)
+
+
+class OrderRate(object):
+    """
+    Exponentially weighted rate of orders of one machine, separately for each coffee type.
+
+    Attributes:
+        tau (float) - time constant of decay in seconds
+        started (float) - time of first order
+        updated (float) - time of last order
+        counts (dict) - decayed number of orders keyed by coffee type
+    """
+
+    def __init__(self, tau, now):
+        self.tau = tau
+        self.started = now
+        self.updated = now
+        self.counts = {}
+
+    def add(self, coffee_type, now, count=1):
+        self._decay(now)
+        self.counts[coffee_type] = self.counts.get(coffee_type, 0.0) + count
+
+    def _decay(self, now):
+        if now > self.updated:
+            factor = math.exp(-(now - self.updated) / self.tau)
+            for coffee_type in self.counts:
+                self.counts[coffee_type] *= factor
+            self.updated = now
+
+    def get_rates(self, now, warmup):
+        """
+        :param now: (float) - current time
+        :param warmup: (float) - minimum observed period, so first orders do not give huge rates
+        :return: dict with orders per second keyed by coffee type
+        """
+        factor = math.exp(-max(now - self.updated, 0) / self.tau)
+        window = self.tau * (1 - math.exp(-max(now - self.started, warmup) / self.tau))
+        return {coffee_type: count * factor / window for coffee_type, count in self.counts.items()}
+
+
+class RefillPredictor(object):
+    """
+    Tracks orders of each machine and predicts when tanks run empty and trash bin gets full.
+
+    Attributes:
+        half_life (float) - seconds after which weight of order drops to half
+        warmup (float) - minimum period used to count rates
+        clock - function returning current time in seconds
+    """
+
+    def __init__(self, half_life=3600.0, warmup=60.0, clock=time.time):
+        self.half_life = half_life
+        self.warmup = warmup
+        self.clock = clock
+        self._rates = {}
+        self._recipes = {}
+        self._lock = threading.Lock()
+
+    def reinit_after_fork(self):
+        self._lock = threading.Lock()
+
+    def observe(self, machine_id, coffees):
+        """
+        Record orders sent to machine
+        :param machine_id: (int) - id of machine
+        :param coffees: (list) - ordered coffees
+        """
+        now = self.clock()
+        with self._lock:
+            rate = self._rates.get(machine_id)
+            if rate is None:
+                rate = self._rates[machine_id] = OrderRate(self.half_life / math.log(2), now)
+            for coffee in coffees:
+                rate.add(coffee.coffee_type, now)
+                self._recipes[coffee.coffee_type] = coffee
+
+    def get_consumption_rates(self, machine_id, mechanism):
+        """
+        :param machine_id: (int) - id of machine
+        :param mechanism: (CoffeeBrewMechanism) - mechanism of machine, used to choose recipes
+        :return: tuple of orders per second and dict with consumption per second of each resource
+        """
+        consumption = {name: 0.0 for name, _ in RESOURCES}
+        with self._lock:
+            rate = self._rates.get(machine_id)
+            if rate is None:
+                return 0.0, consumption
+            rates = rate.get_rates(self.clock(), self.warmup)
+            recipes = dict(self._recipes)
+        for coffee_type, orders in rates.items():
+            cup = get_cup_consumption(recipes[coffee_type], mechanism.get_method_for_coffee(recipes[coffee_type]))
+            for name in consumption:
+                consumption[name] += orders * getattr(cup, name)
+        return sum(rates.values()), consumption
+
+    def predict(self, machine):
+        """
+        :param machine: (FleetMachine) - machine of fleet
+        :return: list of dicts with prediction for each resource of machine
+        """
+        orders, consumption = self.get_consumption_rates(machine.machine_id, machine.mechanism)
+        levels = machine.availability.get_levels()
+        predictions = []
+        for name, action in RESOURCES:
+            if name == "trash":
+                cups = max(levels[name], 0)
+            else:
+                cups = count_cups(levels[name], consumption[name] / orders) if consumption[name] else None
+            seconds = cups / orders if cups is not None and orders else None
+            predictions.append({
+                "machine": machine.machine_id,
+                "resource": name,
+                "action": action,
+                "level": levels[name],
+                "rate_per_hour": consumption[name] * 3600,
+                "seconds_left": seconds,
+            })
+        return predictions
+
+    def schedule(self, machines, horizon=None):
+        """
+        Prioritized list of maintenance actions. Actions which must be done first are on the top,
+        resources which are not consumed are at the end.
+        :param machines: (list) - FleetMachine objects
+        :param horizon: (float) - return only actions needed within given number of seconds
+        :return: list of dicts with predictions
+        """
+        predictions = [prediction for machine in machines for prediction in self.predict(machine)]
+        if horizon is not None:
+            predictions = [prediction for prediction in predictions
+                           if prediction["seconds_left"] is not None and prediction["seconds_left"] <= horizon]
+        return sorted(predictions, key=lambda prediction: (prediction["seconds_left"] is None,
+                                                           prediction["seconds_left"] or 0.0))
@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coffemachine.machine.benchmark import run_benchmarks, compare
+from coffemachine.machine.recipes import recipe_cache
+
+
+class Command(BaseCommand):
+    help = "Measure latency of mechanism, requests per second of views and memory of mechanism"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rounds", type=int, default=200, help="number of measured rounds of each benchmark")
+        parser.add_argument("--output", help="save results as json in given file")
+        parser.add_argument("--compare", metavar="BASELINE", help="compare results with json saved by --output")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="allowed relative change before result is flagged as regression")
+        parser.add_argument("--skip-views", action="store_true", help="do not measure views")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            try:
+                with open(options["compare"]) as f:
+                    baseline = json.load(f)
+            except (IOError, ValueError) as e:
+                raise CommandError("Can not read baseline %s: %s" % (options["compare"], e))
+        recipes = sorted(recipe_cache.get_all().values(), key=lambda coffee: coffee.coffee_type)
+        results = run_benchmarks(recipes, rounds=options["rounds"], views=not options["skip_views"])
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if baseline is None:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+            return
+        rows = compare(baseline, results, options["threshold"])
+        for row in rows:
+            self.stdout.write("%-50s %14.6g %14.6g %+8.1f%%%s" % (
+                row["name"], row["baseline"], row["current"], row["change"] * 100,
+                "  REGRESSION" if row["regression"] else ""))
+        regressions = [row["name"] for row in rows if row["regression"]]
+        if regressions:
+            raise CommandError("Regressions: %s" % ", ".join(regressions))
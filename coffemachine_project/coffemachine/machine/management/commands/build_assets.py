@@ -0,0 +1,25 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coffemachine.machine.assets import build_assets, get_assets_root, brotli
+
+
+class Command(BaseCommand):
+    help = "Build hashed bundles of static files with gzip and brotli variants, served at /assets/"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="output directory, by default COFFEE_MACHINE_ASSETS_ROOT")
+
+    def handle(self, *args, **options):
+        root = options["output"] or get_assets_root()
+        try:
+            manifest = build_assets(root)
+        except ValueError as e:
+            raise CommandError(str(e))
+        for name, hashed_name in manifest.items():
+            path = os.path.join(root, hashed_name)
+            sizes = [os.path.getsize(path + suffix) for suffix in ("", ".gz", ".br") if os.path.exists(path + suffix)]
+            self.stdout.write("%-20s %-35s %s" % (name, hashed_name, " / ".join("%d B" % size for size in sizes)))
+        if brotli is None:
+            self.stderr.write("brotli is not installed, only gzip variants were built")
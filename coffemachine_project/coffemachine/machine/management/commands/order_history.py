@@ -0,0 +1,37 @@
+import csv
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from coffemachine.machine.eventlog import EventLog
+
+
+class Command(BaseCommand):
+    help = "Print operations recorded in event log of machines as csv"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default=None, help="event log, by default COFFEE_MACHINE_EVENT_LOG")
+        parser.add_argument("--machine", type=int, default=None, help="show only operations of given machine")
+        parser.add_argument("--orders", action="store_true", help="show only brews, without refills")
+
+    def handle(self, *args, **options):
+        path = options["path"] or getattr(settings, "COFFEE_MACHINE_EVENT_LOG", None)
+        if not path:
+            raise CommandError("Give path of event log or set COFFEE_MACHINE_EVENT_LOG")
+        writer = csv.writer(self.stdout)
+        writer.writerow(["time", "machine", "event", "coffee_type", "size", "batch_size", "served"])
+        for event in EventLog(path).read():
+            if options["machine"] is not None and event.machine_id != options["machine"]:
+                continue
+            if options["orders"] and event.coffee is None:
+                continue
+            writer.writerow([
+                datetime.datetime.utcfromtimestamp(event.time).isoformat(),
+                event.machine_id,
+                event.kind,
+                event.coffee.coffee_type if event.coffee else "",
+                event.coffee.size if event.coffee else "",
+                event.batch_size or "",
+                int(event.served) if event.coffee else "",
+            ])
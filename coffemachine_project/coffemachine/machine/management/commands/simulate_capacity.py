@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coffemachine.machine.recipes import recipe_cache
+from coffemachine.machine.simulation.montecarlo import MonteCarloSimulator, numpy
+
+
+class Command(BaseCommand):
+    help = "Simulate many machines serving random orders and print failure rate, time to first refill and throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=100000, help="number of simulated machines")
+        parser.add_argument("--orders", type=int, default=100, help="number of orders served by each machine")
+        parser.add_argument("--mix", action="append", default=[], metavar="COFFEE=WEIGHT",
+                            help="popularity of coffee, e.g. --mix espresso=3 --mix latte=1")
+        parser.add_argument("--service-time", type=float, default=120.0, help="seconds needed to refill machine")
+        parser.add_argument("--seed", type=int, default=None)
+
+    def handle(self, *args, **options):
+        if numpy is None:
+            raise CommandError("Simulation requires numpy, install requirements/simulation.txt")
+        mix = {}
+        for item in options["mix"]:
+            coffee_type, _, weight = item.partition("=")
+            try:
+                mix[coffee_type] = float(weight)
+            except ValueError:
+                raise CommandError("Wrong mix %s, expected COFFEE=WEIGHT" % item)
+        simulator = MonteCarloSimulator(recipe_cache.get_all().values(), mix=mix or None,
+                                        service_time=options["service_time"])
+        result = simulator.run(options["runs"], options["orders"], seed=options["seed"])
+        self.stdout.write(json.dumps(result.get_summary(), indent=2, sort_keys=True))
@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coffemachine.machine.recipes import recipe_cache
+from coffemachine.machine.simulation.discrete import DiscreteEventSimulator, DEVICES, poisson_trace
+
+
+class Command(BaseCommand):
+    help = "Replay random arrivals of orders on virtual clock and print latency, queueing delay and utilization"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--machines", type=int, default=1, help="number of machines")
+        parser.add_argument("--rate", type=float, default=120.0, help="mean number of orders per hour")
+        parser.add_argument("--duration", type=float, default=8 * 3600.0, help="length of trace in seconds")
+        parser.add_argument("--mix", action="append", default=[], metavar="COFFEE=WEIGHT",
+                            help="popularity of coffee, e.g. --mix espresso=3 --mix latte=1")
+        parser.add_argument("--units", action="append", default=[], metavar="DEVICE=COUNT",
+                            help="number of units of device in each machine, e.g. --units coffee_grinder=2")
+        parser.add_argument("--seed", type=int, default=None)
+
+    def _parse(self, items, convert, allowed=None):
+        parsed = {}
+        for item in items:
+            name, _, value = item.partition("=")
+            if allowed is not None and name not in allowed:
+                raise CommandError("Unknown name %s, expected one of: %s" % (name, ", ".join(sorted(allowed))))
+            try:
+                parsed[name] = convert(value)
+            except ValueError:
+                raise CommandError("Wrong value %s, expected NAME=NUMBER" % item)
+        return parsed
+
+    def handle(self, *args, **options):
+        recipes = recipe_cache.get_all()
+        mix = self._parse(options["mix"], float, recipes) or {coffee_type: 1 for coffee_type in recipes}
+        layout = self._parse(options["units"], int, DEVICES)
+        try:
+            simulator = DiscreteEventSimulator(recipes.values(), machines=options["machines"], layout=layout)
+        except ValueError as e:
+            raise CommandError(str(e))
+        trace = poisson_trace(options["rate"], options["duration"], mix, seed=options["seed"])
+        result = simulator.run(trace)
+        self.stdout.write(json.dumps(result.get_summary(), indent=2, sort_keys=True))
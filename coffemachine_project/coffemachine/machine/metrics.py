@@ -0,0 +1,335 @@
+"""
+Counters and latency histograms of mechanism exposed in Prometheus text format.
+
+Every thread writes to own shard of metric, so observing value does not take any lock.
+Shards are summed only when metrics are rendered. Shards of finished threads are merged into one
+retired shard, so short living request threads do not leave shards behind.
+"""
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+_buffers = threading.local()
+
+
+class MetricsBuffer(object):
+    """
+    Keeps values observed by current thread inside with block instead of adding them to metrics.
+    Buffered values are added by flush, e.g. after state changed by operation was saved, or dropped by discard.
+
+    Attributes:
+        records (list) - tuples of metric, name of method and its arguments
+    """
+
+    def __init__(self):
+        self.records = []
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_buffers, "buffer", None)
+        _buffers.buffer = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _buffers.buffer = self._previous
+
+    def flush(self):
+        records, self.records = self.records, []
+        for metric, method, args in records:
+            getattr(metric, method)(*args)
+
+    def discard(self):
+        self.records = []
+
+
+def _buffer(metric, method, *args):
+    """
+    :return: True if value was buffered by MetricsBuffer of current thread
+    """
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None:
+        return False
+    buffer.records.append((metric, method, args))
+    return True
+
+
+class _ShardedMetric(object):
+    """
+    Base of metrics kept in thread local shards. Shard is dict with values keyed by label value.
+
+    Attributes:
+        name (string) - name of metric
+        help (string) - description of metric
+        label (string) - name of label, which divides metric, e.g. step
+    """
+    TYPE = ""
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def reinit_after_fork(self):
+        self._lock = threading.Lock()
+
+    def _get_shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def _merge(self, target, value):
+        raise NotImplementedError
+
+    def collect(self):
+        """
+        :return: dict with values of all threads keyed by label value
+        """
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge_shard(self._retired, shard)
+            self._shards = alive
+            total = {}
+            self._merge_shard(total, self._retired)
+            for _, shard in alive:
+                self._merge_shard(total, shard)
+        return total
+
+    def _merge_shard(self, target, shard):
+        for key, value in list(shard.items()):
+            if key not in target:
+                target[key] = self._new_value()
+            target[key] = self._merge(target[key], value)
+
+    def reset(self):
+        with self._lock:
+            for _, shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.TYPE)]
+        for key, value in sorted(self.collect().items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        raise NotImplementedError
+
+    def _labels(self, key, **extra):
+        labels = [(self.label, key)] + sorted(extra.items())
+        return "{%s}" % ",".join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+
+class Counter(_ShardedMetric):
+    """
+    Monotonic counter divided by label, e.g. number of brews of each coffee type
+    """
+    TYPE = "counter"
+
+    def inc(self, key, amount=1):
+        if _buffer(self, "inc", key, amount):
+            return
+        shard = self._get_shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def _new_value(self):
+        return 0
+
+    def _merge(self, target, value):
+        return target + value
+
+    def _render_value(self, key, value):
+        return ["%s%s %s" % (self.name, self._labels(key), _number(value))]
+
+
+class Histogram(_ShardedMetric):
+    """
+    Histogram of observed values divided by label. Value of each label is list with count of each bucket,
+    count of values above last bucket and sum of values.
+
+    Attributes:
+        buckets (tuple) - sorted upper bounds of buckets
+    """
+    TYPE = "histogram"
+
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, key, value):
+        if _buffer(self, "observe", key, value):
+            return
+        shard = self._get_shard()
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = self._new_value()
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _new_value(self):
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def _merge(self, target, value):
+        return [a + b for a, b in zip(target, value)]
+
+    def _render_value(self, key, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), value[:-1]):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (self.name, self._labels(key, le=_number(bound)), cumulative))
+        lines.append("%s_sum%s %s" % (self.name, self._labels(key), _number(value[-1])))
+        lines.append("%s_count%s %d" % (self.name, self._labels(key), cumulative))
+        return lines
+
+
+class Gauge(object):
+    """
+    Gauge read at the moment of rendering metrics.
+
+    Attributes:
+        name (string) - name of metric
+        help (string) - description of metric
+        callback - function returning list of pairs: dict with labels and value
+    """
+
+    def __init__(self, name, help, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def reset(self):
+        pass
+
+    def reinit_after_fork(self):
+        pass
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name]
+        for labels, value in self.callback():
+            text = ",".join('%s="%s"' % (name, _escape(label)) for name, label in sorted(labels.items()))
+            lines.append("%s{%s} %s" % (self.name, text, _number(value)))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    Keeps metrics by name and renders all of them in Prometheus text format
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add metric to registry, metric with the same name is replaced
+        :return: given metric
+        """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def reset(self):
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def reinit_after_fork(self):
+        self._lock = threading.Lock()
+        for metric in list(self._metrics.values()):
+            metric.reinit_after_fork()
+
+    def render(self):
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+
+step_seconds = registry.register(Histogram(
+    "coffee_machine_step_seconds", "Duration of each step of mechanism", "step"))
+brew_seconds = registry.register(Histogram(
+    "coffee_machine_brew_seconds", "Duration of brew of each recipe", "recipe"))
+device_seconds = registry.register(Histogram(
+    "coffee_machine_device_process_seconds", "Duration of run_process of each device", "device"))
+brews_total = registry.register(Counter(
+    "coffee_machine_brews_total", "Number of brewed coffees of each type", "coffee_type"))
+failures_total = registry.register(Counter(
+    "coffee_machine_failures_total", "Number of failed brews by error", "error"))
+refills_total = registry.register(Counter(
+    "coffee_machine_refills_total", "Number of refills of each tank", "tank"))
+
+
+def timed(histogram, key):
+    """
+    Decorator observing duration of each call of function in histogram. Duration of coroutine function
+    is measured until coroutine returns.
+    :param histogram: (Histogram) - histogram with durations
+    :param key: (string) - value of label, e.g. name of step
+    """
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def coroutine_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    histogram.observe(key, time.perf_counter() - start)
+            return coroutine_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(key, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count_brew(coffee, status):
+    """
+    Count brewed coffee and errors of failed brew
+    :param coffee: (Coffee) - model object containing brewed coffee
+    :param status: status returned by mechanism, dict with errors if brew failed
+    """
+    if isinstance(status, dict):
+        for error in status:
+            failures_total.inc(error)
+    else:
+        brews_total.inc(coffee.coffee_type)
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='coffee',
+            name='coffee_type',
+            field=models.CharField(
+                choices=[('espresso', 'Espresso'), ('americano', 'Americano'), ('latte', 'Latte')],
+                db_index=True, max_length=15),
+        ),
+    ]
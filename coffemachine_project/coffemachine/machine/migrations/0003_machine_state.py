@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 10:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0002_coffee_type_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MachineState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('machine_id', models.PositiveIntegerField(unique=True)),
+                ('water', models.IntegerField()),
+                ('beans', models.IntegerField()),
+                ('milk', models.IntegerField()),
+                ('trash', models.IntegerField()),
+                ('errors', models.TextField(default='{}')),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
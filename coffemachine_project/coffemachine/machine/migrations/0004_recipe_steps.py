@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 14:20
+from __future__ import unicode_literals
+
+import coffemachine.machine.pipeline
+from django.db import migrations, models
+
+
+def set_default_steps(apps, schema_editor):
+    Coffee = apps.get_model('machine', 'Coffee')
+    for coffee_type, steps in coffemachine.machine.pipeline.DEFAULT_STEPS.items():
+        Coffee.objects.filter(coffee_type=coffee_type, steps='').update(steps=steps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0003_machine_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coffee',
+            name='steps',
+            field=models.CharField(
+                blank=True, default='', max_length=100,
+                help_text='e.g. grind,boil,pump,lather; empty uses default steps of coffee type',
+                validators=[coffemachine.machine.pipeline.validate_steps]),
+        ),
+        migrations.AlterField(
+            model_name='coffee',
+            name='coffee_type',
+            field=models.CharField(db_index=True, max_length=15),
+        ),
+        migrations.RunPython(set_default_steps, migrations.RunPython.noop),
+    ]
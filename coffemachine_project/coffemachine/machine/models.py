@@ -1,18 +1,66 @@
 from six import python_2_unicode_compatible
+from django.core.exceptions import ValidationError
 from django.db import models
 
+from coffemachine.machine.pipeline import validate_steps, compile_recipe, get_steps
+
 
 @python_2_unicode_compatible
 class Coffee(models.Model):
+    """
+    Recipe of coffee. Steps are names of steps separated by commas, e.g. "grind,boil,pump,lather",
+    see pipeline module. New drink with own coffee type and steps can be added without code,
+    coffee_types are drinks known since the first version.
+    """
     coffee_types = (("espresso", "Espresso"), ("americano", "Americano"), ("latte", "Latte"))
     sizes = ((120, "Normal"), (240, "Large"))
-    coffee_type = models.CharField(max_length=15, choices=coffee_types)
+    coffee_type = models.CharField(max_length=15, db_index=True)
     beans = models.CharField(max_length=15)
     coffee_quantity = models.IntegerField()
     size = models.IntegerField(choices=sizes)
     extra_quantity = models.IntegerField(null=True, blank=True)
     contains_milk = models.BooleanField(default=False)
     time_preparing = models.IntegerField()
+    steps = models.CharField(max_length=100, blank=True, default="", validators=[validate_steps],
+                             help_text="e.g. grind,boil,pump,lather; empty uses default steps of coffee type")
+
+    def clean(self):
+        """
+        Check fields used by steps: extra_water needs extra_quantity, coffee contains milk only if it has lather step
+        """
+        try:
+            recipe = compile_recipe(get_steps(self))
+        except ValueError as e:
+            if self.steps:
+                # reported by validator of steps
+                return
+            raise ValidationError({"steps": str(e)})
+        errors = {}
+        if recipe.EXTRA_WATER and self.extra_quantity is None:
+            errors["extra_quantity"] = "Step extra_water needs extra quantity"
+        if recipe.LATHER_MILK != bool(self.contains_milk):
+            errors["contains_milk"] = "Coffee contains milk if and only if it has step lather"
+        if errors:
+            raise ValidationError(errors)
 
     def __str__(self):
         return "%s, %s" % (self.coffee_type, self.size)
+
+
+@python_2_unicode_compatible
+class MachineState(models.Model):
+    """
+    Persistent state of one machine shared by all worker processes. Every write checks and increments version,
+    so concurrent writers never overwrite each other.
+    """
+    machine_id = models.PositiveIntegerField(unique=True)
+    water = models.IntegerField()
+    beans = models.IntegerField()
+    milk = models.IntegerField()
+    trash = models.IntegerField()
+    errors = models.TextField(default="{}")
+    version = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "machine %s, version %s" % (self.machine_id, self.version)
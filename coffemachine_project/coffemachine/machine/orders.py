@@ -0,0 +1,191 @@
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+
+class OrderQueueFull(Exception):
+    """
+    Raised when order can not be accepted, because queue reached maximum size
+    """
+    pass
+
+
+class Order(object):
+    """
+    Single coffee order waiting in queue. Client receives ticket and asks about status of order.
+
+    Attributes:
+        ticket (string) - unique id of order
+        coffee (Coffee) - model object containing coffee, which client wants to drink
+        status (string) - one of QUEUED, BREWING, DONE, FAILED
+        result - path to coffee image if order is done, dict with errors if order failed
+        events (list) - pairs of name of finished stage of brew and dict with its result
+    """
+    QUEUED = "queued"
+    BREWING = "brewing"
+    DONE = "done"
+    FAILED = "failed"
+
+    ERROR_MACHINE_FAILURE = "Machine failure"
+
+    def __init__(self, coffee):
+        self.ticket = uuid.uuid4().hex
+        self.coffee = coffee
+        self.status = self.QUEUED
+        self.result = None
+        self.events = []
+        self._finished = threading.Event()
+        self._changed = threading.Condition()
+
+    def is_finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until order is finished
+        :param timeout: (float) - maximum seconds to wait
+        :return: True if order is finished, otherwise False
+        """
+        return self._finished.wait(timeout)
+
+    def start(self):
+        """
+        Mark order as brewing and wake up readers of events
+        """
+        with self._changed:
+            self.status = self.BREWING
+            self._changed.notify_all()
+
+    def finish(self, result):
+        """
+        Save result of brew and mark order as done or failed
+        :param result: String with path to coffee image, otherwise dict with errors
+        """
+        with self._changed:
+            self.result = result
+            self.status = self.FAILED if isinstance(result, dict) else self.DONE
+            self._finished.set()
+            self._changed.notify_all()
+
+    def add_event(self, stage, data):
+        """
+        Listener of brew, it saves finished stage and wakes up readers of events
+        :param stage: (string) - name of stage, see BrewContext
+        :param data: (dict) - result of stage
+        """
+        with self._changed:
+            self.events.append((stage, data))
+            self._changed.notify_all()
+
+    def iter_events(self, timeout=None):
+        """
+        Generator of events of brew. Events added before are yielded at once, then it waits for next ones
+        and stops when order is finished.
+        :param timeout: (float) - seconds of waiting for event, None is yielded if no event comes in this time
+        """
+        position = 0
+        while True:
+            with self._changed:
+                if position == len(self.events) and not self.is_finished():
+                    self._changed.wait(timeout)
+                events = self.events[position:]
+                finished = self.is_finished()
+            position += len(events)
+            for event in events:
+                yield event
+            if finished and position == len(self.events):
+                return
+            if not events:
+                yield None
+
+
+class OrderQueue(object):
+    """
+    Bounded queue of coffee orders drained by pool of worker threads. Workers are started with first order,
+    so creating queue at import time does not start any thread.
+
+    Attributes:
+        machine - object with make_coffee method accepting listener of brew stages,
+            e.g. CoffeeMachineFleet or CoffeeBrewMechanism
+        workers (int) - number of worker threads
+        keep (int) - how many orders are remembered for status requests
+    """
+
+    def __init__(self, machine, workers=2, maxsize=100, keep=1000):
+        self.machine = machine
+        self.workers = workers
+        self.keep = keep
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._orders = OrderedDict()
+        self._orders_lock = threading.Lock()
+        self._threads = []
+
+    def reinit_after_fork(self):
+        """
+        Worker threads do not survive fork, child starts own workers with empty queue on first order.
+        Orders of parent are forgotten, they are brewed and reported by parent.
+        """
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._orders = OrderedDict()
+        self._orders_lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, coffee):
+        """
+        Put new order to queue
+        :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+        :return: Order object with ticket
+        :raise OrderQueueFull if there is no place in queue
+        """
+        self._start_workers()
+        order = Order(coffee)
+        try:
+            self._queue.put_nowait(order)
+        except queue.Full:
+            raise OrderQueueFull("Too many orders, try again later")
+        self._remember(order)
+        return order
+
+    def get(self, ticket):
+        """
+        :param ticket: (string) - ticket of order
+        :return: Order object or None if ticket is unknown
+        """
+        with self._orders_lock:
+            return self._orders.get(ticket)
+
+    def _remember(self, order):
+        with self._orders_lock:
+            self._orders[order.ticket] = order
+            while len(self._orders) > self.keep:
+                self._orders.popitem(last=False)
+
+    def _start_workers(self):
+        with self._orders_lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                worker = threading.Thread(target=self._work, name="coffee-order-worker-%d" % number)
+                worker.daemon = True
+                worker.start()
+                self._threads.append(worker)
+
+    def _work(self):
+        while True:
+            order = self._queue.get()
+            order.start()
+            try:
+                result = self.machine.make_coffee(order.coffee, order.add_event)
+            except Exception:
+                logger.exception("Order %s failed", order.ticket)
+                result = {Order.ERROR_MACHINE_FAILURE: True}
+            order.finish(result)
+            self._queue.task_done()
@@ -0,0 +1,143 @@
+"""
+Recipes described as data and compiled into step pipelines.
+
+Recipe of coffee is ordered list of steps kept in Coffee.steps, e.g. "grind,boil,pump,lather". Quantities of steps
+are fields of the same recipe: grind uses coffee_quantity, boil uses size, extra_water uses extra_quantity
+and lather uses whole milk heater. Steps are compiled once into immutable RecipePipeline, which is shared by all
+orders of recipes with the same steps. Mechanism runs pipeline with one loop, so new drink, e.g. cappuccino,
+is only new row of Coffee table.
+"""
+import threading
+
+from django.core.exceptions import ValidationError
+
+GRIND = "grind"
+BOIL = "boil"
+PUMP = "pump"
+EXTRA_WATER = "extra_water"
+LATHER = "lather"
+
+# steps making basic espresso, each recipe contains all of them in any order
+BASIC_STEPS = (GRIND, BOIL, PUMP)
+# optional steps run after espresso is brewed
+EXTRA_STEPS = (EXTRA_WATER, LATHER)
+
+# methods of mechanism running each step, basic steps raise OperationException, extra steps return errors
+STEP_METHODS = {
+    GRIND: "step_preparing_ground_coffee",
+    BOIL: "step_preparing_boiling_water",
+    PUMP: "step_preparing_pressure_pump",
+    EXTRA_WATER: "step_adding_extra_water",
+    LATHER: "step_lathering_milk",
+}
+
+# steps of recipes saved before steps were kept in Coffee table
+DEFAULT_STEPS = {
+    "espresso": "grind,boil,pump",
+    "americano": "grind,boil,pump,extra_water",
+    "latte": "grind,boil,pump,lather",
+}
+
+ESPRESSO_IMAGE = "/static/images/espresso.png"
+LATTE_IMAGE = "/static/images/latte.png"
+
+
+def parse_steps(steps):
+    """
+    :param steps: (string) - names of steps separated by commas
+    :return: tuple with names of steps
+    :raise ValueError if step is unknown or repeated, basic step is missing or follows extra step
+    """
+    names = tuple(name.strip() for name in steps.split(",") if name.strip())
+    for name in names:
+        if name not in STEP_METHODS:
+            raise ValueError("Unknown step %s, choose from: %s" % (name, ", ".join(BASIC_STEPS + EXTRA_STEPS)))
+        if names.count(name) > 1:
+            raise ValueError("Step %s is repeated" % name)
+    basic = [name for name in names if name in BASIC_STEPS]
+    if len(basic) != len(BASIC_STEPS):
+        raise ValueError("Recipe must contain steps %s" % ", ".join(BASIC_STEPS))
+    if names[:len(basic)] != tuple(basic):
+        raise ValueError("Steps %s must follow %s" % (", ".join(EXTRA_STEPS), ", ".join(BASIC_STEPS)))
+    return names
+
+
+def validate_steps(steps):
+    """
+    Validator of Coffee.steps, empty steps mean default steps of coffee type
+    """
+    if steps:
+        try:
+            parse_steps(steps)
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+
+class RecipePipeline(object):
+    """
+    Immutable recipe compiled from steps. Its flags tell batch, availability and simulations
+    which extra resources recipe uses.
+
+    Attributes:
+        steps (tuple) - names of steps
+        basic_methods (tuple) - methods of mechanism making espresso, checking of trash bin is the first one
+        extra_methods (tuple) - methods of mechanism run after espresso is brewed
+        IMAGE (string) - path to image of coffee
+        EXTRA_WATER (bool) - recipe adds extra boiled water to basic coffee
+        LATHER_MILK (bool) - recipe adds foamed milk to basic coffee
+    """
+    __slots__ = ("steps", "basic_methods", "extra_methods", "IMAGE", "EXTRA_WATER", "LATHER_MILK")
+
+    def __init__(self, steps):
+        values = {
+            "steps": steps,
+            "basic_methods": ("step_preparing_trash",) + tuple(STEP_METHODS[name] for name in steps
+                                                               if name in BASIC_STEPS),
+            "extra_methods": tuple(STEP_METHODS[name] for name in steps if name in EXTRA_STEPS),
+            "IMAGE": LATTE_IMAGE if LATHER in steps else ESPRESSO_IMAGE,
+            "EXTRA_WATER": EXTRA_WATER in steps,
+            "LATHER_MILK": LATHER in steps,
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RecipePipeline is immutable")
+
+    def __repr__(self):
+        return "RecipePipeline(%s)" % ",".join(self.steps)
+
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+
+def reinit_after_fork():
+    global _pipelines_lock
+    _pipelines_lock = threading.Lock()
+
+
+def compile_recipe(steps):
+    """
+    :param steps: (string) - names of steps separated by commas
+    :return: RecipePipeline shared by all recipes with the same steps
+    :raise ValueError if steps are not valid
+    """
+    pipeline = _pipelines.get(steps)
+    if pipeline is None:
+        pipeline = RecipePipeline(parse_steps(steps))
+        with _pipelines_lock:
+            pipeline = _pipelines.setdefault(steps, pipeline)
+    return pipeline
+
+
+def get_steps(coffee):
+    """
+    :param coffee: (Coffee) - model object, recipe snapshot or coffee read from event log
+    :return: (string) - steps of coffee, default steps of coffee type if recipe does not define them
+    :raise ValueError if there are no steps for coffee
+    """
+    steps = getattr(coffee, "steps", None) or DEFAULT_STEPS.get(coffee.coffee_type)
+    if steps is None:
+        raise ValueError("There are no steps for %s" % coffee.coffee_type)
+    return steps
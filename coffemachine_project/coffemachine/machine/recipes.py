@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from coffemachine.machine.models import Coffee
+
+logger = logging.getLogger(__name__)
+
+RecipeSnapshot = namedtuple("RecipeSnapshot", [
+    "pk", "coffee_type", "beans", "coffee_quantity", "size", "extra_quantity", "contains_milk", "time_preparing",
+    "steps",
+])
+RecipeSnapshot.__doc__ = """
+Immutable copy of Coffee model object. Provides the same attributes as Coffee, so mechanism can brew it.
+"""
+
+
+class RecipeCache(object):
+    """
+    In-process cache of coffee recipes keyed by coffee type. Recipes are loaded with one query
+    and kept until version stamp changes. Version stamp is kept in django cache, so every worker process
+    using shared cache backend reloads recipes after any of them changes Coffee table. Stamp is read at most
+    once per check_interval, other requests use recipes from memory without touching cache.
+    Process changing recipes reloads them on next request.
+
+    Attributes:
+        VERSION_KEY (string) - key of version stamp in django cache
+        cache_alias (string) - alias of django cache keeping version stamp
+        check_interval (float) - seconds between reads of version stamp
+        timer - function returning current time in seconds
+    """
+    VERSION_KEY = "coffemachine:recipes:version"
+
+    def __init__(self, cache_alias="default", check_interval=1.0, timer=time.monotonic):
+        self.cache_alias = cache_alias
+        self.check_interval = check_interval
+        self.timer = timer
+        self._recipes = {}
+        self._version = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def reinit_after_fork(self):
+        self._lock = threading.Lock()
+
+    def get_version(self):
+        """
+        :return: current version stamp, new stamp is created if cache does not have any
+        """
+        cache = caches[self.cache_alias]
+        version = cache.get(self.VERSION_KEY)
+        if version is None:
+            cache.add(self.VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(self.VERSION_KEY)
+        return version
+
+    def get(self, coffee_type):
+        """
+        :param coffee_type: (string) - type of coffee, e.g. espresso
+        :return: RecipeSnapshot object
+        :raise Coffee.DoesNotExist if there is no recipe for given coffee type
+        """
+        recipe = self.get_all().get(coffee_type)
+        if recipe is None:
+            raise Coffee.DoesNotExist("There is no recipe for %s" % coffee_type)
+        return recipe
+
+    def get_all(self):
+        """
+        :return: dict with RecipeSnapshot objects keyed by coffee type
+        """
+        now = self.timer()
+        if now >= self._expires:
+            version = self.get_version()
+            if version != self._version:
+                self._load(version)
+            self._expires = now + self.check_interval
+        return self._recipes
+
+    def invalidate(self):
+        """
+        Change version stamp, so every process reloads recipes on next request
+        """
+        caches[self.cache_alias].set(self.VERSION_KEY, uuid.uuid4().hex, None)
+        self._expires = 0
+
+    def _load(self, version):
+        if self._version is None and isinstance(caches[self.cache_alias], LocMemCache):
+            logger.warning("Version stamp of recipes is kept in local memory cache %r, other worker processes "
+                           "do not reload changed recipes", self.cache_alias)
+        with self._lock:
+            self._recipes = {
+                coffee.coffee_type: RecipeSnapshot(*[getattr(coffee, field) for field in RecipeSnapshot._fields])
+                for coffee in Coffee.objects.all()
+            }
+            self._version = version
+
+
+recipe_cache = RecipeCache(getattr(settings, "COFFEE_MACHINE_RECIPE_CACHE", "default"),
+                           getattr(settings, "COFFEE_MACHINE_RECIPE_CHECK_INTERVAL", 1.0))
+
+
+def invalidate_recipes(sender, **kwargs):
+    """
+    Signal receiver connected to post_save and post_delete of Coffee model. Stamp is changed after transaction
+    is committed, otherwise other process could reload recipes before change is visible and keep old ones.
+    """
+    transaction.on_commit(recipe_cache.invalidate)
@@ -0,0 +1,277 @@
+"""
+Discrete-event simulation of coffee machines with virtual clock.
+
+Each order is split into steps of mechanism. Step occupies devices of machine for time scaled
+from PROCESS_TIME of devices, so whole brew of one coffee lasts Coffee.time_preparing seconds.
+Steps of different orders overlap on one machine if they use different devices, like in mechanism
+with per-device locks. Resources of tanks are not simulated, only time.
+"""
+import heapq
+import itertools
+import math
+import random
+from collections import deque
+
+from coffemachine.machine.devices import WaterHeater, MilkHeater, CoffeeGrinder, PressurePump, TrashBin
+from coffemachine.machine.handler import CoffeeBrewMechanism
+
+DEVICES = {
+    "trash_bin": TrashBin,
+    "coffee_grinder": CoffeeGrinder,
+    "water_heater": WaterHeater,
+    "pressure_pump": PressurePump,
+    "milk_heater": MilkHeater,
+}
+
+
+def get_recipe_steps(coffee, recipe):
+    """
+    Describe brew of coffee as list of steps. Each step is pair of tuple with names of used devices
+    and duration. Durations are scaled, so they sum to time of preparing coffee.
+    :param coffee: (Coffee) - model object containing coffee, which client wants to drink
+    :param recipe: (RecipePipeline) - compiled recipe used to brew coffee
+    :return: list of steps
+    """
+    steps = [("trash_bin",), ("coffee_grinder",), ("water_heater",), ("pressure_pump",)]
+    if recipe.EXTRA_WATER:
+        steps.append(("water_heater",))
+    if recipe.LATHER_MILK:
+        steps.append(("milk_heater", "water_heater"))
+    nominal = [max(DEVICES[name].PROCESS_TIME for name in devices) for devices in steps]
+    scale = float(coffee.time_preparing) / sum(nominal) if coffee.time_preparing else 1.0
+    return [(tuple(sorted(devices)), duration * scale) for devices, duration in zip(steps, nominal)]
+
+
+def percentile(values, percent):
+    """
+    :param values: (list) - sorted values
+    :param percent: (float) - percentile from 0 to 100
+    :return: value of percentile using nearest rank
+    """
+    if not values:
+        return None
+    rank = max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class VirtualClock(object):
+    """
+    Virtual clock with heap of events. Time moves only from one event to another,
+    so simulation runs as fast as events are processed.
+
+    Attributes:
+        now (float) - current virtual time in seconds
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self._events = []
+        self._sequence = itertools.count()
+
+    def schedule(self, time, callback, *args):
+        """
+        Add event at given virtual time. Events with the same time are processed in order of scheduling.
+        """
+        heapq.heappush(self._events, (time, next(self._sequence), callback, args))
+
+    def run(self):
+        while self._events:
+            self.now, _, callback, args = heapq.heappop(self._events)
+            callback(*args)
+
+
+class SimulatedDevice(object):
+    """
+    Device of simulated machine with given number of units and FIFO queue of waiting orders.
+    """
+
+    def __init__(self, name, units=1):
+        self.name = name
+        self.units = units
+        self.free = units
+        self.busy_time = 0.0
+        self.waiting = deque()
+
+
+class SimulatedOrder(object):
+    def __init__(self, number, arrival, coffee_type, steps):
+        self.number = number
+        self.arrival = arrival
+        self.coffee_type = coffee_type
+        self.steps = steps
+        self.step = 0
+        self.acquired = []
+        self.started = None
+        self.finished = None
+        self.machine = None
+
+
+class SimulatedMachine(object):
+    def __init__(self, number, layout):
+        self.number = number
+        self.devices = {name: SimulatedDevice(name, layout.get(name, 1)) for name in DEVICES}
+        self.pending = 0
+        self.finished = []
+
+
+class EventSimulationResult(object):
+    """
+    Statistics of replayed trace.
+
+    Attributes:
+        orders (list) - finished SimulatedOrder objects
+        machines (list) - SimulatedMachine objects with busy time of devices
+        duration (float) - virtual time of last event
+    """
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, orders, machines, duration):
+        self.orders = orders
+        self.machines = machines
+        self.duration = duration
+
+    def get_latencies(self):
+        return sorted(order.finished - order.arrival for order in self.orders)
+
+    def get_queueing_delays(self):
+        """
+        :return: sorted time, which orders spent waiting for devices, before and during brewing
+        """
+        return sorted(order.finished - order.arrival - sum(duration for _, duration in order.steps)
+                      for order in self.orders)
+
+    def get_utilization(self):
+        """
+        :return: dict with part of time, when units of each device were busy
+        """
+        utilization = {}
+        for name in DEVICES:
+            devices = [machine.devices[name] for machine in self.machines]
+            available = sum(device.units for device in devices) * self.duration
+            utilization[name] = sum(device.busy_time for device in devices) / available if available else 0.0
+        return utilization
+
+    def get_summary(self):
+        latencies = self.get_latencies()
+        delays = self.get_queueing_delays()
+        return {
+            "orders": len(self.orders),
+            "machines": len(self.machines),
+            "duration": self.duration,
+            "throughput_per_hour": len(self.orders) * 3600.0 / self.duration if self.duration else 0.0,
+            "latency": {"p%d" % p: percentile(latencies, p) for p in self.PERCENTILES},
+            "queueing_delay": {
+                "mean": sum(delays) / len(delays) if delays else None,
+                "p%d" % self.PERCENTILES[-1]: percentile(delays, self.PERCENTILES[-1]),
+            },
+            "utilization": self.get_utilization(),
+        }
+
+
+class DiscreteEventSimulator(object):
+    """
+    Replays trace of orders on given number of machines. Orders are dispatched to machine with
+    the fewest orders in progress, like in fleet of machines.
+
+    Attributes:
+        machines (int) - number of machines
+        layout (dict) - number of units of each device in one machine, e.g. {"coffee_grinder": 2}
+    """
+
+    def __init__(self, recipes, machines=1, layout=None):
+        """
+        :param recipes: (iterable) - Coffee model objects or recipe snapshots
+        """
+        if machines < 1:
+            raise ValueError("Simulation needs at least one machine")
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        self.steps = {coffee.coffee_type: get_recipe_steps(coffee, mechanism.get_method_for_coffee(coffee))
+                      for coffee in recipes}
+        self.machines = machines
+        self.layout = layout or {}
+
+    def run(self, trace):
+        """
+        :param trace: (iterable) - pairs of arrival time in seconds and coffee type
+        :return: EventSimulationResult object
+        """
+        clock = VirtualClock()
+        machines = [SimulatedMachine(number, self.layout) for number in range(self.machines)]
+        finished = []
+        for number, (arrival, coffee_type) in enumerate(trace):
+            order = SimulatedOrder(number, float(arrival), coffee_type, self.steps[coffee_type])
+            clock.schedule(order.arrival, self._arrive, clock, machines, order)
+        clock.run()
+        for machine in machines:
+            finished.extend(machine.finished)
+        finished.sort(key=lambda order: order.number)
+        return EventSimulationResult(finished, machines, clock.now)
+
+    def _arrive(self, clock, machines, order):
+        order.machine = min(machines, key=lambda machine: machine.pending)
+        order.machine.pending += 1
+        self._acquire(clock, order)
+
+    def _acquire(self, clock, order):
+        """
+        Take devices of current step one by one, in the same order for each step, like mechanism takes locks.
+        If device is busy, order waits in its queue and keeps devices taken so far.
+        """
+        names, duration = order.steps[order.step]
+        while len(order.acquired) < len(names):
+            device = order.machine.devices[names[len(order.acquired)]]
+            if not device.free:
+                device.waiting.append(order)
+                return
+            device.free -= 1
+            order.acquired.append((device, clock.now))
+        if order.started is None:
+            order.started = clock.now
+        clock.schedule(clock.now + duration, self._finish_step, clock, order)
+
+    def _finish_step(self, clock, order):
+        acquired, order.acquired = order.acquired, []
+        order.step += 1
+        for device, since in acquired:
+            device.free += 1
+            device.busy_time += clock.now - since
+            if device.waiting:
+                self._acquire(clock, device.waiting.popleft())
+        if order.step < len(order.steps):
+            self._acquire(clock, order)
+        else:
+            order.finished = clock.now
+            order.machine.pending -= 1
+            order.machine.finished.append(order)
+
+
+def poisson_trace(rate, duration, mix, seed=None):
+    """
+    Generate trace of random orders arriving with constant rate
+    :param rate: (float) - mean number of orders per hour
+    :param duration: (float) - length of trace in seconds
+    :param mix: (dict) - popularity of each coffee type
+    :param seed: seed of random generator
+    :return: list of pairs of arrival time and coffee type
+    :raise ValueError: if rate is not positive or mix has no positive popularity
+    """
+    if rate <= 0:
+        raise ValueError("Rate of orders must be positive")
+    generator = random.Random(seed)
+    coffee_types = sorted(mix)
+    weights = [mix[coffee_type] for coffee_type in coffee_types]
+    total = float(sum(weights))
+    if total <= 0:
+        raise ValueError("Mix of drinks needs at least one positive popularity")
+    trace = []
+    time = generator.expovariate(rate / 3600.0)
+    while time < duration:
+        point, chosen = generator.random() * total, coffee_types[-1]
+        for coffee_type, weight in zip(coffee_types, weights):
+            if point < weight:
+                chosen = coffee_type
+                break
+            point -= weight
+        trace.append((time, chosen))
+        time += generator.expovariate(rate / 3600.0)
+    return trace
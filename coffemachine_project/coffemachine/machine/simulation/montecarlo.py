@@ -0,0 +1,280 @@
+"""
+Vectorized Monte Carlo simulation of coffee machines used for capacity planning.
+
+Each run is one machine serving random stream of orders. State of all runs is kept in numpy arrays
+and every order is applied to all runs at once with the same consumption rules as devices and containers.
+When machine fails to brew coffee, operator refills all tanks and empties trash bin.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from coffemachine.machine.container import WaterTank, MilkTank, CoffeeBeansTank
+from coffemachine.machine.devices import WaterHeater, MilkHeater, CoffeeGrinder, TrashBin
+from coffemachine.machine.handler import CoffeeBrewMechanism
+
+
+class DrinkTable(object):
+    """
+    Parameters of each recipe stored in arrays indexed by drink number.
+
+    Attributes:
+        coffee_types (list) - coffee type of each drink number
+        beans (array) - beans ground for drink, zero if amount does not fit in grinder
+        size (array) - water boiled for basic coffee
+        extra (array) - extra water boiled for americano
+        has_extra (array) - drink adds extra water
+        has_milk (array) - drink adds foamed milk
+        valid_size, valid_extra (array) - portion of water fits in water heater
+        time (array) - time of preparing drink in seconds
+    """
+
+    def __init__(self, recipes):
+        """
+        :param recipes: (iterable) - Coffee model objects or recipe snapshots
+        """
+        if numpy is None:
+            raise ImportError("Monte Carlo simulation requires numpy")
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        recipes = list(recipes)
+        methods = [mechanism.get_method_for_coffee(coffee) for coffee in recipes]
+        self.coffee_types = [coffee.coffee_type for coffee in recipes]
+        self.beans = numpy.array([coffee.coffee_quantity if 0 < coffee.coffee_quantity <= CoffeeGrinder.CAPACITY
+                                  else 0 for coffee in recipes])
+        self.size = numpy.array([coffee.size for coffee in recipes])
+        self.extra = numpy.array([(coffee.extra_quantity or 0) if method.EXTRA_WATER else 0
+                                  for coffee, method in zip(recipes, methods)])
+        self.has_extra = numpy.array([method.EXTRA_WATER for method in methods])
+        self.has_milk = numpy.array([method.LATHER_MILK for method in methods])
+        self.valid_size = self._fits_in_heater(self.size)
+        self.valid_extra = self._fits_in_heater(self.extra) | ~self.has_extra
+        self.time = numpy.array([coffee.time_preparing for coffee in recipes], dtype=float)
+
+    @staticmethod
+    def _fits_in_heater(amount):
+        return (WaterHeater.MIN_CAPACITY <= amount) & (amount <= WaterHeater.CAPACITY)
+
+
+class MachineArrays(object):
+    """
+    State of many machines kept in arrays. Every machine starts with full tanks and empty trash bin.
+
+    Attributes:
+        water, beans, milk (array) - levels of tanks
+        trash (array) - level of trash bin
+        heater_error (array) - water heater keeps error, which fails next brew
+    """
+
+    def __init__(self, runs):
+        self.water = numpy.full(runs, WaterTank.CAPACITY, dtype=numpy.int64)
+        self.beans = numpy.full(runs, CoffeeBeansTank.CAPACITY, dtype=numpy.int64)
+        self.milk = numpy.full(runs, MilkTank.CAPACITY, dtype=numpy.int64)
+        self.trash = numpy.zeros(runs, dtype=numpy.int64)
+        self.heater_error = numpy.zeros(runs, dtype=bool)
+
+    def service(self, mask):
+        """
+        Refill tanks and empty trash bin of selected machines
+        :param mask: (array) - machines to service
+        """
+        self.water[mask] = WaterTank.CAPACITY
+        self.beans[mask] = CoffeeBeansTank.CAPACITY
+        self.milk[mask] = MilkTank.CAPACITY
+        self.trash[mask] = 0
+        self.heater_error[mask] = False
+
+
+def _take(level, amount, mask):
+    """
+    Take amount from container of selected machines. Container never gives away the last portion.
+    :return: mask of machines, which got amount
+    """
+    taken = mask & (level - amount > 0)
+    level -= numpy.where(taken, amount, 0)
+    return taken
+
+
+def brew_orders(machines, drinks, orders):
+    """
+    Brew one order on every machine, following steps of CoffeeBrewMechanism.
+    :param machines: (MachineArrays) - state of machines, changed in place
+    :param drinks: (DrinkTable) - parameters of recipes
+    :param orders: (array) - drink number ordered on each machine
+    :return: mask of machines, which failed to brew coffee
+    """
+    pressure_water = WaterHeater.CAPACITY
+    alive = machines.trash < TrashBin.CAPACITY
+
+    grind = alive & (drinks.beans[orders] > 0)
+    alive &= _take(machines.beans, drinks.beans[orders], grind) | ~grind
+
+    alive &= drinks.valid_size[orders]
+    alive &= _take(machines.water, drinks.size[orders], alive)
+    alive &= _take(machines.water, pressure_water, alive)
+    alive &= ~machines.heater_error
+    machines.trash += alive
+
+    extra = alive & drinks.has_extra[orders]
+    alive &= drinks.valid_extra[orders]
+    extra &= alive
+    alive &= _take(machines.water, drinks.extra[orders], extra) | ~extra
+    extra &= alive
+    alive &= _take(machines.water, pressure_water, extra) | ~extra
+
+    lather = alive & drinks.has_milk[orders]
+    boiled = _take(machines.water, MilkTank.WATER_FOR_LATHER, lather)
+    pressurized = _take(machines.water, pressure_water, lather)
+    machines.heater_error |= lather & ~(boiled & pressurized)
+    alive &= boiled | ~lather
+    lather &= boiled
+    alive &= _take(machines.milk, MilkHeater.CAPACITY, lather) | ~lather
+    return ~alive
+
+
+class SimulationResult(object):
+    """
+    Statistics of simulation.
+
+    Attributes:
+        runs (int) - number of simulated machines
+        orders (int) - number of orders in each stream
+        failures (array) - number of failed orders of each machine
+        refills (array) - number of services of each machine
+        first_refill_order (array) - number of orders served before first failure, -1 if machine never failed
+        first_refill_time (array) - seconds of brewing before first failure, -1 if machine never failed
+        busy_time (array) - seconds of brewing and servicing of each machine
+        served (array) - number of served coffees of each machine
+    """
+    PERCENTILES = (5, 50, 95)
+
+    def __init__(self, runs, orders):
+        self.runs = runs
+        self.orders = orders
+        self.failures = numpy.zeros(runs, dtype=numpy.int64)
+        self.refills = numpy.zeros(runs, dtype=numpy.int64)
+        self.first_refill_order = numpy.full(runs, -1, dtype=numpy.int64)
+        self.first_refill_time = numpy.full(runs, -1.0)
+        self.busy_time = numpy.zeros(runs)
+        self.served = numpy.zeros(runs, dtype=numpy.int64)
+
+    def _distribution(self, values):
+        if not len(values):
+            return None
+        return {
+            "mean": float(values.mean()),
+            "percentiles": {str(p): float(v) for p, v in zip(self.PERCENTILES,
+                                                             numpy.percentile(values, self.PERCENTILES))},
+        }
+
+    def get_summary(self):
+        """
+        :return: dict with failure rate, distributions of time to first refill and throughput in coffees per hour
+        """
+        refilled = self.first_refill_order >= 0
+        throughput = numpy.where(self.busy_time > 0, self.served * 3600.0 / numpy.maximum(self.busy_time, 1e-9), 0)
+        return {
+            "runs": self.runs,
+            "orders": self.orders,
+            "failure_rate": float(self.failures.sum()) / (self.runs * self.orders),
+            "refills_per_run": float(self.refills.mean()),
+            "never_refilled": float((~refilled).mean()),
+            "orders_to_first_refill": self._distribution(self.first_refill_order[refilled]),
+            "seconds_to_first_refill": self._distribution(self.first_refill_time[refilled]),
+            "throughput_per_hour": self._distribution(throughput),
+        }
+
+
+class MonteCarloSimulator(object):
+    """
+    Simulates many machines serving random streams of orders.
+
+    Attributes:
+        drinks (DrinkTable) - parameters of recipes
+        mix (array) - probability of ordering each drink
+        service_time (float) - seconds needed by operator to refill machine
+        chunk_size (int) - number of machines simulated at once, bounds memory usage
+    """
+
+    def __init__(self, recipes, mix=None, service_time=120.0, chunk_size=100000):
+        """
+        :param recipes: (iterable) - Coffee model objects or recipe snapshots
+        :param mix: (dict) - probability of each coffee type, by default each drink is equally popular
+        """
+        self.drinks = DrinkTable(recipes)
+        weights = numpy.array([float((mix or {}).get(coffee_type, 0 if mix else 1))
+                               for coffee_type in self.drinks.coffee_types])
+        if weights.sum() <= 0:
+            raise ValueError("Mix of drinks needs at least one positive probability")
+        self.mix = weights / weights.sum()
+        self.service_time = service_time
+        self.chunk_size = chunk_size
+
+    def random_orders(self, runs, orders, random_state):
+        """
+        :return: array (runs x orders) with random drink numbers
+        """
+        return random_state.choice(len(self.mix), size=(runs, orders), p=self.mix)
+
+    def run(self, runs, orders, seed=None):
+        """
+        Simulate runs machines, each serving stream of given number of random orders
+        :return: SimulationResult object
+        """
+        random_state = numpy.random.RandomState(seed)
+        result = SimulationResult(runs, orders)
+        for start in range(0, runs, self.chunk_size):
+            stop = min(start + self.chunk_size, runs)
+            self.simulate(self.random_orders(stop - start, orders, random_state), result, start)
+        return result
+
+    def simulate(self, orders, result=None, offset=0):
+        """
+        Simulate given streams of orders
+        :param orders: (array) - drink numbers, one row for each machine
+        :param result: (SimulationResult) - result to fill, new one is created by default
+        :param offset: (int) - position of first machine in result
+        :return: tuple of SimulationResult and array (runs x orders) with True for each failed order
+        """
+        runs, count = orders.shape
+        if result is None:
+            result = SimulationResult(runs, count)
+        rows = slice(offset, offset + runs)
+        machines = MachineArrays(runs)
+        failed = numpy.zeros((runs, count), dtype=bool)
+        clock = numpy.zeros(runs)
+        for number in range(count):
+            drink = orders[:, number]
+            fail = brew_orders(machines, self.drinks, drink)
+            failed[:, number] = fail
+            clock += numpy.where(fail, self.service_time, self.drinks.time[drink])
+            first = fail & (result.first_refill_order[rows] < 0)
+            result.first_refill_order[rows][first] = number
+            result.first_refill_time[rows][first] = clock[first] - self.service_time
+            machines.service(fail)
+        result.failures[rows] = failed.sum(axis=1)
+        result.refills[rows] = result.failures[rows]
+        result.served[rows] = count - result.failures[rows]
+        result.busy_time[rows] = clock
+        return result, failed
+
+
+def run_reference(recipes, orders):
+    """
+    Brew streams of orders with CoffeeBrewMechanism objects. It is slow, but shows behaviour which
+    simulation must reproduce. Failed machine is replaced by new one, like after service.
+    :param recipes: (list) - Coffee model objects or recipe snapshots, order defines drink numbers
+    :param orders: (list) - drink numbers, one list for each machine
+    :return: list with True for each failed order, one list for each machine
+    """
+    results = []
+    for stream in orders:
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        failed = []
+        for drink in stream:
+            status = mechanism.make_coffee(recipes[drink])
+            failed.append(isinstance(status, dict))
+            if failed[-1]:
+                mechanism = CoffeeBrewMechanism.create_standalone()
+        results.append(failed)
+    return results
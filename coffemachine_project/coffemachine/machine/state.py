@@ -0,0 +1,420 @@
+"""
+Persistent state of machines shared by many worker processes.
+
+Mechanism in each process is only a view of state used by read-only checks, refresh copies state to it without
+any lock. Each operation runs on new working copy of current state and checks and reserves resources at once,
+new state is written back only if nobody changed it in the meantime. If write fails, operation is repeated
+on fresh state, so whole consumption of brew is applied at once or not at all. Operation does not wait
+for devices, does not inform listener and does not change metrics, these side effects are collected
+by SideEffects and replayed after state is saved, so retried operation does not repeat them.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from django.conf import settings
+from django.db import transaction, DatabaseError
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from coffemachine.machine.clock import DeferredClock, get_clock, override_clock
+from coffemachine.machine.errors import ERROR_MESSAGES, ALL_ERRORS, ErrorFlags
+from coffemachine.machine.handler import CoffeeBrewMechanism
+from coffemachine.machine.metrics import MetricsBuffer
+from coffemachine.machine.models import MachineState
+
+DEVICES = ("water_heater", "milk_heater", "coffee_grinder", "pressure_pump", "trash_bin")
+
+
+class StateConflict(Exception):
+    """
+    Raised when state of machine was changed by other writers in every attempt of operation
+    """
+    pass
+
+
+def get_snapshot(mechanism):
+    """
+    :param mechanism: (CoffeeBrewMechanism) - mechanism of machine
+    :return: dict with levels of tanks, level of trash bin and errors of mechanism and each device
+    """
+    errors = {name: sorted(getattr(mechanism, name)._errors) for name in DEVICES if getattr(mechanism, name)._errors}
+    if mechanism.errors:
+        errors["mechanism"] = sorted(mechanism.errors)
+    return {
+        "water": mechanism.water_heater.water_tank.content_level,
+        "beans": mechanism.coffee_grinder.coffee_tank.content_level,
+        "milk": mechanism.milk_heater.milk_tank.content_level,
+        "trash": mechanism.trash_bin.current_level,
+        "errors": errors,
+    }
+
+
+def apply_snapshot(mechanism, snapshot):
+    """
+    Copy state returned by get_snapshot to mechanism
+    :param mechanism: (CoffeeBrewMechanism) - mechanism of machine
+    :param snapshot: (dict) - state of machine
+    """
+    tanks = (
+        (mechanism.water_heater.water_tank, snapshot["water"]),
+        (mechanism.coffee_grinder.coffee_tank, snapshot["beans"]),
+        (mechanism.milk_heater.milk_tank, snapshot["milk"]),
+    )
+    for tank, level in tanks:
+        with tank.lock:
+            tank.content_level = level
+    with mechanism.trash_bin.lock:
+        mechanism.trash_bin.current_level = snapshot["trash"]
+    errors = snapshot["errors"]
+    for name in DEVICES:
+        device = getattr(mechanism, name)
+        with device.lock:
+            device._errors = ErrorFlags.from_messages(errors.get(name, ()))
+    mechanism.errors = ErrorFlags.from_messages(errors.get("mechanism", ()))
+
+
+class SideEffects(object):
+    """
+    Side effects of operation run on working copy of machine: durations of device processes, stages sent
+    to listener and observed metrics. They are collected while operation runs and replayed after its state is saved.
+
+    Attributes:
+        clock (DeferredClock) - collects durations of device processes
+        metrics (MetricsBuffer) - collects observed metrics
+        events (list) - tuples of seconds of device processes before stage, name of stage and its result
+    """
+
+    def __init__(self):
+        self.clock = DeferredClock()
+        self.metrics = MetricsBuffer()
+        self.events = []
+
+    def run(self, operation, mechanism):
+        """
+        Run operation collecting its side effects
+        :param operation: function called with mechanism and listener of brew stages
+        :return: result of operation
+        """
+        with override_clock(self.clock), self.metrics:
+            return operation(mechanism, self.listener)
+
+    def listener(self, stage, data):
+        self.events.append((self.clock.take(), stage, data))
+
+    def replay(self, listener=None, clock=None):
+        """
+        Wait for device processes and inform listener about each stage in the same order as operation did
+        :param clock: clock used to wait, None uses clock configured in settings
+        """
+        clock = clock or get_clock()
+        for seconds, stage, data in self.events:
+            clock.wait(seconds)
+            if listener is not None:
+                listener(stage, data)
+        clock.wait(self.clock.take())
+        self.metrics.flush()
+
+    async def replay_async(self, listener=None, clock=None):
+        """
+        Coroutine version of replay, it sleeps instead of waiting
+        """
+        clock = clock or get_clock()
+        for seconds, stage, data in self.events:
+            await clock.sleep(seconds)
+            if listener is not None:
+                listener(stage, data)
+        await clock.sleep(self.clock.take())
+        self.metrics.flush()
+
+
+class StateStore(object):
+    """
+    Base of persistent stores. Operations of one machine are serialized inside process, operations of different
+    processes are checked by version of state. Lock is held only while operation runs on working copy,
+    which takes no time, because operation does not wait for devices.
+
+    Attributes:
+        retries (int) - number of attempts of operation before StateConflict is raised
+    """
+
+    def __init__(self, retries=20):
+        self.retries = retries
+        self._locks = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    def reinit_after_fork(self):
+        self._locks = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    def _get_lock(self, machine_id):
+        with self._locks_lock:
+            return self._locks[machine_id]
+
+    def read(self, machine_id, mechanism):
+        """
+        Read state of machine, state of given mechanism is saved if machine does not have any.
+        Read does not wait for writers.
+        :return: tuple of version and snapshot of state
+        """
+        raise NotImplementedError
+
+    def write(self, machine_id, version, snapshot):
+        """
+        Save state of machine only if its version did not change
+        :return: True if state was saved
+        """
+        raise NotImplementedError
+
+    def load(self, machine_id, mechanism):
+        """
+        Copy current state of machine to mechanism without waiting for running operations
+        """
+        apply_snapshot(mechanism, self.read(machine_id, mechanism)[1])
+
+    def run(self, machine_id, mechanism, operation):
+        """
+        Run operation on working copy of current state of machine and save state changed by operation.
+        Operation is repeated on fresh state if state was changed in the meantime, so it must not have side effects,
+        see SideEffects.
+        :param mechanism: (CoffeeBrewMechanism) - view of machine, it gets saved state
+        :param operation: function called with working copy of mechanism
+        :return: result of operation
+        :raise StateConflict if state could not be saved
+        """
+        for attempt in range(self.retries):
+            with self._get_lock(machine_id):
+                version, snapshot = self.read(machine_id, mechanism)
+                working = CoffeeBrewMechanism.create_standalone()
+                apply_snapshot(working, snapshot)
+                result = operation(working)
+                snapshot = get_snapshot(working)
+                if self.write(machine_id, version, snapshot):
+                    apply_snapshot(mechanism, snapshot)
+                    return result
+            time.sleep(min(0.001 * 2 ** attempt, 0.05))
+        raise StateConflict("State of machine %s is changed by other writers" % machine_id)
+
+
+class DatabaseStateStore(StateStore):
+    """
+    Keeps state of machines in MachineState table. Write is one conditional update of row in short transaction.
+
+    Attributes:
+        using (string) - alias of database
+    """
+
+    def __init__(self, using="default", retries=20):
+        super(DatabaseStateStore, self).__init__(retries)
+        self.using = using
+
+    def read(self, machine_id, mechanism):
+        states = MachineState.objects.using(self.using)
+        row = states.filter(machine_id=machine_id).values(
+            "water", "beans", "milk", "trash", "errors", "version").first()
+        if row is None:
+            snapshot = get_snapshot(mechanism)
+            try:
+                with transaction.atomic(using=self.using):
+                    states.create(machine_id=machine_id, version=0, **self._to_fields(snapshot))
+                return 0, snapshot
+            except DatabaseError:
+                row = states.filter(machine_id=machine_id).values(
+                    "water", "beans", "milk", "trash", "errors", "version").get()
+        version = row.pop("version")
+        row["errors"] = json.loads(row["errors"])
+        return version, row
+
+    def write(self, machine_id, version, snapshot):
+        try:
+            with transaction.atomic(using=self.using):
+                updated = MachineState.objects.using(self.using).filter(machine_id=machine_id, version=version).update(
+                    version=F("version") + 1, updated=timezone.now(), **self._to_fields(snapshot))
+        except DatabaseError:
+            return False
+        return updated == 1
+
+    @staticmethod
+    def _to_fields(snapshot):
+        fields = dict(snapshot)
+        fields["errors"] = json.dumps(snapshot["errors"], sort_keys=True)
+        return fields
+
+
+class MmapStateStore(StateStore):
+    """
+    Keeps state of machines in memory mapped file shared by all worker processes on one host.
+    Each machine has slot of fixed size with sequence number, levels of tanks, level of trash bin and bits of errors.
+    Writer changes slot under lock of slot region and makes sequence number odd while writing,
+    reader copies slot without any lock and repeats copy if sequence number was odd or changed (seqlock).
+    If sequence number stays odd, e.g. writer was killed while writing, reader takes lock of slot
+    and repairs sequence number. Version of state is half of sequence number.
+    Each owner of errors has fixed number of bits, header keeps size of slot and layout of errors,
+    so file written with other layout is refused.
+
+    Attributes:
+        path (string) - path to file with state
+        MAGIC (bytes) - marks file with state of machines
+        ERROR_BITS (int) - bits of errors of one owner, limits number of ERROR_MESSAGES
+        SPINS (int) - copies of slot tried by reader before it takes lock
+    """
+    MAGIC = b"COFFEE01"
+    HEADER = struct.Struct("<8sIII")
+    HEADER_SIZE = 64
+    SLOT = struct.Struct("<QiiiiQ")
+    ERROR_OWNERS = DEVICES + ("mechanism",)
+    ERROR_BITS = 10
+    SPINS = 1000
+    _process_lock = threading.Lock()
+
+    def __init__(self, path=None, slots=None, retries=20):
+        """
+        :param path: (string) - path to file, by default COFFEE_MACHINE_STATE_FILE setting
+        :param slots: (int) - number of machines in file, by default size of fleet
+        """
+        if fcntl is None:
+            raise ImportError("Memory mapped state requires fcntl module")
+        if len(ERROR_MESSAGES) > self.ERROR_BITS:
+            raise ValueError("Memory mapped state keeps at most %s errors of each device" % self.ERROR_BITS)
+        super(MmapStateStore, self).__init__(retries)
+        self.path = path or getattr(settings, "COFFEE_MACHINE_STATE_FILE")
+        slots = slots or getattr(settings, "COFFEE_MACHINE_FLEET_SIZE", 1)
+        size = self.HEADER_SIZE + self.SLOT.size * slots
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, os.fstat(self._fd).st_size)
+            layout = (self.SLOT.size, self.ERROR_BITS, len(self.ERROR_OWNERS))
+            header = self.HEADER.unpack_from(self._map, 0)
+            if header[0] != self.MAGIC:
+                self.HEADER.pack_into(self._map, 0, self.MAGIC, *layout)
+            elif header[1:] != layout:
+                raise ValueError("File %s keeps state in other layout" % self.path)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.slots = (len(self._map) - self.HEADER_SIZE) // self.SLOT.size
+
+    def reinit_after_fork(self):
+        """
+        Mapping and descriptor are shared with parent, locks of file regions belong to process,
+        so only lock of writers inside process is replaced.
+        """
+        super(MmapStateStore, self).reinit_after_fork()
+        MmapStateStore._process_lock = threading.Lock()
+
+    def _offset(self, machine_id):
+        if not 0 <= machine_id < self.slots:
+            raise ValueError("File %s keeps state of %s machines" % (self.path, self.slots))
+        return self.HEADER_SIZE + machine_id * self.SLOT.size
+
+    def _read_slot(self, offset):
+        for _ in range(self.SPINS):
+            values = self.SLOT.unpack_from(self._map, offset)
+            if not values[0] % 2 and values[0] == self.SLOT.unpack_from(self._map, offset)[0]:
+                return values
+        return self._locked(offset, self._repair_slot, offset)
+
+    def _repair_slot(self, offset):
+        """
+        Nobody writes slot while its lock is held, so odd sequence number was left by killed writer.
+        Sequence number is made even and greater, so writers with version read before are rejected.
+        """
+        values = self.SLOT.unpack_from(self._map, offset)
+        if values[0] % 2:
+            struct.pack_into("<Q", self._map, offset, values[0] + 1)
+            values = self.SLOT.unpack_from(self._map, offset)
+        return values
+
+    def _write_slot(self, offset, sequence, snapshot):
+        struct.pack_into("<Q", self._map, offset, sequence + 1)
+        self.SLOT.pack_into(self._map, offset, sequence + 1, snapshot["water"], snapshot["beans"], snapshot["milk"],
+                            snapshot["trash"], self.encode_errors(snapshot["errors"]))
+        struct.pack_into("<Q", self._map, offset, sequence + 2)
+
+    def _locked(self, offset, function, *args):
+        """
+        Call function holding lock of slot. Lock of file region excludes other processes only,
+        so writers inside process are serialized by lock shared by all stores.
+        """
+        with self._process_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                return function(*args)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+
+    def read(self, machine_id, mechanism):
+        offset = self._offset(machine_id)
+        values = self._read_slot(offset)
+        if not values[0]:
+            self._locked(offset, self._initialize, offset, get_snapshot(mechanism))
+            values = self._read_slot(offset)
+        sequence, water, beans, milk, trash, errors = values
+        return sequence // 2, {
+            "water": water,
+            "beans": beans,
+            "milk": milk,
+            "trash": trash,
+            "errors": self.decode_errors(errors),
+        }
+
+    def _initialize(self, offset, snapshot):
+        if not self.SLOT.unpack_from(self._map, offset)[0]:
+            self._write_slot(offset, 0, snapshot)
+
+    def write(self, machine_id, version, snapshot):
+        offset = self._offset(machine_id)
+        return self._locked(offset, self._write_if_version, offset, version, snapshot)
+
+    def _write_if_version(self, offset, version, snapshot):
+        sequence = self.SLOT.unpack_from(self._map, offset)[0]
+        if sequence != version * 2:
+            return False
+        self._write_slot(offset, sequence, snapshot)
+        return True
+
+    @classmethod
+    def encode_errors(cls, errors):
+        """
+        :param errors: (dict) - lists of errors keyed by owner, like in snapshot
+        :return: (int) - bits of errors
+        """
+        bits = 0
+        for owner, messages in errors.items():
+            bits |= ErrorFlags.from_messages(messages) << cls.ERROR_OWNERS.index(owner) * cls.ERROR_BITS
+        return bits
+
+    @classmethod
+    def decode_errors(cls, bits):
+        errors = {}
+        for owner_index, owner in enumerate(cls.ERROR_OWNERS):
+            messages = list(ErrorFlags(bits >> owner_index * cls.ERROR_BITS & ALL_ERRORS))
+            if messages:
+                errors[owner] = messages
+        return errors
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def get_state_store():
+    """
+    :return: store configured by COFFEE_MACHINE_STATE_STORE setting, None if state is kept only in memory
+    """
+    path = getattr(settings, "COFFEE_MACHINE_STATE_STORE", None)
+    if not path:
+        return None
+    return import_string(path)()
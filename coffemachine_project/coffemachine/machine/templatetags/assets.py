@@ -0,0 +1,33 @@
+from django import template
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.html import format_html_join
+
+from coffemachine.machine.assets import BUNDLES, get_manifest
+
+register = template.Library()
+
+TAGS = {
+    ".css": '<link rel="stylesheet" type="text/css" href="{}">',
+    ".js": '<script src="{}"></script>',
+}
+
+
+def get_bundle_urls(name):
+    """
+    :param name: (string) - name of bundle, e.g. "js/machine.js"
+    :return: list with URL of built bundle, URLs of its sources if assets were not built
+    """
+    hashed_name = get_manifest().get(name)
+    if hashed_name is not None:
+        return [reverse("machine:asset", args=[hashed_name])]
+    return [static(source) for source in BUNDLES[name]]
+
+
+@register.simple_tag
+def bundle(name):
+    """
+    Render link or script tags of bundle, e.g. {% bundle "js/machine.js" %}
+    """
+    tag = TAGS[name[name.rindex("."):]]
+    return format_html_join("\n", tag, ((url,) for url in get_bundle_urls(name)))
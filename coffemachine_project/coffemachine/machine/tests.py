@@ -1,12 +1,53 @@
 # Create your tests here.
+import asyncio
+import gzip
+import json
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
 from collections import defaultdict
+from unittest import mock, skipIf
 
-from django.test import TestCase, Client
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+from django.http import JsonResponse
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 
+from coffemachine.machine.asgi import CoffeeMachineASGI
+from coffemachine.machine.assets import build_assets, read_sources, compress_gzip, rewrite_urls, BUNDLES
+from coffemachine.machine.asynchronous import AsyncCoffeeBrewMechanism, AsyncCoffeeMachineFleet
+from coffemachine.machine.clock import InstantClock, ScaledClock, get_clock, create_clock
+from coffemachine.machine.compact import CompactFleetState
+from coffemachine.machine.benchmark import run_benchmarks, compare, bench_steps, STEPS
+from coffemachine.machine.availability import MachineAvailability
 from coffemachine.machine.container import WaterTank, MilkTank
 from coffemachine.machine.devices import PressurePump, WaterHeater, MilkHeater, TrashBin, CoffeeGrinder
-from coffemachine.machine.handler import CoffeeBrewMechanism, AmericanoRecipe, LatteRecipe, EspressoRecipe
-from coffemachine.machine.models import Coffee
+from coffemachine.machine.errors import ErrorFlags, ERROR_CODES, ERROR_MESSAGES, encode_errors, get_error_table
+from coffemachine.machine.eventlog import EventLog
+from coffemachine.machine.fleet import CoffeeMachineFleet
+from coffemachine.machine.fragments import ProblemFragmentCache
+from coffemachine.machine.lifecycle import warm_up, reinit_after_fork
+from coffemachine.machine.maintenance import RefillPredictor
+from coffemachine.machine.handler import BrewContext, CoffeeBrewMechanism
+from coffemachine.machine.metrics import Counter, Histogram, registry, brews_total, failures_total, refills_total, \
+    step_seconds, device_seconds
+from coffemachine.machine.models import Coffee, MachineState
+from coffemachine.machine.pipeline import ESPRESSO_IMAGE, LATTE_IMAGE, compile_recipe, parse_steps
+from coffemachine.machine.idempotency import IdempotencyCache, IdempotencyConflict, IdempotencyKeyReused, \
+    idempotency_keys
+from coffemachine.machine.orders import OrderQueue, OrderQueueFull, Order
+from coffemachine.machine.recipes import recipe_cache, RecipeCache, RecipeSnapshot
+from coffemachine.machine.state import DatabaseStateStore, MmapStateStore, StateConflict, get_snapshot, apply_snapshot
+from coffemachine.machine.simulation.discrete import DiscreteEventSimulator, VirtualClock, get_recipe_steps, \
+    percentile, poisson_trace
+from coffemachine.machine.simulation.montecarlo import MonteCarloSimulator, run_reference, numpy
+from coffemachine.machine import views
 
 
 class MachineTestCases(TestCase):
@@ -16,6 +57,17 @@ class MachineTestCases(TestCase):
     def create_client(self):
         self.client = Client()
 
+    def patch_fleet(self, size=1):
+        """
+        Replace fleet used by views with new one, so test does not depend on resources used by other tests
+        :return: new fleet
+        """
+        fleet = CoffeeMachineFleet(size=size)
+        for patcher in (mock.patch.object(views, "fleet", fleet), mock.patch.object(views.orders, "machine", fleet)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return fleet
+
 
 class PressurePump_Test(MachineTestCases):
     def test_initial_device(self):
@@ -167,7 +219,7 @@ class CoffeeBrewMechanism_Test(MachineTestCases):
     def test_espresso_init(self):
         coffee = Coffee.objects.get(coffee_type="espresso")
         brew_mechanism = CoffeeBrewMechanism()
-        self.assertEqual(brew_mechanism.make_coffee(coffee), EspressoRecipe.IMAGE)
+        self.assertEqual(brew_mechanism.make_coffee(coffee), ESPRESSO_IMAGE)
 
     def test_make_couple_cups_of_espresso_coffee(self):
         coffee = Coffee.objects.get(coffee_type="espresso")
@@ -180,7 +232,7 @@ class CoffeeBrewMechanism_Test(MachineTestCases):
     def test_americano_init(self):
         coffee = Coffee.objects.get(coffee_type="americano")
         brew_mechanism = CoffeeBrewMechanism()
-        self.assertEqual(brew_mechanism.make_coffee(coffee), AmericanoRecipe.IMAGE)
+        self.assertEqual(brew_mechanism.make_coffee(coffee), ESPRESSO_IMAGE)
 
     def test_make_couple_cups_of_americano_coffee(self):
         coffee = Coffee.objects.get(coffee_type="americano")
@@ -193,7 +245,7 @@ class CoffeeBrewMechanism_Test(MachineTestCases):
     def test_late_init(self):
         coffee = Coffee.objects.get(coffee_type="latte")
         brew_mechanism = CoffeeBrewMechanism()
-        self.assertEqual(brew_mechanism.make_coffee(coffee), LatteRecipe.IMAGE)
+        self.assertEqual(brew_mechanism.make_coffee(coffee), LATTE_IMAGE)
 
     def test_make_couple_cups_of_late_coffee(self):
         coffee = Coffee.objects.get(coffee_type="latte")
@@ -202,3 +254,1613 @@ class CoffeeBrewMechanism_Test(MachineTestCases):
         for _ in range(5):
             status = brew_mechanism.make_coffee(coffee)
         self.assertTrue(status[WaterHeater.ERROR_EMPTY_WATER_TANK])
+
+    def test_brew_context_keeps_own_errors(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        context = BrewContext(coffee, brew_mechanism.get_method_for_coffee(coffee))
+        context.errors |= ERROR_CODES[WaterHeater.ERROR_EMPTY_WATER_TANK]
+        self.assertFalse(brew_mechanism.errors)
+        self.assertEqual(brew_mechanism.make_coffee(coffee), ESPRESSO_IMAGE)
+
+    def test_concurrent_brews_do_not_lose_updates(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        results = []
+
+        def brew():
+            results.append(brew_mechanism.make_coffee(coffee))
+
+        threads = [threading.Thread(target=brew) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        served = [status for status in results if not isinstance(status, dict)]
+        self.assertEqual(len(served), 2)
+        self.assertEqual(brew_mechanism.trash_bin.current_level, len(served))
+        self.assertEqual(brew_mechanism.water_heater.water_tank.content_level,
+                         WaterTank.CAPACITY - 2 * (coffee.size + WaterHeater.CAPACITY))
+
+    def test_concurrent_brews_do_not_overfill_trash_bin(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        brew_mechanism.trash_bin.current_level = TrashBin.CAPACITY - 1
+        brew_mechanism.coffee_grinder.clock = ScaledClock(speed=100)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(brew_mechanism.make_coffee(coffee)))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results, key=lambda status: isinstance(status, dict))[0], ESPRESSO_IMAGE)
+        self.assertTrue(any(isinstance(status, dict) and status[TrashBin.ERROR_FULL_TRASH] for status in results))
+        self.assertEqual(brew_mechanism.trash_bin.current_level, TrashBin.CAPACITY)
+
+    def test_failed_brew_releases_trash_bin(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        brew_mechanism.coffee_grinder.coffee_tank.content_level = 0
+        self.assertTrue(brew_mechanism.make_coffee(coffee)[CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND])
+        self.assertEqual(brew_mechanism.trash_bin.current_level, 0)
+        brew_mechanism.refill_beans_tank()
+        results = brew_mechanism.make_batch([coffee] * 4)
+        self.assertTrue(results[3][CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND])
+        self.assertEqual(brew_mechanism.trash_bin.current_level, 3)
+
+
+class CoffeeMachineFleet_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_fleet_machines_are_independent(self):
+        fleet = CoffeeMachineFleet(size=2)
+        first, second = [machine.mechanism for machine in fleet.machines]
+        self.assertIsNot(first, second)
+        self.assertIsNot(first.water_heater, second.water_heater)
+
+    def test_fleet_skips_blocked_machine(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        fleet = CoffeeMachineFleet(size=2)
+        fleet.machines[0].mechanism.trash_bin.current_level = TrashBin.CAPACITY
+        self.assertEqual(fleet.select_machine(coffee), fleet.machines[1])
+        self.assertEqual(fleet.make_coffee(coffee), ESPRESSO_IMAGE)
+        self.assertEqual(fleet.machines[1].served, 1)
+
+    def test_batch_skips_machine_without_resources(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        fleet = CoffeeMachineFleet(size=2)
+        fleet.machines[0].mechanism.coffee_grinder.coffee_tank.content_level = 1
+        self.assertTrue(fleet.machines[0].mechanism.can_make_coffee(coffee))
+        self.assertEqual(fleet.select_machine(coffee), fleet.machines[1])
+        self.assertEqual(fleet.select_machine_for_batch([coffee, coffee]), fleet.machines[1])
+
+    def test_fleet_serves_more_than_one_machine(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        single, double = CoffeeMachineFleet(size=1), CoffeeMachineFleet(size=2)
+        for _ in range(4):
+            single.make_coffee(coffee)
+            double.make_coffee(coffee)
+        self.assertGreater(double.get_stats()["served"], single.get_stats()["served"])
+
+    def test_fleet_without_machines(self):
+        with self.assertRaises(ValueError):
+            CoffeeMachineFleet(size=0)
+
+    def test_fleet_status_view(self):
+        response = self.client.get("/fleet/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("throughput", response.json())
+
+
+class OrderQueue_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_order_is_brewed_by_worker(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        orders = OrderQueue(CoffeeBrewMechanism.create_standalone(), workers=1)
+        order = orders.submit(coffee)
+        self.assertTrue(order.wait(5))
+        self.assertEqual(order.status, Order.DONE)
+        self.assertEqual(order.result, ESPRESSO_IMAGE)
+        self.assertEqual(orders.get(order.ticket), order)
+
+    def test_failed_order_keeps_errors(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        mechanism.trash_bin.current_level = TrashBin.CAPACITY
+        order = OrderQueue(mechanism, workers=1).submit(coffee)
+        order.wait(5)
+        self.assertEqual(order.status, Order.FAILED)
+        self.assertTrue(order.result[TrashBin.ERROR_FULL_TRASH])
+
+    def test_full_queue_rejects_order(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        orders = OrderQueue(CoffeeBrewMechanism.create_standalone(), workers=0, maxsize=1)
+        orders.submit(coffee)
+        with self.assertRaises(OrderQueueFull):
+            orders.submit(coffee)
+
+    def test_forget_old_orders(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        orders = OrderQueue(CoffeeBrewMechanism.create_standalone(), workers=0, keep=1)
+        first, second = orders.submit(coffee), orders.submit(coffee)
+        self.assertIsNone(orders.get(first.ticket))
+        self.assertEqual(orders.get(second.ticket), second)
+
+    def test_post_returns_ticket_and_status(self):
+        self.patch_fleet()
+        response = self.client.post("/", {"coffee_type": "espresso"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        data = response.json()
+        self.assertIn(data["status"], [Order.QUEUED, Order.BREWING, Order.DONE])
+        views.orders.get(data["ticket"]).wait(5)
+        status = self.client.get(data["status_url"]).json()
+        self.assertIn(status["status"], [Order.DONE, Order.FAILED])
+
+    def test_unknown_ticket(self):
+        response = self.client.get("/orders/%s/" % ("0" * 32))
+        self.assertEqual(response.status_code, 404)
+
+
+class CoffeeBatch_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_batch_shares_water_for_pressure_pump(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        self.assertEqual(brew_mechanism.make_batch([coffee] * 3), [ESPRESSO_IMAGE] * 3)
+        self.assertEqual(brew_mechanism.water_heater.water_tank.content_level,
+                         WaterTank.CAPACITY - 3 * coffee.size - WaterHeater.CAPACITY)
+        self.assertEqual(brew_mechanism.trash_bin.current_level, 3)
+
+    def test_batch_serves_more_than_single_brews(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        single = CoffeeBrewMechanism.create_standalone()
+        served = [single.make_coffee(coffee) for _ in range(3)]
+        self.assertIsInstance(served[-1], dict)
+
+    def test_batch_fails_only_rest_of_batch(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        results = brew_mechanism.make_batch([coffee] * 4)
+        self.assertEqual(results[:3], [ESPRESSO_IMAGE] * 3)
+        self.assertTrue(results[3][CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND])
+        self.assertEqual(brew_mechanism.trash_bin.current_level, 3)
+
+    def test_batch_respects_trash_bin(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        brew_mechanism.trash_bin.current_level = TrashBin.CAPACITY - 1
+        results = brew_mechanism.make_batch([coffee] * 2)
+        self.assertEqual(results[0], ESPRESSO_IMAGE)
+        self.assertTrue(results[1][TrashBin.ERROR_FULL_TRASH])
+        self.assertFalse(brew_mechanism.errors)
+
+    def test_batch_with_latte(self):
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        latte = Coffee.objects.get(coffee_type="latte")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        results = brew_mechanism.make_batch([espresso, latte])
+        self.assertEqual(results, [ESPRESSO_IMAGE, LATTE_IMAGE])
+        self.assertEqual(brew_mechanism.milk_heater.milk_tank.content_level, MilkTank.CAPACITY - MilkHeater.CAPACITY)
+
+    def test_batch_view(self):
+        response = self.client.post("/batch/", {"coffee_type": ["espresso", "latte"]})
+        results = response.json()["results"]
+        self.assertEqual([result["coffee_type"] for result in results], ["espresso", "latte"])
+
+    def test_batch_view_too_big(self):
+        response = self.client.post("/batch/", {"coffee_type": ["espresso"] * 100})
+        self.assertEqual(response.status_code, 400)
+
+
+class RecipeCache_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_recipe_snapshot(self):
+        recipe = recipe_cache.get("espresso")
+        self.assertIsInstance(recipe, RecipeSnapshot)
+        self.assertEqual(recipe.coffee_quantity, Coffee.objects.get(coffee_type="espresso").coffee_quantity)
+
+    def test_cached_recipe_without_queries(self):
+        recipe_cache.get("espresso")
+        with self.assertNumQueries(0):
+            recipe = recipe_cache.get("latte")
+            self.assertEqual(CoffeeBrewMechanism.create_standalone().make_coffee(recipe), LATTE_IMAGE)
+
+    def test_brew_request_without_queries(self):
+        self.patch_fleet()
+        recipe_cache.get("espresso")
+        with self.assertNumQueries(0):
+            response = self.client.post("/", {"coffee_type": "espresso"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        views.orders.get(response.json()["ticket"]).wait(5)
+
+    def test_version_is_checked_once_per_interval(self):
+        now = [0.0]
+        cache = RecipeCache(check_interval=10, timer=lambda: now[0])
+        cache.get("espresso")
+        with mock.patch.object(cache, "get_version", wraps=cache.get_version) as get_version:
+            cache.get("latte")
+            now[0] = 10
+            cache.get("latte")
+        self.assertEqual(get_version.call_count, 1)
+
+    def test_local_memory_cache_is_reported(self):
+        cache = RecipeCache("local")
+        with override_settings(CACHES={"local": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}):
+            with self.assertLogs("coffemachine.machine.recipes", "WARNING"):
+                cache.get("espresso")
+
+
+class RecipeInvalidation_Test(TransactionTestCase):
+    """
+    Cache is invalidated after commit, so changes are committed by these tests
+    """
+    fixtures = ['coffee.json']
+
+    def test_save_invalidates_cache(self):
+        recipe_cache.get("espresso")
+        Coffee.objects.filter(coffee_type="espresso").update(size=240)
+        self.assertEqual(recipe_cache.get("espresso").size, 120)
+        Coffee.objects.get(coffee_type="espresso").save()
+        self.assertEqual(recipe_cache.get("espresso").size, 240)
+
+    def test_delete_invalidates_cache(self):
+        recipe_cache.get("latte")
+        Coffee.objects.get(coffee_type="latte").delete()
+        with self.assertRaises(Coffee.DoesNotExist):
+            recipe_cache.get("latte")
+
+    def test_cache_is_invalidated_after_commit(self):
+        recipe_cache.get("espresso")
+        with transaction.atomic():
+            Coffee.objects.filter(coffee_type="espresso").update(size=240)
+            Coffee.objects.get(coffee_type="espresso").save()
+            self.assertEqual(recipe_cache.get("espresso").size, 120)
+        self.assertEqual(recipe_cache.get("espresso").size, 240)
+
+
+class ProblemFragmentCache_Test(MachineTestCases):
+    def test_render_each_error_set_once(self):
+        fragments = ProblemFragmentCache()
+        first = fragments.render({WaterHeater.ERROR_EMPTY_WATER_TANK: True, TrashBin.ERROR_FULL_TRASH: True})
+        second = fragments.render({TrashBin.ERROR_FULL_TRASH: True, WaterHeater.ERROR_EMPTY_WATER_TANK: True})
+        self.assertEqual(first, second)
+        self.assertIn(WaterHeater.ERROR_EMPTY_WATER_TANK, first)
+        self.assertEqual(fragments.get_stats()["hits"], 1)
+        self.assertEqual(fragments.get_stats()["misses"], 1)
+
+    def test_cache_is_bounded(self):
+        fragments = ProblemFragmentCache(maxsize=1)
+        fragments.render({WaterHeater.ERROR_EMPTY_WATER_TANK: True})
+        fragments.render({TrashBin.ERROR_FULL_TRASH: True})
+        fragments.render({WaterHeater.ERROR_EMPTY_WATER_TANK: True})
+        self.assertEqual(fragments.get_stats()["misses"], 3)
+        self.assertEqual(fragments.get_stats()["size"], 1)
+
+    def test_clear_cache(self):
+        fragments = ProblemFragmentCache()
+        fragments.render({TrashBin.ERROR_FULL_TRASH: True})
+        fragments.clear()
+        fragments.render({TrashBin.ERROR_FULL_TRASH: True})
+        self.assertEqual(fragments.get_stats()["misses"], 2)
+
+
+class MachineAvailability_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def assert_available_cups(self, coffee_type):
+        coffee = Coffee.objects.get(coffee_type=coffee_type)
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        availability = MachineAvailability(brew_mechanism)
+        count = availability.count(coffee)
+        self.assertGreater(count, 0)
+        for _ in range(count):
+            self.assertNotIsInstance(brew_mechanism.make_coffee(coffee), dict)
+        self.assertEqual(availability.count(coffee), 0)
+        self.assertTrue(availability.get_errors(coffee))
+        self.assertIsInstance(brew_mechanism.make_coffee(coffee), dict)
+
+    def test_available_espresso(self):
+        self.assert_available_cups("espresso")
+
+    def test_available_americano(self):
+        self.assert_available_cups("americano")
+
+    def test_available_latte(self):
+        self.assert_available_cups("latte")
+
+    def test_errors_without_touching_devices(self):
+        coffee = Coffee.objects.get(coffee_type="espresso")
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        brew_mechanism.coffee_grinder.coffee_tank.content_level = coffee.coffee_quantity
+        errors = MachineAvailability(brew_mechanism).get_errors(coffee)
+        self.assertEqual(list(errors), [CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND])
+        self.assertEqual(brew_mechanism.coffee_grinder.coffee_tank.content_level, coffee.coffee_quantity)
+        self.assertEqual(brew_mechanism.water_heater.water_tank.content_level, WaterTank.CAPACITY)
+
+    def test_fail_fast_view(self):
+        fleet = self.patch_fleet()
+        fleet.machines[0].mechanism.trash_bin.current_level = TrashBin.CAPACITY
+        response = self.client.post("/", {"coffee_type": "espresso"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        data = response.json()
+        self.assertEqual(data["status"], Order.FAILED)
+        self.assertIn(TrashBin.ERROR_FULL_TRASH, data["problems"])
+        self.assertNotIn("ticket", data)
+
+    def test_availability_view(self):
+        self.patch_fleet(size=2)
+        coffees = self.client.get("/availability/").json()["coffees"]
+        self.assertEqual(set(coffees), {"espresso", "americano", "latte"})
+        self.assertEqual(coffees["latte"], 2)
+
+
+@skipIf(numpy is None, "Monte Carlo simulation requires numpy")
+class MonteCarloSimulator_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def get_recipes(self):
+        recipes = list(Coffee.objects.order_by("pk"))
+        recipes.append(Coffee(coffee_type="espresso", beans="Robusta", coffee_quantity=90, size=60,
+                              time_preparing=5))
+        return recipes
+
+    def test_simulation_follows_mechanism(self):
+        recipes = self.get_recipes()
+        simulator = MonteCarloSimulator(recipes)
+        orders = numpy.random.RandomState(7).randint(0, len(recipes), size=(50, 30))
+        result, failed = simulator.simulate(orders)
+        self.assertEqual(failed.tolist(), run_reference(recipes, orders.tolist()))
+        self.assertEqual(result.failures.sum(), failed.sum())
+
+    def test_simulation_summary(self):
+        simulator = MonteCarloSimulator(Coffee.objects.all(), mix={"espresso": 1}, chunk_size=100)
+        summary = simulator.run(250, 10, seed=1).get_summary()
+        self.assertEqual(summary["runs"], 250)
+        self.assertEqual(summary["orders_to_first_refill"]["percentiles"]["50"], 2)
+        self.assertGreater(summary["throughput_per_hour"]["mean"], 0)
+
+    def test_wrong_mix(self):
+        with self.assertRaises(ValueError):
+            MonteCarloSimulator(Coffee.objects.all(), mix={"mocha": 1})
+
+
+class DiscreteEventSimulator_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_virtual_clock_order(self):
+        clock = VirtualClock()
+        events = []
+        clock.schedule(5, events.append, "second")
+        clock.schedule(1, events.append, "first")
+        clock.schedule(5, events.append, "third")
+        clock.run()
+        self.assertEqual(events, ["first", "second", "third"])
+        self.assertEqual(clock.now, 5)
+
+    def test_percentile_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertIsNone(percentile([], 50))
+
+    def test_steps_sum_to_time_preparing(self):
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        for coffee in Coffee.objects.all():
+            steps = get_recipe_steps(coffee, mechanism.get_method_for_coffee(coffee))
+            self.assertAlmostEqual(sum(duration for _, duration in steps), coffee.time_preparing)
+        latte = Coffee.objects.get(coffee_type="latte")
+        steps = get_recipe_steps(latte, mechanism.get_method_for_coffee(latte))
+        self.assertEqual(steps[-1][0], ("milk_heater", "water_heater"))
+
+    def test_single_order_latency(self):
+        simulator = DiscreteEventSimulator(Coffee.objects.all())
+        summary = simulator.run([(10, "latte")]).get_summary()
+        latte = Coffee.objects.get(coffee_type="latte")
+        self.assertAlmostEqual(summary["latency"]["p50"], latte.time_preparing)
+        self.assertEqual(summary["queueing_delay"]["mean"], 0)
+
+    def test_orders_wait_for_busy_devices(self):
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        simulator = DiscreteEventSimulator([espresso])
+        result = simulator.run([(0, "espresso"), (0, "espresso")])
+        first, second = result.orders
+        self.assertAlmostEqual(first.finished, espresso.time_preparing)
+        self.assertGreater(second.started, 0)
+        self.assertLess(second.finished, 2 * espresso.time_preparing)
+        self.assertGreater(result.get_utilization()["water_heater"], 0)
+
+    def test_more_machines_lower_latency(self):
+        trace = poisson_trace(600, 3600, {"espresso": 2, "americano": 1, "latte": 1}, seed=3)
+        one = DiscreteEventSimulator(Coffee.objects.all(), machines=1).run(trace).get_summary()
+        three = DiscreteEventSimulator(Coffee.objects.all(), machines=3).run(trace).get_summary()
+        self.assertEqual(one["orders"], len(trace))
+        self.assertEqual(three["orders"], len(trace))
+        self.assertLess(three["latency"]["p95"], one["latency"]["p95"])
+
+    def test_trace_with_wrong_rate_or_mix(self):
+        with self.assertRaises(ValueError):
+            poisson_trace(0, 3600, {"espresso": 1})
+        with self.assertRaises(ValueError):
+            poisson_trace(600, 3600, {"espresso": 0, "latte": 0})
+
+    def test_layout_with_more_units(self):
+        trace = [(0, "americano")] * 4
+        single = DiscreteEventSimulator(Coffee.objects.all()).run(trace).get_summary()
+        double = DiscreteEventSimulator(Coffee.objects.all(), layout={"water_heater": 2}).run(trace).get_summary()
+        self.assertLess(double["duration"], single["duration"])
+
+    def test_wrong_number_of_machines(self):
+        with self.assertRaises(ValueError):
+            DiscreteEventSimulator(Coffee.objects.all(), machines=0)
+
+
+class Benchmark_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_run_benchmarks(self):
+        fleet = self.patch_fleet()
+        recipes = list(Coffee.objects.order_by("coffee_type"))
+        results = run_benchmarks(recipes, rounds=3)["results"]
+        self.assertIs(views.fleet, fleet)
+        self.assertEqual(get_snapshot(fleet.machines[0].mechanism),
+                         get_snapshot(CoffeeBrewMechanism.create_standalone()))
+        for coffee in recipes:
+            self.assertEqual(results["make_coffee.%s" % coffee.coffee_type]["rounds"], 3)
+            for step in STEPS:
+                self.assertIn("%s.%s" % (step, coffee.coffee_type), results)
+        self.assertEqual(results["view_order_coffee"]["errors"], 0)
+        self.assertEqual(results["view_extra_options"]["errors"], 0)
+        self.assertGreater(results["mechanism_memory"]["value"], 0)
+        self.assertLess(results["compact_machine_memory"]["value"], results["mechanism_memory"]["value"] / 10)
+
+    def test_steps_stop_after_error(self):
+        coffee = Coffee(coffee_type="espresso", beans="Robusta", coffee_quantity=10, size=500, time_preparing=5)
+        results = bench_steps(coffee, rounds=2)
+        self.assertNotIn("step_preparing_pressure_pump", results)
+        self.assertEqual(results["step_preparing_boiling_water"]["rounds"], 2)
+
+    def test_compare_flags_regressions(self):
+        baseline = {"results": {
+            "latency": {"value": 1.0, "higher_is_better": False},
+            "throughput": {"value": 100.0, "higher_is_better": True},
+            "memory": {"value": 10.0, "higher_is_better": False},
+        }}
+        current = {"results": {
+            "latency": {"value": 1.5, "higher_is_better": False},
+            "throughput": {"value": 150.0, "higher_is_better": True},
+            "memory": {"value": 10.5, "higher_is_better": False},
+            "new": {"value": 1.0, "higher_is_better": False},
+        }}
+        rows = {row["name"]: row for row in compare(baseline, current, threshold=0.2)}
+        self.assertEqual(sorted(rows), ["latency", "memory", "throughput"])
+        self.assertTrue(rows["latency"]["regression"])
+        self.assertFalse(rows["throughput"]["regression"])
+        self.assertFalse(rows["memory"]["regression"])
+
+
+class Metrics_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def setUp(self):
+        registry.reset()
+
+    def test_counter_sums_threads(self):
+        counter = Counter("test_total", "Test counter", "kind")
+        threads = [threading.Thread(target=lambda: [counter.inc("a") for _ in range(100)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc("b", 2)
+        self.assertEqual(counter.collect(), {"a": 400, "b": 2})
+        self.assertEqual(counter.collect(), {"a": 400, "b": 2})
+
+    def test_histogram_buckets(self):
+        histogram = Histogram("test_seconds", "Test histogram", "step", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe("x", value)
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{step="x",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{step="x",le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{step="x",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{step="x"} 4', lines)
+
+    def test_brew_is_instrumented(self):
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        latte = Coffee.objects.get(coffee_type="latte")
+        mechanism.make_coffee(latte)
+        mechanism.make_coffee(latte)
+        mechanism.refill_water_tank()
+        self.assertEqual(brews_total.collect(), {"latte": 1})
+        self.assertEqual(failures_total.collect(), {WaterHeater.ERROR_EMPTY_WATER_TANK: 1})
+        self.assertEqual(refills_total.collect(), {"water": 1})
+        steps = step_seconds.collect()
+        self.assertEqual(sum(steps["step_preparing_trash"][:-1]), 2)
+        self.assertEqual(sum(steps["run_brew_process"][:-1]), 1)
+        self.assertIn("milk_heater", device_seconds.collect())
+
+    def test_metrics_view(self):
+        fleet = self.patch_fleet(size=2)
+        fleet.make_coffee(Coffee.objects.get(coffee_type="espresso"))
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        text = response.content.decode()
+        self.assertIn('coffee_machine_brews_total{coffee_type="espresso"} 1', text)
+        self.assertIn("# TYPE coffee_machine_step_seconds histogram", text)
+        self.assertIn('coffee_machine_tank_level{machine="1",tank="water"} %d' % WaterTank.CAPACITY, text)
+        self.assertIn('coffee_machine_trash_level{machine="0"} 1', text)
+
+
+class DatabaseStateStore_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_snapshot_round_trip(self):
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        mechanism.make_coffee(Coffee.objects.get(coffee_type="latte"))
+        snapshot = get_snapshot(mechanism)
+        self.assertEqual(snapshot["errors"], {"water_heater": [WaterHeater.ERROR_EMPTY_WATER_TANK]})
+        copy = CoffeeBrewMechanism.create_standalone()
+        apply_snapshot(copy, snapshot)
+        self.assertEqual(get_snapshot(copy), snapshot)
+
+    def test_fleets_share_state(self):
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        first = CoffeeMachineFleet(store=DatabaseStateStore())
+        second = CoffeeMachineFleet(store=DatabaseStateStore())
+        self.assertEqual(first.make_coffee(espresso), ESPRESSO_IMAGE)
+        self.assertEqual(second.count_available(espresso), 1)
+        self.assertEqual(second.make_coffee(espresso), ESPRESSO_IMAGE)
+        self.assertEqual(first.count_available(espresso), 0)
+        self.assertTrue(first.get_unavailable_errors(espresso))
+        state = MachineState.objects.get(machine_id=0)
+        self.assertEqual((state.water, state.trash, state.version), (WaterTank.CAPACITY - 2 * 470, 2, 2))
+        second.refill_water_tank()
+        second.refill_beans_tank()
+        second.remove_trash_bin()
+        self.assertEqual(first.count_available(espresso), 2)
+
+    def test_stale_write_is_rejected(self):
+        store = DatabaseStateStore()
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        version, snapshot = store.read(0, mechanism)
+        self.assertTrue(store.write(0, version, snapshot))
+        self.assertFalse(store.write(0, version, snapshot))
+
+    def test_operation_is_repeated_after_conflict(self):
+        store = DatabaseStateStore()
+        other = DatabaseStateStore()
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        calls = []
+
+        def brew(mechanism):
+            calls.append(mechanism.water_heater.water_tank.content_level)
+            if len(calls) == 1:
+                other.run(0, CoffeeBrewMechanism.create_standalone(), lambda m: m.make_coffee(espresso))
+            return mechanism.make_coffee(espresso)
+
+        self.assertEqual(store.run(0, CoffeeBrewMechanism.create_standalone(), brew), ESPRESSO_IMAGE)
+        self.assertEqual(calls, [WaterTank.CAPACITY, WaterTank.CAPACITY - 470])
+        self.assertEqual(MachineState.objects.get(machine_id=0).water, WaterTank.CAPACITY - 2 * 470)
+
+    def test_conflict_after_retries(self):
+        store = DatabaseStateStore(retries=2)
+        other = DatabaseStateStore()
+
+        def conflict(mechanism):
+            other.run(0, CoffeeBrewMechanism.create_standalone(), lambda m: m.remove_trash_bin())
+
+        with self.assertRaises(StateConflict):
+            store.run(0, CoffeeBrewMechanism.create_standalone(), conflict)
+
+
+    def test_retry_does_not_repeat_side_effects(self):
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        fleet = CoffeeMachineFleet(store=DatabaseStateStore())
+        store = fleet.machines[0].store
+        write = store.write
+        store.write = mock.Mock(side_effect=[False, True])
+        self.addCleanup(setattr, store, "write", write)
+        brews = brews_total.collect().get("espresso", 0)
+        stages = []
+        self.assertEqual(fleet.make_coffee(espresso, lambda stage, data: stages.append(stage)), ESPRESSO_IMAGE)
+        self.assertEqual(store.write.call_count, 2)
+        self.assertEqual(stages, [BrewContext.TRASH, BrewContext.GRINDING, BrewContext.BOILING, BrewContext.PRESSURE,
+                                  BrewContext.DONE])
+        self.assertEqual(brews_total.collect()["espresso"], brews + 1)
+
+
+class BlockingClock(InstantClock):
+    """
+    Clock waiting until test releases it
+    """
+
+    def __init__(self):
+        self.waiting = threading.Event()
+        self.released = threading.Event()
+
+    def wait(self, seconds):
+        self.waiting.set()
+        return self.released.wait(5)
+
+
+class MmapStateStore_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def setUp(self):
+        descriptor, self.path = tempfile.mkstemp()
+        os.close(descriptor)
+        self.addCleanup(os.remove, self.path)
+
+    def get_store(self, **kwargs):
+        store = MmapStateStore(self.path, slots=2, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_errors_bits(self):
+        errors = {"mechanism": [TrashBin.ERROR_FULL_TRASH], "milk_heater": [MilkHeater.ERROR_PUMP,
+                                                                           WaterHeater.ERROR_EMPTY_WATER_TANK]}
+        decoded = MmapStateStore.decode_errors(MmapStateStore.encode_errors(errors))
+        self.assertEqual({owner: sorted(messages) for owner, messages in decoded.items()},
+                         {owner: sorted(messages) for owner, messages in errors.items()})
+
+    def test_errors_layout_is_checked(self):
+        self.get_store()
+        with mock.patch.object(MmapStateStore, "ERROR_BITS", 12):
+            with self.assertRaises(ValueError):
+                MmapStateStore(self.path, slots=2)
+        with mock.patch.object(MmapStateStore, "ERROR_BITS", 4):
+            with self.assertRaises(ValueError):
+                MmapStateStore(self.path, slots=2)
+
+    def test_slot_left_by_killed_writer_is_repaired(self):
+        store = self.get_store()
+        version, snapshot = store.read(1, CoffeeBrewMechanism.create_standalone())
+        offset = store._offset(1)
+        struct.pack_into("<Q", store._map, offset, version * 2 + 1)
+        self.assertEqual(store.read(1, CoffeeBrewMechanism.create_standalone()), (version + 1, snapshot))
+        self.assertFalse(store.write(1, version, snapshot))
+        self.assertTrue(store.write(1, version + 1, snapshot))
+
+    def test_fleets_share_state(self):
+        latte = Coffee.objects.get(coffee_type="latte")
+        first = CoffeeMachineFleet(size=2, store=self.get_store())
+        second = CoffeeMachineFleet(size=2, store=self.get_store())
+        self.assertEqual(first.make_coffee(latte), LATTE_IMAGE)
+        self.assertEqual(first.make_coffee(latte), LATTE_IMAGE)
+        self.assertEqual(second.count_available(latte), 0)
+        mechanism = second.machines[0].mechanism
+        self.assertEqual(mechanism.milk_heater.milk_tank.content_level, MilkTank.CAPACITY - MilkHeater.CAPACITY)
+        self.assertTrue(mechanism.water_heater.get_device_errors())
+        second.refill_water_tank()
+        second.fill_milk()
+        self.assertEqual(first.count_available(latte), 2)
+
+    def test_stale_write_is_rejected(self):
+        store = self.get_store()
+        version, snapshot = store.read(1, CoffeeBrewMechanism.create_standalone())
+        self.assertEqual(version, 1)
+        self.assertTrue(store.write(1, version, snapshot))
+        self.assertFalse(store.write(1, version, snapshot))
+        self.assertEqual(store.read(1, CoffeeBrewMechanism.create_standalone())[0], 2)
+
+    def test_concurrent_writers(self):
+        stores = [self.get_store(retries=1000) for _ in range(4)]
+        espresso = Coffee.objects.get(coffee_type="espresso")
+
+        def brew(store):
+            for _ in range(25):
+                store.run(0, CoffeeBrewMechanism.create_standalone(),
+                          lambda mechanism: (mechanism.remove_trash_bin(), mechanism.make_coffee(espresso)))
+
+        threads = [threading.Thread(target=brew, args=(store,)) for store in stores]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        version, snapshot = stores[0].read(0, CoffeeBrewMechanism.create_standalone())
+        self.assertEqual(version, 101)
+
+    def test_devices_wait_after_state_is_saved(self):
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        fleet = CoffeeMachineFleet(size=2, store=self.get_store())
+        other = CoffeeMachineFleet(size=2, store=self.get_store())
+        clock = BlockingClock()
+        with mock.patch("coffemachine.machine.state.get_clock", return_value=clock):
+            brewing = threading.Thread(target=fleet.make_coffee, args=(espresso,))
+            brewing.start()
+            self.assertTrue(clock.waiting.wait(5))
+            start = time.time()
+            self.assertFalse(fleet.get_unavailable_errors(espresso))
+            other.refresh()
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(other.machines[0].mechanism.trash_bin.current_level, 1)
+            self.assertEqual(fleet.machines[0].pending, 1)
+            clock.released.set()
+            brewing.join()
+
+    def test_machine_outside_file(self):
+        with self.assertRaises(ValueError):
+            self.get_store().read(2, CoffeeBrewMechanism.create_standalone())
+
+
+class ErrorFlags_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_every_device_error_has_code(self):
+        devices = (WaterHeater, MilkHeater, CoffeeGrinder, PressurePump, TrashBin)
+        messages = [getattr(device, name) for device in devices
+                    for name in dir(device) if name.startswith("ERROR_")]
+        self.assertEqual(sorted(set(messages)), list(ERROR_MESSAGES))
+
+    def test_flags_behave_like_dict_of_errors(self):
+        errors = ErrorFlags.from_messages([TrashBin.ERROR_FULL_TRASH])
+        errors |= ERROR_CODES[WaterHeater.ERROR_EMPTY_WATER_TANK]
+        self.assertIsInstance(errors, ErrorFlags)
+        self.assertTrue(errors[TrashBin.ERROR_FULL_TRASH])
+        self.assertNotIn(MilkHeater.ERROR_EMPTY_MILK_TANK, errors)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(errors.to_dict(), {TrashBin.ERROR_FULL_TRASH: True, WaterHeater.ERROR_EMPTY_WATER_TANK: True})
+        self.assertEqual(list(errors.without(TrashBin.ERROR_FULL_TRASH)), [WaterHeater.ERROR_EMPTY_WATER_TANK])
+        with self.assertRaises(KeyError):
+            ErrorFlags()[TrashBin.ERROR_FULL_TRASH]
+        with self.assertRaises(KeyError):
+            ErrorFlags.from_messages(["Unknown"])
+
+    def test_error_code_decoded_by_table(self):
+        status = {CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND: True, "Order failed": True}
+        code = encode_errors(status)
+        table = get_error_table()
+        self.assertEqual([message for bit, message in table.items() if code & int(bit)],
+                         [CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND])
+
+    def test_failed_brew_returns_dict(self):
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        brew_mechanism.coffee_grinder.coffee_tank.content_level = 1
+        status = brew_mechanism.make_coffee(Coffee.objects.get(coffee_type="espresso"))
+        self.assertEqual(status, {CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND: True})
+        self.assertIs(type(status), dict)
+        self.assertEqual(brew_mechanism.get_errors(), ERROR_CODES[CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND])
+
+    def test_errors_view(self):
+        response = Client().get("/errors/")
+        self.assertEqual(response.json()["errors"][str(ERROR_CODES[TrashBin.ERROR_FULL_TRASH])],
+                         TrashBin.ERROR_FULL_TRASH)
+
+
+class CompactFleetState_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_machine_behaves_like_mechanism(self):
+        recipes = list(Coffee.objects.order_by("pk"))
+        recipes.append(Coffee(coffee_type="espresso", beans="Robusta", coffee_quantity=300, size=60, time_preparing=5))
+        operations = ["refill_water_tank", "refill_beans_tank", "fill_milk", "remove_trash_bin"]
+        generator = random.Random(5)
+        state = CompactFleetState(5)
+        mechanisms = [CoffeeBrewMechanism.create_standalone() for _ in range(5)]
+        for _ in range(500):
+            machine_id = generator.randrange(5)
+            if generator.random() < 0.2:
+                operation = generator.choice(operations)
+                getattr(mechanisms[machine_id], operation)()
+                getattr(state.machine(machine_id), operation)()
+            else:
+                coffee = generator.choice(recipes)
+                self.assertEqual(state.make_coffee(machine_id, coffee), mechanisms[machine_id].make_coffee(coffee))
+            self.assertEqual(get_snapshot(state.machine(machine_id)), get_snapshot(mechanisms[machine_id]))
+
+    def test_machines_are_independent(self):
+        state = CompactFleetState(3)
+        latte = Coffee.objects.get(coffee_type="latte")
+        self.assertEqual(state.make_coffee(1, latte), LATTE_IMAGE)
+        self.assertEqual(state.milk.tolist(), [MilkTank.CAPACITY, MilkTank.CAPACITY - MilkHeater.CAPACITY,
+                                               MilkTank.CAPACITY])
+        self.assertEqual(state.trash.tolist(), [0, 1, 0])
+        self.assertFalse(state.machine(0).water_heater.get_device_errors())
+        self.assertTrue(state.machine(1).water_heater.get_device_errors())
+
+    def test_views_have_no_dict(self):
+        mechanism = CompactFleetState(1).machine(0)
+        views = [mechanism, mechanism.water_heater, mechanism.water_heater.water_tank, mechanism.milk_heater,
+                 mechanism.milk_heater.milk_tank, mechanism.coffee_grinder, mechanism.coffee_grinder.coffee_tank,
+                 mechanism.pressure_pump, mechanism.trash_bin]
+        for view in views:
+            self.assertFalse(hasattr(view, "__dict__"), view)
+
+    def test_error_bits(self):
+        state = CompactFleetState(2)
+        trash_bin = state.machine(1).trash_bin
+        trash_bin.add_error(TrashBin.ERROR_FULL_TRASH)
+        self.assertEqual(trash_bin.get_device_errors().to_dict(), {TrashBin.ERROR_FULL_TRASH: True})
+        self.assertFalse(state.machine(1).errors)
+        self.assertFalse(state.machine(0).trash_bin.get_device_errors())
+        with self.assertRaises(KeyError):
+            trash_bin.add_error("Unknown")
+        state.machine(1).errors |= trash_bin.get_device_errors()
+        self.assertEqual(list(state.machine(1).errors), [TrashBin.ERROR_FULL_TRASH])
+        trash_bin.cleanup()
+        state.machine(1).errors = ErrorFlags()
+        self.assertEqual(state.errors.tolist(), [0, 0])
+
+    def test_memory(self):
+        self.assertEqual(CompactFleetState(1000).get_memory(), 35 * 1000)
+        with self.assertRaises(IndexError):
+            CompactFleetState(2).machine(2)
+
+
+class EventLog_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, "machines.log")
+        self.addCleanup(shutil.rmtree, directory)
+
+    def get_fleet(self, size=2, checkpoint_every=1000):
+        journal = EventLog(self.path, checkpoint_every=checkpoint_every)
+        self.addCleanup(journal.close)
+        return CoffeeMachineFleet(size=size, journal=journal)
+
+    def brew_orders(self, fleet):
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        latte = Coffee.objects.get(coffee_type="latte")
+        americano = Coffee.objects.get(coffee_type="americano")
+        fleet.make_coffee(espresso)
+        fleet.make_coffee(latte)
+        fleet.make_batch([espresso, americano])
+        fleet.refill_water_tank()
+        fleet.make_coffee(latte)
+        fleet.remove_trash_bin()
+        fleet.make_coffee(espresso)
+
+    def assertSameState(self, fleet, recovered):
+        for machine, copy in zip(fleet.machines, recovered.machines):
+            self.assertEqual(get_snapshot(copy.mechanism), get_snapshot(machine.mechanism))
+
+    def test_recover_from_log(self):
+        fleet = self.get_fleet()
+        self.brew_orders(fleet)
+        recovered = self.get_fleet()
+        self.assertSameState(fleet, recovered)
+        self.assertNotEqual(get_snapshot(recovered.machines[0].mechanism),
+                            get_snapshot(CoffeeBrewMechanism.create_standalone()))
+
+    def test_forked_fleet_does_not_write_log(self):
+        fleet = self.get_fleet()
+        fleet.make_coffee(Coffee.objects.get(coffee_type="espresso"))
+        written = os.path.getsize(self.path)
+        with self.assertLogs("coffemachine.machine.fleet", "WARNING"):
+            fleet.reinit_after_fork()
+        self.brew_orders(fleet)
+        self.assertEqual(os.path.getsize(self.path), written)
+        self.assertTrue(all(machine.journal is None for machine in fleet.machines))
+
+    def test_recover_from_checkpoint(self):
+        fleet = self.get_fleet(checkpoint_every=3)
+        self.brew_orders(fleet)
+        self.assertTrue(os.path.exists(self.path + ".checkpoint"))
+        journal = EventLog(self.path)
+        recovered = CoffeeMachineFleet(size=2)
+        replayed = journal.recover({machine.machine_id: machine.mechanism for machine in recovered.machines})
+        self.assertLess(replayed, len(list(journal.read())))
+        self.assertSameState(fleet, recovered)
+
+    def test_recover_without_waiting_and_metrics(self):
+        self.brew_orders(self.get_fleet())
+        brews = brews_total.collect()
+        refills = refills_total.collect()
+        clock = RecordingClock()
+        with mock.patch("coffemachine.machine.clock._clock", clock):
+            self.get_fleet()
+        self.assertEqual(clock.waits, [])
+        self.assertEqual(brews_total.collect(), brews)
+        self.assertEqual(refills_total.collect(), refills)
+
+    def test_partial_record_is_removed(self):
+        fleet = self.get_fleet()
+        self.brew_orders(fleet)
+        with open(self.path, "ab") as log:
+            log.write(b"\x00" * (EventLog.RECORD.size // 2))
+        recovered = self.get_fleet()
+        self.assertSameState(fleet, recovered)
+        recovered.make_coffee(Coffee.objects.get(coffee_type="espresso"))
+        self.assertEqual((os.path.getsize(self.path) - len(EventLog.MAGIC)) % EventLog.RECORD.size, 0)
+
+    def test_order_history(self):
+        self.brew_orders(self.get_fleet(size=1))
+        events = list(EventLog(self.path).read())
+        self.assertEqual([event.kind for event in events[:4]], ["brew", "brew", "batch_cup", "batch_cup"])
+        self.assertEqual(events[3].coffee.coffee_type, "americano")
+        self.assertEqual(events[3].batch_size, 2)
+        self.assertTrue(events[0].served)
+        self.assertEqual(events[-1].machine_id, 0)
+
+
+class RefillPredictor_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def setUp(self):
+        super(RefillPredictor_Test, self).setUp()
+        self.now = 0.0
+        self.predictor = RefillPredictor(half_life=600.0, warmup=60.0, clock=lambda: self.now)
+        self.fleet = CoffeeMachineFleet(size=1, predictor=self.predictor)
+
+    def order(self, coffee_type, count, interval):
+        coffee = Coffee.objects.get(coffee_type=coffee_type)
+        for _ in range(count):
+            self.now += interval
+            self.assertNotIsInstance(self.fleet.make_coffee(coffee), dict)
+            self.fleet.refill_water_tank()
+
+    def get_prediction(self, resource):
+        return [prediction for prediction in self.fleet.get_maintenance_schedule()
+                if prediction["resource"] == resource][0]
+
+    def test_without_orders_nothing_is_consumed(self):
+        schedule = self.fleet.get_maintenance_schedule()
+        self.assertEqual(len(schedule), 4)
+        self.assertTrue(all(prediction["seconds_left"] is None for prediction in schedule))
+        self.assertEqual(self.fleet.get_maintenance_schedule(horizon=3600), [])
+
+    def test_time_to_full_trash_bin(self):
+        self.order("espresso", 3, 60.0)
+        trash = self.get_prediction("trash")
+        self.assertEqual(trash["level"], TrashBin.CAPACITY - 3)
+        self.assertTrue(60 <= trash["rate_per_hour"] <= 100)
+        self.assertAlmostEqual(trash["seconds_left"], trash["level"] * 3600 / trash["rate_per_hour"])
+        self.assertIsNone(self.get_prediction("milk")["seconds_left"])
+
+    def test_recipe_mix_changes_prediction(self):
+        self.order("espresso", 2, 60.0)
+        self.assertIsNone(self.get_prediction("milk")["seconds_left"])
+        espresso = self.get_prediction("water")["rate_per_hour"]
+        self.order("latte", 1, 60.0)
+        self.assertIsNotNone(self.get_prediction("milk")["seconds_left"])
+        self.assertGreater(self.get_prediction("water")["rate_per_hour"], espresso)
+
+    def test_recent_orders_weigh_more(self):
+        self.order("espresso", 3, 10.0)
+        busy = self.get_prediction("trash")["rate_per_hour"]
+        self.now += 1800
+        self.assertLess(self.get_prediction("trash")["rate_per_hour"], busy / 4)
+
+    def test_most_urgent_first(self):
+        self.order("espresso", 2, 30.0)
+        self.fleet.machines[0].mechanism.coffee_grinder.coffee_tank.content_level = 30
+        schedule = self.fleet.get_maintenance_schedule()
+        self.assertEqual(schedule[0]["resource"], "beans")
+        self.assertEqual(schedule[-1]["resource"], "milk")
+        seconds = [prediction["seconds_left"] for prediction in schedule[:-1]]
+        self.assertEqual(seconds, sorted(seconds))
+
+    def test_maintenance_view(self):
+        self.patch_fleet()
+        response = self.client.get("/maintenance/")
+        self.assertEqual(len(response.json()["schedule"]), 4)
+        self.assertEqual(self.client.get("/maintenance/?horizon=soon").status_code, 400)
+
+
+class Clock_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_instant_by_default(self):
+        self.assertIsInstance(get_clock(), InstantClock)
+
+    def test_clock_from_settings(self):
+        with override_settings(COFFEE_MACHINE_CLOCK="scaled", COFFEE_MACHINE_CLOCK_SPEED=1000):
+            self.assertIsInstance(get_clock(), ScaledClock)
+            self.assertEqual(get_clock().speed, 1000)
+        self.assertIsInstance(get_clock(), InstantClock)
+        with self.assertRaises(ValueError):
+            create_clock("sundial")
+
+    def test_devices_wait_for_clock(self):
+        clock = mock.Mock(wraps=InstantClock())
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        for device in (brew_mechanism.water_heater, brew_mechanism.coffee_grinder, brew_mechanism.pressure_pump):
+            device.clock = clock
+        self.assertNotIsInstance(brew_mechanism.make_coffee(Coffee.objects.get(coffee_type="espresso")), dict)
+        waits = [call[0][0] for call in clock.wait.call_args_list]
+        self.assertIn(CoffeeGrinder.PROCESS_TIME, waits)
+        self.assertIn(PressurePump.PROCESS_TIME, waits)
+        self.assertIn(WaterHeater.PROCESS_TIME, waits)
+
+    def test_scaled_clock(self):
+        pump = PressurePump()
+        pump.clock = ScaledClock(speed=1000)
+        start = time.time()
+        self.assertTrue(pump.run_process())
+        self.assertGreaterEqual(time.time() - start, PressurePump.PROCESS_TIME / 1000.0 * 0.9)
+        pump.clock.stop()
+        self.assertFalse(pump.clock.wait(3600))
+
+
+class RecordingClock(InstantClock):
+    def __init__(self):
+        self.sleeps = []
+        self.waits = []
+
+    def wait(self, seconds):
+        self.waits.append(seconds)
+        return True
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        return await super(RecordingClock, self).sleep(seconds)
+
+
+class EventLoopMixin(object):
+    """
+    Gives each test own event loop
+    """
+
+    def setUp(self):
+        super(EventLoopMixin, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+class AsyncMechanism_Test(EventLoopMixin, MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_same_result_as_blocking_mechanism(self):
+        for coffee_type in ("espresso", "americano", "latte"):
+            coffee = Coffee.objects.get(coffee_type=coffee_type)
+            brew_mechanism = CoffeeBrewMechanism.create_standalone()
+            async_mechanism = AsyncCoffeeBrewMechanism(clock=RecordingClock())
+            self.assertEqual(self.run_async(async_mechanism.make_coffee(coffee)), brew_mechanism.make_coffee(coffee))
+            self.assertEqual(get_snapshot(async_mechanism.mechanism), get_snapshot(brew_mechanism))
+
+    def test_sleeps_for_device_processes(self):
+        clock = RecordingClock()
+        async_mechanism = AsyncCoffeeBrewMechanism(clock=clock)
+        self.run_async(async_mechanism.make_coffee(Coffee.objects.get(coffee_type="espresso")))
+        self.assertIn(CoffeeGrinder.PROCESS_TIME, clock.sleeps)
+        self.assertIn(PressurePump.PROCESS_TIME, clock.sleeps)
+        self.assertGreater(sum(clock.sleeps), CoffeeGrinder.PROCESS_TIME + PressurePump.PROCESS_TIME)
+
+    def test_devices_are_shared_with_blocking_code(self):
+        fleet = CoffeeMachineFleet(size=1)
+        async_fleet = AsyncCoffeeMachineFleet(fleet, clock=RecordingClock())
+        self.run_async(async_fleet.make_coffee(Coffee.objects.get(coffee_type="espresso")))
+        mechanism = fleet.machines[0].mechanism
+        self.assertIsNone(mechanism.coffee_grinder.clock)
+        clock = RecordingClock()
+        with mock.patch("coffemachine.machine.devices.get_clock", return_value=clock):
+            self.assertEqual(fleet.make_coffee(Coffee.objects.get(coffee_type="espresso")), ESPRESSO_IMAGE)
+        self.assertIn(CoffeeGrinder.PROCESS_TIME, clock.waits)
+        self.assertEqual(fleet.machines[0].served, 2)
+
+    def test_machine_with_store_sleeps_after_state_is_saved(self):
+        descriptor, path = tempfile.mkstemp()
+        os.close(descriptor)
+        self.addCleanup(os.remove, path)
+        store = MmapStateStore(path, slots=1)
+        self.addCleanup(store.close)
+        fleet = CoffeeMachineFleet(size=1, store=store)
+        clock = RecordingClock()
+        async_fleet = AsyncCoffeeMachineFleet(fleet, clock=clock)
+        stages = []
+        status = self.run_async(async_fleet.make_coffee(Coffee.objects.get(coffee_type="espresso"),
+                                                        lambda stage, data: stages.append(stage)))
+        self.assertEqual(status, ESPRESSO_IMAGE)
+        self.assertEqual(stages[-1], BrewContext.DONE)
+        self.assertIn(CoffeeGrinder.PROCESS_TIME, clock.sleeps)
+        self.assertEqual(store.read(0, CoffeeBrewMechanism.create_standalone())[1]["trash"], 1)
+
+    def test_orders_wait_concurrently(self):
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        clock = ScaledClock(speed=2000)
+        single = AsyncCoffeeBrewMechanism(clock=clock)
+        start = time.time()
+        self.run_async(single.make_coffee(espresso))
+        duration = time.time() - start
+        fleet = AsyncCoffeeMachineFleet(CoffeeMachineFleet(size=4), clock=clock)
+        start = time.time()
+        results = self.run_async(asyncio.gather(*[fleet.make_coffee(espresso) for _ in range(4)]))
+        self.assertLess(time.time() - start, duration * 3)
+        self.assertFalse(any(isinstance(status, dict) for status in results))
+        self.assertEqual([machine.served for machine in fleet.fleet.machines], [1, 1, 1, 1])
+        self.assertEqual([machine.pending for machine in fleet.fleet.machines], [0, 0, 0, 0])
+
+    def test_batch(self):
+        fleet = AsyncCoffeeMachineFleet(CoffeeMachineFleet(size=1), clock=RecordingClock())
+        results = self.run_async(fleet.make_batch([Coffee.objects.get(coffee_type="espresso")] * 2))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(fleet.fleet.machines[0].served, 2)
+
+    def test_dispatch_does_not_block_event_loop(self):
+        fleet = AsyncCoffeeMachineFleet(CoffeeMachineFleet(size=1), clock=RecordingClock())
+        threads = []
+        dispatch = fleet.fleet.dispatch
+
+        def record_thread(*args):
+            threads.append(threading.current_thread())
+            return dispatch(*args)
+
+        with mock.patch.object(fleet.fleet, "dispatch", side_effect=record_thread):
+            self.run_async(fleet.make_coffee(Coffee.objects.get(coffee_type="espresso")))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+
+class ASGI_Test(EventLoopMixin, MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def request(self, application, method, path, body=b"", headers=()):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": b"", "headers": list(headers)}
+        self.run_async(application(scope, receive, send))
+        return messages[0]["status"], b"".join(message.get("body", b"") for message in messages[1:])
+
+    def get_application(self):
+        # views read recipes in executor, in-memory test database is locked for other threads during test
+        recipe_cache.get_all()
+        fleet = CoffeeMachineFleet(size=1)
+        application = CoffeeMachineASGI(fleet, mock.Mock(side_effect=self.wsgi_application), workers=1)
+        application.fleet.brewers[0].clock = RecordingClock()
+        self.addCleanup(application.executor.shutdown)
+        return application
+
+    def wsgi_application(self, environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/html")])
+        return [environ["PATH_INFO"].encode()]
+
+    def order(self, application, token="x" * 32, headers=()):
+        return self.request(application, "POST", "/", b"coffee_type=espresso", [
+            (b"content-type", b"application/x-www-form-urlencoded"),
+            (b"x-requested-with", b"XMLHttpRequest"),
+            (b"cookie", ("csrftoken=%s" % ("x" * 32)).encode()),
+            (b"x-csrftoken", token.encode()),
+        ] + list(headers))
+
+    def test_ajax_order_is_brewed_by_coroutine(self):
+        application = self.get_application()
+        status, body = self.order(application)
+        self.assertEqual(status, 200, body)
+        self.assertEqual(json.loads(body.decode()), {"status": Order.DONE, "image": ESPRESSO_IMAGE})
+        self.assertEqual(application.fleet.fleet.machines[0].served, 1)
+        application.wsgi_application.assert_not_called()
+
+    def test_csrf_is_checked(self):
+        status, _ = self.order(self.get_application(), token="y" * 32)
+        self.assertEqual(status, 403)
+
+    def test_retry_with_idempotency_key(self):
+        self.addCleanup(idempotency_keys.clear)
+        application = self.get_application()
+        headers = [(b"idempotency-key", uuid.uuid4().hex.encode())]
+        first = self.order(application, headers=headers)
+        self.assertEqual(self.order(application, headers=headers), first)
+        self.assertEqual(application.fleet.fleet.machines[0].served, 1)
+
+    def test_other_requests_go_to_wsgi(self):
+        self.assertEqual(self.request(self.get_application(), "GET", "/fleet/"), (200, b"/fleet/"))
+
+
+class BrewEvents_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def brew(self, coffee_type, brew_mechanism=None):
+        events = []
+        brew_mechanism = brew_mechanism or CoffeeBrewMechanism.create_standalone()
+        brew_mechanism.make_coffee(Coffee.objects.get(coffee_type=coffee_type), lambda *event: events.append(event))
+        return events
+
+    def test_stages_of_espresso(self):
+        self.assertEqual([stage for stage, _ in self.brew("espresso")], [
+            BrewContext.TRASH, BrewContext.GRINDING, BrewContext.BOILING, BrewContext.PRESSURE, BrewContext.DONE,
+        ])
+
+    def test_stages_of_latte(self):
+        stages = [stage for stage, _ in self.brew("latte")]
+        self.assertEqual(stages[-2:], [BrewContext.MILK, BrewContext.DONE])
+
+    def test_failed_stage(self):
+        brew_mechanism = CoffeeBrewMechanism.create_standalone()
+        brew_mechanism.coffee_grinder.coffee_tank.content_level = 1
+        events = self.brew("espresso", brew_mechanism)
+        self.assertEqual([stage for stage, _ in events], [BrewContext.TRASH, BrewContext.GRINDING, BrewContext.FAILED])
+        self.assertEqual(events[1][1], {
+            "errors": [CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND],
+            "error_code": ERROR_CODES[CoffeeGrinder.ERROR_NOT_ENOUGH_BEANS_TO_GRIND],
+        })
+
+    def test_start_wakes_up_readers(self):
+        order = Order(Coffee.objects.get(coffee_type="espresso"))
+        events = order.iter_events(timeout=5)
+        timer = threading.Timer(0.05, order.start)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.time()
+        self.assertIsNone(next(events))
+        self.assertLess(time.time() - start, 4)
+        self.assertEqual(order.status, Order.BREWING)
+
+    def test_order_events(self):
+        order = Order(Coffee.objects.get(coffee_type="espresso"))
+        order.add_event(BrewContext.TRASH, {})
+        events = order.iter_events(timeout=0.01)
+        self.assertEqual(next(events), (BrewContext.TRASH, {}))
+        self.assertIsNone(next(events))
+        order.add_event(BrewContext.GRINDING, {})
+        order.finish(ESPRESSO_IMAGE)
+        self.assertEqual(list(events), [(BrewContext.GRINDING, {})])
+
+    def test_events_view(self):
+        self.patch_fleet()
+        data = self.client.post("/", {"coffee_type": "latte"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest").json()
+        response = self.client.get(data["events_url"])
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = b"".join(response.streaming_content).decode()
+        messages = [message.split("\n") for message in stream.split("\n\n") if message]
+        self.assertEqual(messages[0][0], "event: stage")
+        self.assertEqual(json.loads(messages[0][1][len("data: "):]), {"stage": BrewContext.TRASH})
+        self.assertIn("event: stage", messages[-2])
+        self.assertEqual(messages[-1][0], "event: done")
+        self.assertEqual(json.loads(messages[-1][1][len("data: "):])["image"], LATTE_IMAGE)
+        self.assertEqual(self.client.get("/orders/%s/events/" % ("0" * 32)).status_code, 404)
+
+
+class Maintenance_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def drain(self, machine):
+        machine.mechanism.water_heater.water_tank.content_level = 1
+        machine.mechanism.milk_heater.milk_tank.content_level = 1
+        machine.mechanism.trash_bin.current_level = TrashBin.CAPACITY
+
+    def test_service_selected_machines(self):
+        fleet = CoffeeMachineFleet(size=3)
+        for machine in fleet.machines:
+            self.drain(machine)
+        results = fleet.maintain(["service"], [2, 0])
+        self.assertEqual(len(results), 8)
+        self.assertEqual({result["machine"] for result in results}, {0, 2})
+        self.assertTrue(all(result["status"] == "done" for result in results))
+        for machine_id, full in ((0, True), (1, False), (2, True)):
+            mechanism = fleet.machines[machine_id].mechanism
+            self.assertEqual(mechanism.water_heater.water_tank.content_level == WaterTank.CAPACITY, full)
+            self.assertEqual(mechanism.trash_bin.current_level == 0, full)
+
+    def test_unknown_operation_or_machine(self):
+        fleet = CoffeeMachineFleet(size=2)
+        with self.assertRaises(ValueError):
+            fleet.maintain(["paint_machine"])
+        with self.assertRaises(ValueError):
+            fleet.maintain(["fill_milk"], [2])
+
+    def test_failed_machine_does_not_stop_others(self):
+        fleet = CoffeeMachineFleet(size=2)
+        with mock.patch.object(fleet.machines[0], "maintain", side_effect=StateConflict("busy")):
+            results = fleet.maintain(["remove_trash_bin"])
+        self.assertEqual([result["status"] for result in results], ["failed", "done"])
+        self.assertEqual(results[0]["error"], "busy")
+
+    def test_machine_error_does_not_stop_others(self):
+        fleet = CoffeeMachineFleet(size=3)
+        with mock.patch.object(fleet.machines[0], "maintain", side_effect=DatabaseError("database is locked")), \
+                mock.patch.object(fleet.machines[1], "maintain", side_effect=IOError("disk full")):
+            results = fleet.refill_water_tank()
+        self.assertEqual([result["status"] for result in results], ["failed", "failed", "done"])
+        self.assertEqual([result["error"] for result in results], ["database is locked", "disk full", None])
+
+    def test_legacy_action_reports_failure(self):
+        fleet = self.patch_fleet(size=2)
+        self.assertEqual(self.client.post("/ajax/", {"method": "milk_options"}).json(),
+                         {"action": "Milk successfully refiled"})
+        with mock.patch.object(fleet.machines[1], "maintain", side_effect=StateConflict("busy")):
+            response = self.client.post("/ajax/", {"method": "milk_options"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual([result["machine"] for result in response.json()["results"]], [1])
+
+    def test_bulk_view(self):
+        fleet = self.patch_fleet(size=2)
+        self.drain(fleet.machines[1])
+        response = self.client.post("/ajax/", {"operation": ["fill_milk", "remove_trash_bin"], "machine": ["1"]})
+        results = response.json()["results"]
+        self.assertEqual([(result["machine"], result["operation"]) for result in results],
+                         [(1, "fill_milk"), (1, "remove_trash_bin")])
+        self.assertEqual(fleet.machines[1].mechanism.trash_bin.current_level, 0)
+        self.assertEqual(self.client.post("/ajax/", {"operation": "service", "machine": "5"}).status_code, 400)
+
+    def test_unknown_method(self):
+        response = self.client.post("/ajax/", {"method": "paint_options"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "NotImplemented method"})
+
+
+class Assets_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings_override = override_settings(COFFEE_MACHINE_ASSETS_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_build_is_reproducible(self):
+        manifest = build_assets()
+        self.assertEqual(build_assets(), manifest)
+        hashed_name = manifest["js/machine.js"]
+        self.assertRegex(hashed_name, r"^js/machine\.[0-9a-f]{12}\.js$")
+        with open(os.path.join(self.root, hashed_name + ".gz"), "rb") as compressed:
+            self.assertEqual(compressed.read(), compress_gzip(read_sources(BUNDLES["js/machine.js"])))
+
+    def test_bundle_links_versioned_static_files(self):
+        with open(os.path.join(self.root, build_assets()["css/machine.css"]), "rb") as bundle:
+            content = bundle.read()
+        self.assertNotIn(b"sourceMappingURL", content)
+        self.assertRegex(content, br'url\("/static/images/coffee_machine\.jpg\?v=[0-9a-f]{12}"\)')
+        self.assertIn(b'url("data:image/svg+xml', content)
+
+    def test_relative_urls_are_resolved(self):
+        content = rewrite_urls("css/style.css", b"a{background:url(../images/latte.png)}")
+        self.assertRegex(content, br'^a\{background:url\("/static/images/latte\.png\?v=[0-9a-f]{12}"\)\}$')
+        self.assertEqual(rewrite_urls("css/style.css", b"a{background:url(https://example.com/a.png)}"),
+                         b"a{background:url(https://example.com/a.png)}")
+        with self.assertRaises(ValueError):
+            rewrite_urls("css/style.css", b"a{background:url('missing.png')}")
+
+    def test_page_links_sources_without_build(self):
+        content = Client().get("/").content.decode()
+        self.assertIn("/static/js/jquery-3.3.1.min.js", content)
+        self.assertIn("/static/css/style.css", content)
+
+    def test_page_links_built_bundles(self):
+        manifest = build_assets()
+        content = Client().get("/").content.decode()
+        self.assertIn("/assets/%s" % manifest["css/machine.css"], content)
+        self.assertNotIn("/static/js/", content)
+
+    def test_precompressed_variant(self):
+        url = "/assets/%s" % build_assets()["js/machine.js"]
+        response = Client().get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn(b"jQuery", gzip.decompress(b"".join(response.streaming_content)))
+        response = Client().get(url, HTTP_ACCEPT_ENCODING="gzip;q=0")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_unknown_asset(self):
+        build_assets()
+        self.assertEqual(Client().get("/assets/js/other.0123456789ab.js").status_code, 404)
+
+
+class Lifecycle_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def test_warm_up(self):
+        self.assertGreater(warm_up(), 0)
+        self.assertIn("coffee_machine_warm_up_seconds", registry.render())
+
+    def test_reinit_replaces_held_locks(self):
+        mechanism = views.fleet.machines[0].mechanism
+        held = [mechanism.water_heater.lock, mechanism.coffee_grinder.coffee_tank.lock, views.fleet._dispatch_lock]
+        for lock in held:
+            lock.acquire()
+        try:
+            # in-memory test database is lost when connection is dropped
+            with mock.patch("coffemachine.machine.lifecycle.connections"):
+                reinit_after_fork()
+            self.assertTrue(mechanism.water_heater.lock.acquire(blocking=False))
+            mechanism.water_heater.lock.release()
+            self.assertFalse(mechanism.coffee_grinder.coffee_tank.lock.locked())
+            self.assertFalse(views.fleet._dispatch_lock.locked())
+        finally:
+            for lock in held:
+                lock.release()
+
+    @skipIf(not hasattr(os, "fork"), "fork is not available")
+    def test_child_brews_when_parent_thread_holds_lock(self):
+        espresso = Coffee.objects.get(coffee_type="espresso")
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with mechanism.pressure_pump.lock:
+                locked.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                reinit_after_fork()
+                mechanism.reinit_after_fork()
+                os._exit(0 if mechanism.make_coffee(espresso) == ESPRESSO_IMAGE else 1)
+            finally:
+                os._exit(2)
+        release.set()
+        thread.join()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+
+class RecipePipeline_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def add_flat_white(self):
+        coffee = Coffee.objects.create(coffee_type="flat_white", beans="Arabica", coffee_quantity=120, size=120,
+                                     extra_quantity=None, contains_milk=True, time_preparing=10,
+                                     steps="grind,pump,boil,lather")
+        # transaction of test is never committed, so cache is not invalidated by signal
+        recipe_cache.invalidate()
+        return coffee
+
+    def test_parse_steps(self):
+        self.assertEqual(parse_steps("grind, boil,pump,lather"), ("grind", "boil", "pump", "lather"))
+        for steps in ("grind,boil", "grind,boil,pump,pump", "grind,boil,pump,foam", "grind,boil,lather,pump"):
+            with self.assertRaises(ValueError):
+                parse_steps(steps)
+
+    def test_pipeline_is_shared_and_immutable(self):
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        latte = recipe_cache.get("latte")
+        pipeline = mechanism.get_method_for_coffee(latte)
+        self.assertIs(mechanism.get_method_for_coffee(latte), pipeline)
+        self.assertIs(compile_recipe("grind,boil,pump,lather"), pipeline)
+        self.assertTrue(pipeline.LATHER_MILK)
+        with self.assertRaises(AttributeError):
+            pipeline.IMAGE = ESPRESSO_IMAGE
+
+    def test_invalid_steps_are_rejected_by_model(self):
+        coffee = Coffee(coffee_type="cappuccino", beans="Arabica", coffee_quantity=120, size=120,
+                        time_preparing=10, steps="grind,lather")
+        with self.assertRaises(ValidationError):
+            coffee.full_clean()
+
+    def test_steps_need_their_fields(self):
+        coffee = Coffee(coffee_type="long_black", beans="Arabica", coffee_quantity=120, size=120,
+                        time_preparing=10, steps="grind,boil,pump,extra_water")
+        with self.assertRaises(ValidationError) as raised:
+            coffee.full_clean()
+        self.assertIn("extra_quantity", raised.exception.message_dict)
+        coffee.extra_quantity = 100
+        coffee.full_clean()
+        coffee.contains_milk = True
+        with self.assertRaises(ValidationError) as raised:
+            coffee.full_clean()
+        self.assertIn("contains_milk", raised.exception.message_dict)
+        coffee.steps = ""
+        with self.assertRaises(ValidationError) as raised:
+            coffee.full_clean()
+        self.assertIn("steps", raised.exception.message_dict)
+
+    def test_new_drink_without_code(self):
+        self.add_flat_white()
+        flat_white = recipe_cache.get("flat_white")
+        events = []
+        status = CoffeeBrewMechanism.create_standalone().make_coffee(
+            flat_white, lambda stage, data: events.append(stage))
+        self.assertEqual(status, LATTE_IMAGE)
+        self.assertEqual(events, [BrewContext.TRASH, BrewContext.GRINDING, BrewContext.PRESSURE, BrewContext.BOILING,
+                                  BrewContext.MILK, BrewContext.DONE])
+        response = Client().post("/batch/", {"coffee_type": ["flat_white", "espresso"]},
+                                 HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Flat White", Client().get("/").content.decode())
+
+    def test_new_drink_in_event_log(self):
+        self.add_flat_white()
+        flat_white = recipe_cache.get("flat_white")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        log = EventLog(os.path.join(directory, "machines.log"))
+        mechanism = CoffeeBrewMechanism.create_standalone()
+        log.record(0, mechanism, EventLog.BREW, [flat_white], [mechanism.make_coffee(flat_white)])
+        log.close()
+        coffee = next(log.read()).coffee
+        self.assertEqual(coffee.coffee_type, "other")
+        self.assertEqual(coffee.steps, "grind,boil,pump,lather")
+        replayed = CoffeeBrewMechanism.create_standalone()
+        log.recover({0: replayed})
+        self.assertEqual(replayed.milk_heater.milk_tank.content_level, mechanism.milk_heater.milk_tank.content_level)
+
+
+class Idempotency_Test(MachineTestCases):
+    fixtures = ['coffee.json']
+
+    def setUp(self):
+        super(Idempotency_Test, self).setUp()
+        idempotency_keys.clear()
+        self.addCleanup(idempotency_keys.clear)
+
+    def create_client(self, csrf_token="a" * 32):
+        self.client = Client()
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = csrf_token
+
+    def order(self, key, coffee_type="espresso"):
+        return self.client.post("/", {"coffee_type": coffee_type}, HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+                                HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_gets_the_same_order(self):
+        fleet = self.patch_fleet()
+        key = uuid.uuid4().hex
+        first = self.order(key)
+        views.orders.get(first.json()["ticket"]).wait(5)
+        retry = self.order(key)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(fleet.machines[0].mechanism.trash_bin.current_level, 1)
+        self.assertNotEqual(self.order(uuid.uuid4().hex).json()["ticket"], first.json()["ticket"])
+
+    def test_retry_of_batch(self):
+        fleet = self.patch_fleet()
+        key = uuid.uuid4().hex
+        first = self.client.post("/batch/", {"coffee_type": ["espresso", "latte"]}, HTTP_IDEMPOTENCY_KEY=key)
+        retry = self.client.post("/batch/", {"coffee_type": ["espresso", "latte"]}, HTTP_IDEMPOTENCY_KEY=key)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(fleet.machines[0].served, 2)
+
+    def test_key_of_different_order(self):
+        self.patch_fleet()
+        key = uuid.uuid4().hex
+        self.order(key)
+        self.assertEqual(self.order(key, coffee_type="latte").status_code, 422)
+
+    def test_key_is_scoped_by_client(self):
+        self.patch_fleet()
+        key = uuid.uuid4().hex
+        first = self.order(key).json()["ticket"]
+        self.create_client(csrf_token="b" * 32)
+        response = self.order(key)
+        self.assertFalse(response.has_header("Idempotent-Replayed"))
+        self.assertNotEqual(response.json()["ticket"], first)
+
+    def test_invalid_key(self):
+        self.assertEqual(self.order("not a key").status_code, 400)
+        self.assertEqual(self.order("x" * 31).status_code, 400)
+        self.assertEqual(self.order("x" * 65).status_code, 400)
+
+    def test_full_queue_is_not_remembered(self):
+        self.patch_fleet()
+        key = uuid.uuid4().hex
+        with mock.patch.object(views.orders, "submit", side_effect=OrderQueueFull("Too many orders")):
+            self.assertEqual(self.order(key).status_code, 503)
+        self.assertIn("ticket", self.order(key).json())
+
+    def test_request_in_progress(self):
+        cache = IdempotencyCache()
+        self.assertIsNone(cache.begin("key", "order"))
+        with self.assertRaises(IdempotencyConflict):
+            cache.begin("key", "order")
+        with self.assertRaises(IdempotencyKeyReused):
+            cache.begin("key", "other order")
+        cache.abandon("key")
+        self.assertIsNone(cache.begin("key", "order"))
+
+    def test_keys_expire_and_are_bounded(self):
+        now = [0]
+        cache = IdempotencyCache(maxsize=2, ttl=10, timer=lambda: now[0])
+        for key in ("first", "second"):
+            cache.begin(key, "order")
+            cache.complete(key, JsonResponse({"key": key}))
+        self.assertEqual(cache.begin("first", "order").content, b'{"key": "first"}')
+        cache.begin("third", "order")
+        cache.complete("third", JsonResponse({"key": "third"}))
+        self.assertIsNone(cache.begin("second", "order"))
+        self.assertEqual(cache.begin("third", "order").content, b'{"key": "third"}')
+        now[0] = 10
+        self.assertIsNone(cache.begin("third", "order"))
+        self.assertEqual(cache.get_stats(), {"size": 1, "maxsize": 2, "hits": 2, "misses": 5})
@@ -1,9 +1,22 @@
 # Django imports
-from coffemachine.machine.views import CoffeeMachineView, CoffeeExtraOptionsAjaxView
+from coffemachine.machine.views import CoffeeMachineView, CoffeeExtraOptionsAjaxView, CoffeeFleetStatusAjaxView, \
+    CoffeeOrderStatusAjaxView, CoffeeBatchAjaxView, CoffeeAvailabilityAjaxView, MetricsView, \
+    CoffeeMaintenanceAjaxView, CoffeeOrderEventsView, CoffeeErrorsAjaxView, AssetView
 from django.conf.urls import url
 
 urlpatterns = [
     url(r'^$', CoffeeMachineView.as_view(), {'template_name': CoffeeMachineView.template_name},
         name=CoffeeMachineView.view_name),
     url(r'^ajax/$', CoffeeExtraOptionsAjaxView.as_view(), name=CoffeeExtraOptionsAjaxView.view_name),
+    url(r'^orders/(?P<ticket>[0-9a-f]{32})/$', CoffeeOrderStatusAjaxView.as_view(),
+        name=CoffeeOrderStatusAjaxView.view_name),
+    url(r'^orders/(?P<ticket>[0-9a-f]{32})/events/$', CoffeeOrderEventsView.as_view(),
+        name=CoffeeOrderEventsView.view_name),
+    url(r'^batch/$', CoffeeBatchAjaxView.as_view(), name=CoffeeBatchAjaxView.view_name),
+    url(r'^availability/$', CoffeeAvailabilityAjaxView.as_view(), name=CoffeeAvailabilityAjaxView.view_name),
+    url(r'^fleet/$', CoffeeFleetStatusAjaxView.as_view(), name=CoffeeFleetStatusAjaxView.view_name),
+    url(r'^maintenance/$', CoffeeMaintenanceAjaxView.as_view(), name=CoffeeMaintenanceAjaxView.view_name),
+    url(r'^errors/$', CoffeeErrorsAjaxView.as_view(), name=CoffeeErrorsAjaxView.view_name),
+    url(r'^assets/(?P<path>[\w/-]+\.[0-9a-f]{12}\.(?:css|js))$', AssetView.as_view(), name=AssetView.view_name),
+    url(r'^metrics/$', MetricsView.as_view(), name=MetricsView.view_name),
 ]
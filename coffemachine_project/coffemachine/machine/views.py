@@ -1,15 +1,59 @@
-from django.http import JsonResponse
+import json
+import os
+
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, FileResponse
 from django.shortcuts import render
+from django.urls import reverse
+from django.utils.decorators import method_decorator
 
 # Create your views here.
-from django.template.loader import render_to_string
 from django.views import View
 
-from coffemachine.machine.handler import CoffeeBrewMechanism
-from coffemachine.machine.forms import CoffeeChoiceForm
-from coffemachine.machine.models import Coffee
+from coffemachine.machine.assets import get_manifest, find_variant, get_content_type
+from coffemachine.machine.errors import encode_errors, get_error_table
+from coffemachine.machine.eventlog import get_event_log
+from coffemachine.machine.fleet import CoffeeMachineFleet
+from coffemachine.machine.forms import CoffeeChoiceForm, CoffeeBatchForm, MaintenanceForm
+from coffemachine.machine.fragments import render_problems
+from coffemachine.machine.idempotency import idempotent
+from coffemachine.machine.maintenance import RefillPredictor
+from coffemachine.machine.metrics import registry, Gauge
+from coffemachine.machine.orders import OrderQueue, OrderQueueFull, Order
+from coffemachine.machine.recipes import recipe_cache
+from coffemachine.machine.state import get_state_store
+
+fleet = CoffeeMachineFleet(size=getattr(settings, "COFFEE_MACHINE_FLEET_SIZE", 1), store=get_state_store(),
+                           journal=get_event_log(),
+                           predictor=RefillPredictor(getattr(settings, "COFFEE_MACHINE_CONSUMPTION_HALF_LIFE", 3600)))
+orders = OrderQueue(
+    fleet,
+    workers=getattr(settings, "COFFEE_MACHINE_ORDER_WORKERS", 2),
+    maxsize=getattr(settings, "COFFEE_MACHINE_ORDER_QUEUE_SIZE", 100),
+)
+
+
+def get_tank_levels():
+    """
+    :return: list of pairs: labels and level of each tank in fleet
+    """
+    levels = []
+    for machine in fleet.machines:
+        machine_levels = machine.availability.get_levels()
+        for tank in ("water", "beans", "milk"):
+            levels.append(({"machine": machine.machine_id, "tank": tank}, machine_levels[tank]))
+    return levels
+
+
+def get_trash_levels():
+    """
+    :return: list of pairs: labels and current level of trash bin of each machine in fleet
+    """
+    return [({"machine": machine.machine_id}, machine.mechanism.trash_bin.current_level) for machine in fleet.machines]
+
 
-mechanism = CoffeeBrewMechanism()
+registry.register(Gauge("coffee_machine_tank_level", "Current level of each tank", get_tank_levels))
+registry.register(Gauge("coffee_machine_trash_level", "Current level of trash bin", get_trash_levels))
 
 
 class CoffeeMachineView(View):
@@ -39,16 +83,16 @@ class CoffeeMachineView(View):
         self.common_steps(request)
         return render(request, self.template_name, self.kwargs)
 
+    @method_decorator(idempotent)
     def post(self, request, *args, **kwargs):
         """
-        Handling ajax request
-        :return: JsonResponse which contains image path if making coffee was successfully,
-        otherwise contains html with each errors
+        Handling ajax request, retry with the same idempotency key gets ticket of the first order
+        :return: JsonResponse which contains ticket of queued order and url to check its status
         """
         self.common_steps(request)
         if request.is_ajax():
             if self._handle_form():
-                return JsonResponse(self.json_kwargs)
+                return JsonResponse(self.json_kwargs, status=self.json_status)
         return render(request, self.template_name, self.kwargs)
 
     def _init_kwargs(self):
@@ -56,6 +100,7 @@ class CoffeeMachineView(View):
             "title": self.title
         }
         self.json_kwargs = {}
+        self.json_status = 200
 
     def _update_kwargs(self, dictionary):
         if dictionary:
@@ -72,61 +117,276 @@ class CoffeeMachineView(View):
 
     def _handle_form(self):
         """
-        Method checks if form is valid. If it successfully get coffee object from db.
-        Execute  making coffee, if successfully add to response kwargs path to image.
-        Otherwise render template with problems
+        Method checks if form is valid. If it successfully get coffee recipe from cache.
+        If no machine is able to brew coffee, add to response kwargs html with problems without touching devices.
+        Otherwise put order of coffee to queue, if successfully add to response kwargs ticket of order.
         :return: True if form is valid, otherwise False
         """
         if self.form.is_valid():
-            coffee = Coffee.objects.get(coffee_type=self.form.cleaned_data["coffee_type"])
-            status = mechanism.make_coffee(coffee)
-            if isinstance(status, dict):
-                html = render_to_string("core/problem.html", {"problems": status.keys()})
-                self.json_kwargs["problems"] = html
+            coffee = recipe_cache.get(self.form.cleaned_data["coffee_type"])
+            errors = fleet.get_unavailable_errors(coffee)
+            if errors:
+                self.json_kwargs.update({
+                    "status": Order.FAILED,
+                    "problems": render_problems(errors),
+                    "error_code": encode_errors(errors),
+                })
                 return True
-            self.json_kwargs["image"] = status
+            try:
+                order = orders.submit(coffee)
+            except OrderQueueFull as e:
+                self.json_kwargs["error"] = str(e)
+                self.json_status = 503
+                return True
+            self.json_kwargs.update({
+                "ticket": order.ticket,
+                "status": order.status,
+                "status_url": reverse("machine:%s" % CoffeeOrderStatusAjaxView.view_name, args=[order.ticket]),
+                "events_url": reverse("machine:%s" % CoffeeOrderEventsView.view_name, args=[order.ticket]),
+            })
             return True
         return False
 
 
+def get_order_status(order):
+    """
+    :param order: (Order) - queued order
+    :return: dict with status of order, path to image if order is done or html and code of errors if order failed
+    """
+    response = {
+        "ticket": order.ticket,
+        "status": order.status,
+    }
+    if order.status == Order.DONE:
+        response["image"] = order.result
+    elif order.status == Order.FAILED:
+        response["problems"] = render_problems(order.result)
+        response["error_code"] = encode_errors(order.result)
+    return response
+
+
+def format_event(event, data):
+    """
+    :return: Server-Sent Event with given name and data encoded as JSON
+    """
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+
+
+class CoffeeOrderStatusAjaxView(View):
+    """
+    Ajax view returns status of queued order. Finished order contains path to image,
+    failed order contains html with each errors.
+    """
+    view_name = "order_status"
+
+    def get(self, request, ticket, *args, **kwargs):
+        order = orders.get(ticket)
+        if order is None:
+            return JsonResponse({"error": "Unknown ticket"}, status=404)
+        return JsonResponse(get_order_status(order))
+
+
+class CoffeeOrderEventsView(View):
+    """
+    Stream of Server-Sent Events with progress of queued order. Event "stage" is sent after each finished stage
+    of brew, last event is "done" or "failed" with the same data as status of order.
+
+    Attributes:
+        keepalive (int) - seconds without event after which comment is sent, so proxies keep connection open
+    """
+    view_name = "order_events"
+    keepalive = 15
+
+    def get(self, request, ticket, *args, **kwargs):
+        order = orders.get(ticket)
+        if order is None:
+            return JsonResponse({"error": "Unknown ticket"}, status=404)
+        response = StreamingHttpResponse(self._generate_events(order), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def _generate_events(self, order):
+        for event in order.iter_events(self.keepalive):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                stage, data = event
+                yield format_event("stage", dict(data, stage=stage))
+        yield format_event(order.status, get_order_status(order))
+
+
+class CoffeeBatchAjaxView(View):
+    """
+    Ajax view for brewing many coffees at once, e.g. order for whole office.
+    It returns JsonResponse with image path or html with errors for each ordered coffee.
+    Retry with the same idempotency key gets results of the first batch.
+    """
+    view_name = "coffee_batch"
+
+    @method_decorator(idempotent)
+    def post(self, request, *args, **kwargs):
+        form = CoffeeBatchForm(data=request.POST, max_size=getattr(settings, "COFFEE_MACHINE_BATCH_SIZE", None))
+        if not form.is_valid():
+            return JsonResponse({"errors": form.errors}, status=400)
+        coffee_types = form.cleaned_data["coffee_type"]
+        results = fleet.make_batch([recipe_cache.get(coffee_type) for coffee_type in coffee_types])
+        return JsonResponse({
+            "results": [self._generate_result(coffee_type, status)
+                        for coffee_type, status in zip(coffee_types, results)]
+        })
+
+    def _generate_result(self, coffee_type, status):
+        if isinstance(status, dict):
+            return {
+                "coffee_type": coffee_type,
+                "problems": render_problems(status),
+                "error_code": encode_errors(status),
+            }
+        return {
+            "coffee_type": coffee_type,
+            "image": status,
+        }
+
+
 class CoffeeExtraOptionsAjaxView(View):
     """
     Ajax view for handling operations like refill water, milk, beans or remove trash.
     If given method is in available methods, it return JsonResponse with proper message.
-    Otherwise return JsonResponse with error message
+    Otherwise return JsonResponse with error message.
+    Bulk request contains list of operations (e.g. refill_water_tank or service for all of them)
+    and optional list of machines, it returns result of each operation on each machine.
     """
     view_name = "extra_options"
 
     def post(self, request, *args, **kwargs):
+        if "operation" in request.POST:
+            return self.maintain(request)
         methods = {
             "beans_options": self.beans_refill,
             "water_options": self.water_refill,
             "milk_options": self.milk_refill,
             "trash_options": self.trash_remove
         }
-        method = request.POST.get("method")
+        method = methods.get(request.POST.get("method"))
 
         if method:
-            return methods.get(method)()
-        return JsonResponse({"error": "NotImplemented method"})
+            return method()
+        return JsonResponse({"error": "NotImplemented method"}, status=400)
 
-    def _generate_response(self, message):
+    def maintain(self, request):
+        form = MaintenanceForm(data=request.POST, machines=len(fleet))
+        if not form.is_valid():
+            return JsonResponse({"errors": form.errors}, status=400)
+        return JsonResponse({
+            "results": fleet.maintain(form.cleaned_data["operation"], form.cleaned_data["machine"] or None),
+        })
+
+    def _generate_response(self, message, results):
+        """
+        :param results: (list) - results of operation on each machine, see CoffeeMachineFleet.maintain
+        :return: JsonResponse with message, or with failed results and status 503 if any machine failed
+        """
+        failed = [result for result in results if result["status"] == "failed"]
+        if failed:
+            return JsonResponse({"error": "Operation failed, try again later", "results": failed}, status=503)
         return JsonResponse({
             "action": message,
         })
 
     def beans_refill(self):
-        mechanism.refill_beans_tank()
-        return self._generate_response("Beans successfully refiled")
+        return self._generate_response("Beans successfully refiled", fleet.refill_beans_tank())
 
     def water_refill(self):
-        mechanism.refill_water_tank()
-        return self._generate_response("Water successfully refiled")
+        return self._generate_response("Water successfully refiled", fleet.refill_water_tank())
 
     def milk_refill(self):
-        mechanism.milk_heater.fill_milk()
-        return self._generate_response("Milk successfully refiled")
+        return self._generate_response("Milk successfully refiled", fleet.fill_milk())
 
     def trash_remove(self):
-        mechanism.remove_trash_bin()
-        return self._generate_response("Trash throw away")
+        return self._generate_response("Trash throw away", fleet.remove_trash_bin())
+
+
+class CoffeeAvailabilityAjaxView(View):
+    """
+    Ajax view returns how many cups of each coffee can be brewed right now.
+    """
+    view_name = "coffee_availability"
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({
+            "coffees": fleet.get_availability(recipe_cache.get_all().values()),
+        })
+
+
+class CoffeeFleetStatusAjaxView(View):
+    """
+    Ajax view returns counters and throughput of each machine in fleet and summary of whole fleet.
+    """
+    view_name = "fleet_status"
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(fleet.get_stats())
+
+
+class CoffeeMaintenanceAjaxView(View):
+    """
+    Ajax view returns refills and trash removals ordered by predicted time left, the most urgent first.
+    Optional horizon parameter limits list to actions needed within given number of seconds.
+    """
+    view_name = "maintenance_schedule"
+
+    def get(self, request, *args, **kwargs):
+        try:
+            horizon = float(request.GET["horizon"]) if "horizon" in request.GET else None
+        except ValueError:
+            return JsonResponse({"error": "Horizon must be number of seconds"}, status=400)
+        return JsonResponse({"schedule": fleet.get_maintenance_schedule(horizon)})
+
+
+class CoffeeErrorsAjaxView(View):
+    """
+    Ajax view returns message of each error code. Clients fetch it once and decode error_code of failed orders,
+    which is sum of codes of all errors.
+    """
+    view_name = "coffee_errors"
+
+    def get(self, request, *args, **kwargs):
+        response = JsonResponse({"errors": get_error_table()})
+        response["Cache-Control"] = "max-age=86400"
+        return response
+
+
+class AssetView(View):
+    """
+    View serves bundles built by build_assets command. Name of bundle contains hash of its content,
+    so response is cached by browsers and proxies for a year without revalidation.
+    Precompressed variant is chosen by Accept-Encoding header, nothing is compressed on request.
+    """
+    view_name = "asset"
+    max_age = 365 * 24 * 60 * 60
+
+    def get(self, request, path, *args, **kwargs):
+        if path not in get_manifest().values():
+            return JsonResponse({"error": "Unknown asset"}, status=404)
+        variant, encoding = find_variant(path, request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if variant is None:
+            return JsonResponse({"error": "Unknown asset"}, status=404)
+        response = FileResponse(open(variant, "rb"), content_type=get_content_type(path))
+        response["Content-Length"] = os.path.getsize(variant)
+        response["Cache-Control"] = "public, max-age=%d, immutable" % self.max_age
+        response["Vary"] = "Accept-Encoding"
+        if encoding is not None:
+            response["Content-Encoding"] = encoding
+        return response
+
+
+class MetricsView(View):
+    """
+    View returns counters, latency histograms and levels of tanks in Prometheus text format.
+    """
+    view_name = "metrics"
+
+    def get(self, request, *args, **kwargs):
+        fleet.refresh()
+        return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
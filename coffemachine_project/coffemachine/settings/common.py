@@ -80,6 +80,63 @@ TEMPLATES = [
 # Internationalization
 USE_I18N = False
 
+# ##### COFFEE MACHINE CONFIGURATION ######################
+
+# number of independent machines served by dispatcher
+COFFEE_MACHINE_FLEET_SIZE = 1
+
+# worker threads brewing queued orders and maximum number of waiting orders, orders are kept in memory of process,
+# so with many worker processes requests of client must reach the same process (sticky sessions)
+COFFEE_MACHINE_ORDER_WORKERS = 2
+COFFEE_MACHINE_ORDER_QUEUE_SIZE = 100
+
+# maximum number of coffees brewed in one batch
+COFFEE_MACHINE_BATCH_SIZE = 12
+
+# django cache keeping version stamp of recipes, it must be shared by all worker processes, e.g. memcached:
+# CACHES = {'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#                       'LOCATION': '127.0.0.1:11211'}}
+# default local memory cache is reported by warning, it works only with one worker process
+COFFEE_MACHINE_RECIPE_CACHE = 'default'
+# seconds between checks of version stamp of recipes, other workers see changed recipe after this delay
+COFFEE_MACHINE_RECIPE_CHECK_INTERVAL = 1.0
+
+# number of rendered problem fragments kept in memory
+COFFEE_MACHINE_PROBLEM_CACHE_SIZE = 32
+
+# number of idempotency keys of orders remembered by each process and seconds after which key is forgotten
+COFFEE_MACHINE_IDEMPOTENCY_KEYS = 1000
+COFFEE_MACHINE_IDEMPOTENCY_TTL = 600
+
+# persistent state of machines shared by worker processes, None keeps state only in memory of process
+# e.g. 'coffemachine.machine.state.DatabaseStateStore' or 'coffemachine.machine.state.MmapStateStore'
+COFFEE_MACHINE_STATE_STORE = None
+
+# memory mapped file with state of machines used by MmapStateStore, all worker processes must use the same file
+COFFEE_MACHINE_STATE_FILE = join(PROJECT_ROOT, 'run', 'machines.state')
+
+# append-only log of operations used to recover state of machines kept in memory after restart,
+# e.g. join(PROJECT_ROOT, 'run', 'machines.log'), None disables log; each process needs own log,
+# log is disabled in workers forked by preforking server, use COFFEE_MACHINE_STATE_STORE for them
+COFFEE_MACHINE_EVENT_LOG = None
+# number of operations of machine between checkpoints of its state
+COFFEE_MACHINE_CHECKPOINT_EVERY = 1000
+
+# clock modelling duration of device processes: 'instant' (no waiting, tests), 'scaled' (time runs
+# COFFEE_MACHINE_CLOCK_SPEED times faster than real device, e.g. staging) or 'realtime'
+COFFEE_MACHINE_CLOCK = 'instant'
+COFFEE_MACHINE_CLOCK_SPEED = 10
+
+# seconds after which weight of order in predicted consumption drops to half
+COFFEE_MACHINE_CONSUMPTION_HALF_LIFE = 3600
+
+# load recipes, templates and machines when application starts, e.g. in master process of preforking server,
+# so first request does not wait for them; keep it disabled for management commands running on empty database
+COFFEE_MACHINE_WARM_UP = False
+
+# hashed and precompressed bundles of static files written by build_assets command and served at /assets/
+COFFEE_MACHINE_ASSETS_ROOT = join(PROJECT_ROOT, 'run', 'assets')
+
 # ##### SECURITY CONFIGURATION ############################
 
 
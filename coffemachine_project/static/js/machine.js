@@ -1,11 +1,69 @@
 $( document ).ready(function() {
+    var new_idempotency_key = function(){
+        var bytes = new Uint8Array(16);
+        if (window.crypto && window.crypto.getRandomValues){
+            window.crypto.getRandomValues(bytes);
+        } else {
+            for (var i = 0; i < bytes.length; i++){
+                bytes[i] = Math.floor(Math.random() * 256);
+            }
+        }
+        return Array.prototype.map.call(bytes, function(byte){
+            return ("0" + byte.toString(16)).slice(-2);
+        }).join("");
+    };
+
+    var order_retries = 5;
+
+    // each retry of the same order sends the same key, so server brews it once
+    var order_coffee = function(button, key, coffee_type, attempt){
+        $.ajax({
+            url: "",
+            type: "POST",
+            timeout: 10000,
+            headers: {"Idempotency-Key": key},
+            data: {
+                csrfmiddlewaretoken: $("[name='csrfmiddlewaretoken']").val(),
+                method: "make_coffee",
+                coffee_type: coffee_type,
+            },
+        }).done(function( data ){
+            button.removeData("order_key");
+            if (data["events_url"] && window.EventSource){
+                follow_order(data["events_url"], data["status_url"], button);
+            } else if (data["status_url"]){
+                wait_for_order(data["status_url"], button);
+            } else {
+                show_order(data, button);
+            }
+        }).fail(function( xhr ){
+            if ((xhr.status === 0 || xhr.status === 409 || xhr.status === 503) && attempt < order_retries){
+                setTimeout(function(){ order_coffee(button, key, coffee_type, attempt + 1); }, 500 * (attempt + 1));
+            } else {
+                button.removeData("order_key");
+            }
+        });
+    };
+
     $("#coffee_maker").click(function(){
       var button = $(this);
-      $.post( "", {
-            csrfmiddlewaretoken: $("[name='csrfmiddlewaretoken']").val(),
-            method: "make_coffee",
-            coffee_type: $("#id_coffee_type").val(),
-        }, function( data ) {
+      if (button.data("order_key")){
+          return;
+      }
+      var key = new_idempotency_key();
+      button.data("order_key", key);
+      order_coffee(button, key, $("#id_coffee_type").val(), 0);
+    });
+
+    var update_availability = function(){
+        $.get( "/availability/", function( data ) {
+            $("#id_coffee_type option").each(function(){
+                $(this).attr("disabled", data["coffees"][$(this).val()] === 0);
+            });
+        });
+    };
+
+    var show_order = function(data, button){
         if (data["problems"]){
             $("#problems").html(data["problems"]);
             button.attr("disabled", true);
@@ -16,8 +74,46 @@ $( document ).ready(function() {
         if (data["image"]){
             $("#coffee_image").html("<img src='"+data["image"]+"'>");
         }
+        update_availability();
+    };
+
+    var stage_labels = {
+        trash: "Trash bin checked",
+        grinding: "Beans ground",
+        boiling: "Water boiled",
+        pressure: "Pump pressurized",
+        extra_water: "Extra water added",
+        milk: "Milk lathered",
+    };
+
+    var follow_order = function(events_url, status_url, button){
+        var source = new EventSource(events_url);
+        var finish = function(event){
+            source.close();
+            $("#progress").html("");
+            show_order(JSON.parse(event.data), button);
+        };
+        source.addEventListener("stage", function(event){
+            var data = JSON.parse(event.data);
+            $("#progress").html(stage_labels[data["stage"]] || "");
         });
-    });
+        source.addEventListener("done", finish);
+        source.addEventListener("failed", finish);
+        source.onerror = function(){
+            source.close();
+            wait_for_order(status_url, button);
+        };
+    };
+
+    var wait_for_order = function(status_url, button){
+        $.get( status_url, function( data ) {
+            if (data["status"] == "queued" || data["status"] == "brewing"){
+                setTimeout(function(){ wait_for_order(status_url, button); }, 500);
+            } else {
+                show_order(data, button);
+            }
+        });
+    };
 
     var change_options = function(option){
         $.post( "/ajax/", {
@@ -29,6 +125,7 @@ $( document ).ready(function() {
              $("[id*='options']").each(function(){
                 $(this).attr("disabled", true);
              })
+             update_availability();
         });
     };
 
@@ -36,5 +133,7 @@ $( document ).ready(function() {
         change_options($(this).attr("id"));
     });
 
+    update_availability();
+
 
 });